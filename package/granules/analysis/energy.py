@@ -4,7 +4,952 @@
 Created on Fri Nov 15 11:07:18 2019
 
 @author: jse
+
+Vectorized CHARMM energy and force kernels. Every kernel works on whole
+arrays of terms: 'xyz' holds the coordinates of all atoms (N,3) and the
+terms are given by rows of atom indices into 'xyz' (0-based) plus one array
+per force field parameter. Forces are accumulated per atom with np.bincount.
+
+Units are those of LAMMPS 'real': Angstroms, kcal/mol, degrees for the
+equilibrium angles in the parameter arrays.
+
+Every kernel returns (energy of each term, forces (N,3), virial) where the
+virial, sum of r (x) f over the atoms of each term (3,3), is only computed
+when asked for. With 'box' (lengths of an orthorhombic periodic cell) the
+vectors between atoms follow the minimum image convention.
 """
+import numpy as np
+
+COULOMB      = 332.0636    # kcal/mol A / e^2, as in CHARMM and LAMMPS real units
+
+# CHARMM switching between the inner and outer cutoffs, as in
+# LAMMPS pair_style lj/charmm/coul/charmm 8.0 10.0
+SWITCH_INNER = 8.0
+SWITCH_OUTER = 10.0
+
+# electrostatics of the non-bonded pairs (see coulombPairs)
+ELECTROSTATICS = ['charmm', 'dsf', 'rf', 'pme']
+DSF_ALPHA      = 0.2      # 1/A, damping of the damped shifted force
+
+# LAMMPS 'real' unit conversions (velocities in A/fs, pressure in atm)
+MVV2E        = 48.88821291 ** 2    # g/mol A^2/fs^2 -> kcal/mol
+NKTV2P       = 68568.415           # kcal/mol/A^3 -> atm
+BOLTZMANN    = 0.0019872067        # kcal/mol/K
+
+
+def scatter(index, vectors, natoms):
+    ''' sums 'vectors' (M,k,3) on the atoms given by 'index' (M,k).
+
+        Returns
+            (natoms,3) array
+    '''
+    index   = np.asarray(index).ravel()
+    vectors = np.asarray(vectors).reshape(-1, 3)
+    return np.column_stack([np.bincount(index, weights=vectors[:, c], minlength=natoms)
+                            for c in range(3)])
+
+
+def minimumImage(d, box=None):
+    ''' applies the minimum image convention to difference vectors d.'''
+    if box is None: return d
+    box = np.asarray(box, dtype=float)
+    return d - box * np.round(d / box)
+
+
+def termPositions(xyz, index, box=None):
+    ''' positions (M,k,3) of the atoms of each term relative to its first
+        atom, following the chain of atoms in 'index' (M,k) so that terms
+        split by a periodic boundary stay whole. With several frames
+        'xyz' (F,N,3) gives (F,M,k,3).
+    '''
+    d = minimumImage(xyz[..., index[:, 1:], :] - xyz[..., index[:, :-1], :], box)
+    return np.concatenate([np.zeros(d.shape[:-2] + (1, 3)), np.cumsum(d, axis=-2)], axis=-2)
+
+
+def termVirial(positions, termForces):
+    ''' sum of r (x) f (3,3) over the atoms of every term.'''
+    return pairVirial(positions.reshape(-1, 3), termForces.reshape(-1, 3))
+
+
+def pairVirial(d, f):
+    ''' sum of d (x) f (3,3) over rows of vectors (M,3), as one matrix product.'''
+    return d.T @ f
+
+
+def _finish(energy, index, positions, termForces, natoms, virial):
+    return energy, scatter(index, termForces, natoms), \
+           termVirial(positions, termForces) if virial else None
+
+
+def bondForces(xyz, index, K, r0, box=None, virial=False):
+    ''' CHARMM (LAMMPS harmonic) bond terms: E = K (r - r0)^2.
+
+        Parameter
+        ----------
+        xyz : array (N,3)
+            atom coordinates
+
+        index : int array (M,2)
+            rows of xyz of the atoms of each term
+
+        K, r0 : arrays (M)
+            force constant (kcal/mol/A^2) and equilibrium length
+
+        box : array of 3 floats or None
+            periodic cell lengths
+
+        virial : bool
+            also compute the virial
+
+        Returns
+            (energy of each term (M), forces on the atoms (N,3), virial (3,3) or None)
+    '''
+    index = np.asarray(index).reshape(-1, 2)
+    pos = termPositions(xyz, index, box)
+    d = pos[:, 1]
+    r = np.sqrt(np.sum(d * d, axis=-1))
+    dr = r - r0
+    fj = (-2 * K * dr / r)[:, np.newaxis] * d
+    return _finish(K * dr**2, index, pos, np.stack([-fj, fj], axis=1), len(xyz), virial)
+
+
+def angleForces(xyz, index, K, theta0, Kub, S0, box=None, virial=False):
+    ''' CHARMM angle terms with Urey-Bradley correction:
+        E = K (theta - theta0)^2 + Kub (s - S0)^2,
+        with s the distance between the first and the third atoms.
+
+        Parameter
+        ----------
+        xyz : array (N,3)
+            atom coordinates
+
+        index : int array (M,3)
+            rows of xyz of the atoms of each term, vertex in the middle
+
+        K, theta0 : arrays (M)
+            force constant (kcal/mol/rad^2) and equilibrium angle (degrees)
+
+        Kub, S0 : arrays (M)
+            Urey-Bradley force constant (kcal/mol/A^2) and distance
+
+        box : array of 3 floats or None
+            periodic cell lengths
+
+        virial : bool
+            also compute the virial
+
+        Returns
+            (energy of each term (M), forces on the atoms (N,3), virial (3,3) or None)
+    '''
+    index = np.asarray(index).reshape(-1, 3)
+    pos = termPositions(xyz, index, box)
+    a = pos[:, 0] - pos[:, 1]
+    b = pos[:, 2] - pos[:, 1]
+    ra = np.sqrt(np.sum(a * a, axis=-1))
+    rb = np.sqrt(np.sum(b * b, axis=-1))
+    cos = np.clip(np.sum(a * b, axis=-1) / (ra * rb), -1.0, 1.0)
+    theta = np.arccos(cos)
+    sin = np.maximum(np.sqrt(1.0 - cos * cos), 1e-8)
+
+    dtheta = theta - np.radians(theta0)
+    c = (2 * K * dtheta / sin)[:, np.newaxis]
+    fi = c * (b / (ra * rb)[:, np.newaxis] - cos[:, np.newaxis] * a / (ra * ra)[:, np.newaxis])
+    fk = c * (a / (ra * rb)[:, np.newaxis] - cos[:, np.newaxis] * b / (rb * rb)[:, np.newaxis])
+
+    # Urey-Bradley 1-3 spring
+    d = pos[:, 2]
+    s = np.sqrt(np.sum(d * d, axis=-1))
+    ds = s - S0
+    fub = (-2 * Kub * ds / s)[:, np.newaxis] * d
+    fi, fk = fi - fub, fk + fub
+
+    energy = K * dtheta**2 + Kub * ds**2
+    return _finish(energy, index, pos, np.stack([fi, -fi - fk, fk], axis=1), len(xyz), virial)
+
+
+def dihedralAngles(positions):
+    ''' dihedral angles (radians, IUPAC sign convention) of the quadruplets
+        of atoms with 'positions' (M,4,3), and their gradients with respect
+        to the positions of the four atoms (M,4,3).
+    '''
+    b1 = positions[:, 1] - positions[:, 0]
+    b2 = positions[:, 2] - positions[:, 1]
+    b3 = positions[:, 3] - positions[:, 2]
+    m = np.cross(b1, b2)
+    n = np.cross(b2, b3)
+    m2 = np.einsum('ij,ij->i', m, m)
+    n2 = np.einsum('ij,ij->i', n, n)
+    b2norm = np.sqrt(np.einsum('ij,ij->i', b2, b2))
+
+    phi = np.arctan2(b2norm * np.einsum('ij,ij->i', b1, n), np.einsum('ij,ij->i', m, n))
+
+    # Blondel and Karplus, J. Comput. Chem. 17, 1132 (1996)
+    gi = -(b2norm / m2)[:, np.newaxis] * m
+    gl =  (b2norm / n2)[:, np.newaxis] * n
+    p  = (np.einsum('ij,ij->i', b1, b2) / b2norm**2)[:, np.newaxis]
+    q  = (np.einsum('ij,ij->i', b3, b2) / b2norm**2)[:, np.newaxis]
+    gj = q * gl - (p + 1) * gi
+    gk = p * gi - (q + 1) * gl
+
+    return phi, np.stack([gi, gj, gk, gl], axis=1)
+
+
+def dihedralForces(xyz, index, K, n, delta, box=None, virial=False):
+    ''' CHARMM dihedral terms: E = K (1 + cos(n phi - delta)).
+        Dihedrals with several multiplicities appear once per term.
+
+        Parameter
+        ----------
+        xyz : array (N,3)
+            atom coordinates
+
+        index : int array (M,4)
+            rows of xyz of the atoms of each term
+
+        K, n, delta : arrays (M)
+            force constant (kcal/mol), multiplicity and phase (degrees)
+
+        box : array of 3 floats or None
+            periodic cell lengths
+
+        virial : bool
+            also compute the virial
+
+        Returns
+            (energy of each term (M), forces on the atoms (N,3), virial (3,3) or None)
+    '''
+    index = np.asarray(index).reshape(-1, 4)
+    pos = termPositions(xyz, index, box)
+    phi, grad = dihedralAngles(pos)
+    arg = n * phi - np.radians(delta)
+    energy = K * (1 + np.cos(arg))
+    dEdphi = -K * n * np.sin(arg)
+    return _finish(energy, index, pos, -dEdphi[:, np.newaxis, np.newaxis] * grad, len(xyz), virial)
+
+
+def improperForces(xyz, index, K, psi0, box=None, virial=False):
+    ''' CHARMM (and LAMMPS harmonic) improper terms: E = K (psi - psi0)^2,
+        with psi the dihedral angle of the four atoms.
+
+        Parameter
+        ----------
+        xyz : array (N,3)
+            atom coordinates
+
+        index : int array (M,4)
+            rows of xyz of the atoms of each term
+
+        K, psi0 : arrays (M)
+            force constant (kcal/mol/rad^2) and equilibrium angle (degrees)
+
+        box : array of 3 floats or None
+            periodic cell lengths
+
+        virial : bool
+            also compute the virial
+
+        Returns
+            (energy of each term (M), forces on the atoms (N,3), virial (3,3) or None)
+    '''
+    index = np.asarray(index).reshape(-1, 4)
+    pos = termPositions(xyz, index, box)
+    psi, grad = dihedralAngles(pos)
+    dpsi = np.mod(psi - np.radians(psi0) + np.pi, 2 * np.pi) - np.pi
+    energy = K * dpsi**2
+    dEdpsi = 2 * K * dpsi
+    return _finish(energy, index, pos, -dEdpsi[:, np.newaxis, np.newaxis] * grad, len(xyz), virial)
+
+
+def charmmSwitch(r2, inner, outer):
+    ''' CHARMM switching function of the squared distances 'r2':
+            S = (rc^2 - r^2)^2 (rc^2 + 2 r^2 - 3 ri^2) / (rc^2 - ri^2)^3
+        between the inner (ri) and outer (rc) cutoffs, 1 below ri and 0 beyond rc.
+
+        Returns
+            (S, -r dS/dr)
+    '''
+    rc2, ri2 = outer * outer, inner * inner
+    if inner >= outer:
+        return (r2 < rc2).astype(float), np.zeros_like(r2)
+    denom = (rc2 - ri2) ** 3
+    s  = np.where(r2 < ri2, 1.0, (rc2 - r2) ** 2 * (rc2 + 2 * r2 - 3 * ri2) / denom)
+    ds = np.where(r2 < ri2, 0.0, 12 * r2 * (rc2 - r2) * (r2 - ri2) / denom)
+    beyond = r2 >= rc2
+    s[beyond], ds[beyond] = 0.0, 0.0
+    return s, ds
+
+
+def coulombPairs(r2, qq, electrostatics='charmm', inner=SWITCH_INNER, outer=SWITCH_OUTER,
+                 alpha=DSF_ALPHA, epsilonRF=np.inf):
+    ''' Coulomb energy of pairs at squared distances 'r2' with charge
+        products 'qq', zero beyond 'outer' (Rc):
+
+        'charmm': switched   E = COULOMB qq / r S(r)  (LAMMPS coul/charmm)
+        'dsf'   : damped shifted force (Fennell and Gezelter, J. Chem. Phys. 124, 234104 (2006))
+                  E = COULOMB qq [erfc(a r)/r - erfc(a Rc)/Rc + F(Rc) (r - Rc)],
+                  F(r) = erfc(a r)/r^2 + 2a/sqrt(pi) exp(-a^2 r^2)/r   (LAMMPS coul/dsf)
+        'rf'    : reaction field with dielectric 'epsilonRF' beyond the cutoff
+                  E = COULOMB qq (1/r + k r^2 - c),
+                  k = (epsilonRF - 1) / ((2 epsilonRF + 1) Rc^3), c = 1/Rc + k Rc^2
+        'pme'   : real-space part of Ewald sums (see granules.analysis.pme)
+                  E = COULOMB qq erfc(a r)/r
+
+        Energies and forces of 'dsf' vanish at Rc without switching, as do
+        those of 'rf' with a conducting (infinite) epsilonRF.
+
+        Returns
+            (energy of each pair, -r dE/dr of each pair)
+    '''
+    r = np.sqrt(r2)
+    if electrostatics == 'charmm':
+        e = COULOMB * qq / r
+        sw, dsw = charmmSwitch(r2, inner, outer)
+        return e * sw, e * (sw + dsw)
+
+    within = r < outer
+    if electrostatics == 'dsf':
+        from scipy.special import erfc
+
+        shiftE = erfc(alpha * outer) / outer
+        shiftF = shiftE / outer + 2 * alpha / np.sqrt(np.pi) * np.exp(-(alpha * outer) ** 2) / outer
+        damped = erfc(alpha * r) / r
+        e  = COULOMB * qq * (damped - shiftE + shiftF * (r - outer))
+        rf = COULOMB * qq * r * (damped / r + 2 * alpha / np.sqrt(np.pi) * np.exp(-(alpha * r) ** 2) / r - shiftF)
+    elif electrostatics == 'pme':
+        from scipy.special import erfc
+
+        e  = COULOMB * qq * erfc(alpha * r) / r
+        rf = e + COULOMB * qq * 2 * alpha / np.sqrt(np.pi) * np.exp(-(alpha * r) ** 2)
+    elif electrostatics == 'rf':
+        k = 1.0 / (2 * outer ** 3) if np.isinf(epsilonRF) else \
+            (epsilonRF - 1) / ((2 * epsilonRF + 1) * outer ** 3)
+        c = 1.0 / outer + k * outer ** 2
+        e  = COULOMB * qq * (1.0 / r + k * r2 - c)
+        rf = COULOMB * qq * (1.0 / r - 2 * k * r2)
+    else:
+        raise ValueError("unknown electrostatics '{}', use one of {}".format(electrostatics, ELECTROSTATICS))
+    return np.where(within, e, 0.0), np.where(within, rf, 0.0)
+
+
+def coulombSelfEnergy(charge, electrostatics='charmm', outer=SWITCH_OUTER, alpha=DSF_ALPHA):
+    ''' energy of every charge with its own screening: nonzero only for 'dsf'
+        (-COULOMB (erfc(a Rc)/(2 Rc) + a/sqrt(pi)) sum q^2, as in LAMMPS coul/dsf)
+        and 'pme' (-COULOMB a/sqrt(pi) sum q^2).
+    '''
+    if electrostatics == 'pme':
+        return -COULOMB * alpha / np.sqrt(np.pi) * np.sum(charge ** 2)
+    if electrostatics != 'dsf': return 0.0
+    from scipy.special import erfc
+    return -COULOMB * (erfc(alpha * outer) / (2 * outer) + alpha / np.sqrt(np.pi)) * np.sum(charge ** 2)
+
+
+def pairForces(xyz, i, j, epsilon, rmin, qq, box=None, virial=False,
+               inner=SWITCH_INNER, outer=SWITCH_OUTER, electrostatics='charmm',
+               alpha=DSF_ALPHA, epsilonRF=np.inf):
+    ''' CHARMM non-bonded pair terms:
+            Lennard-Jones  E = eps [(Rmin/r)^12 - 2 (Rmin/r)^6] S(r)
+            Coulomb        E = COULOMB qi qj / r S(r)
+        with S the CHARMM switching function (charmmSwitch), as in LAMMPS
+        lj/charmm/coul/charmm, or another Coulomb model (see coulombPairs).
+        Pairs beyond 'outer' do not contribute.
+
+        Parameter
+        ----------
+        xyz : array (N,3)
+            atom coordinates
+
+        i, j : int arrays (M)
+            rows of xyz of the atoms of each pair
+
+        epsilon, rmin : arrays (M)
+            combined well depth (sqrt(eps_i eps_j)) and minimum (Rmin/2_i + Rmin/2_j)
+
+        qq : array (M)
+            product of the charges
+
+        box : array of 3 floats or None
+            periodic cell lengths
+
+        virial : bool
+            also compute the virial
+
+        inner, outer : float
+            cutoffs where the switching starts and ends (inner >= outer
+            truncates at outer without switching)
+
+        electrostatics, alpha, epsilonRF :
+            Coulomb model and its parameters (see coulombPairs)
+
+        Returns
+            (Lennard-Jones energy of each pair (M), Coulomb energy of each pair (M),
+             forces on the atoms (N,3), virial (3,3) or None)
+    '''
+    d = minimumImage(xyz[j] - xyz[i], box)
+    r2 = np.sum(d * d, axis=-1)
+    s6 = (rmin * rmin / r2) ** 3
+    elj = epsilon * (s6 * s6 - 2 * s6)
+    sw, dsw = charmmSwitch(r2, inner, outer)
+    ecoul, rfcoul = coulombPairs(r2, qq, electrostatics, inner, outer, alpha, epsilonRF)
+
+    # force on j divided by r
+    fr = (12 * epsilon * (s6 * s6 - s6) * sw + elj * dsw + rfcoul) / r2
+    elj = elj * sw
+    fj = fr[:, np.newaxis] * d
+    forces = scatter(np.concatenate([i, j]), np.concatenate([-fj, fj]), len(xyz))
+    return elj, ecoul, forces, (pairVirial(d, fj) if virial else None)
+
+
+class CharmmTerms:
+    ''' Arrays of atom indices and parameters of all the terms of a CHARMM
+        system, gathered once from the tables and reused by every evaluation.
+        Atom indices are rows of the coordinate array (0-based).
+
+        Attributes
+        ----------
+        natoms : int
+
+        charge, ljEpsilon, ljRmin2 : arrays (natoms)
+            charge, Lennard-Jones well depth and Rmin/2 of each atom
+
+        lj14Epsilon, lj14Rmin2 : arrays (natoms)
+            Lennard-Jones parameters for 1-4 pairs (default: the normal ones)
+
+        bonds, angles, dihedrals, impropers : int arrays (M,k)
+            atoms of each term
+
+        bondK, bondR0, angleK, angleTheta0, angleKub, angleS0,
+        dihedralK, dihedralN, dihedralDelta, improperK, improperPsi0 : arrays (M)
+            parameters of each term
+
+        pairs14 : int array (M,2)
+            1-4 pairs: first and last atoms of the dihedrals, each pair once
+            and only if it is not also a 1-2 or 1-3 pair (small rings)
+
+        exclusions : sorted int64 array
+            keys i * natoms + j (i < j) of the pairs left out of the main
+            non-bonded interactions (1-2, 1-3 and 1-4 pairs)
+    '''
+
+    def __init__(self, natoms, charge, ljEpsilon, ljRmin2,
+                 bonds, bondK, bondR0,
+                 angles, angleK, angleTheta0, angleKub, angleS0,
+                 dihedrals, dihedralK, dihedralN, dihedralDelta,
+                 impropers, improperK, improperPsi0,
+                 lj14Epsilon=None, lj14Rmin2=None):
+        self.natoms       = int(natoms)
+        self.charge       = np.asarray(charge, dtype=float)
+        self.ljEpsilon    = np.asarray(ljEpsilon, dtype=float)
+        self.ljRmin2      = np.asarray(ljRmin2, dtype=float)
+        self.lj14Epsilon  = self.ljEpsilon if lj14Epsilon is None else np.asarray(lj14Epsilon, dtype=float)
+        self.lj14Rmin2    = self.ljRmin2 if lj14Rmin2 is None else np.asarray(lj14Rmin2, dtype=float)
+
+        self.bonds        = np.asarray(bonds, dtype=int).reshape(-1, 2)
+        self.bondK        = np.asarray(bondK, dtype=float)
+        self.bondR0       = np.asarray(bondR0, dtype=float)
+
+        self.angles       = np.asarray(angles, dtype=int).reshape(-1, 3)
+        self.angleK       = np.asarray(angleK, dtype=float)
+        self.angleTheta0  = np.asarray(angleTheta0, dtype=float)
+        self.angleKub     = np.asarray(angleKub, dtype=float)
+        self.angleS0      = np.asarray(angleS0, dtype=float)
+
+        self.dihedrals     = np.asarray(dihedrals, dtype=int).reshape(-1, 4)
+        self.dihedralK     = np.asarray(dihedralK, dtype=float)
+        self.dihedralN     = np.asarray(dihedralN, dtype=float)
+        self.dihedralDelta = np.asarray(dihedralDelta, dtype=float)
+
+        self.impropers    = np.asarray(impropers, dtype=int).reshape(-1, 4)
+        self.improperK    = np.asarray(improperK, dtype=float)
+        self.improperPsi0 = np.asarray(improperPsi0, dtype=float)
+
+        excluded13 = self.pairKeys(self.bonds[:, 0], self.bonds[:, 1],
+                                   self.angles[:, 0], self.angles[:, 2])
+        keys14 = self.pairKeys(self.dihedrals[:, 0], self.dihedrals[:, 3])
+        keys14 = keys14[~np.isin(keys14, excluded13) & (keys14 // self.natoms != keys14 % self.natoms)]
+        self.pairs14      = np.column_stack([keys14 // self.natoms, keys14 % self.natoms])
+        self.exclusions   = np.union1d(excluded13, keys14)
+
+    def pairKeys(self, *pairs):
+        ''' sorted unique keys min * natoms + max of the pairs of atom
+            indices given as consecutive (i, j) arrays.
+        '''
+        keys = [np.minimum(i, j).astype(np.int64) * self.natoms + np.maximum(i, j)
+                for i, j in zip(pairs[::2], pairs[1::2])]
+        return np.unique(np.concatenate(keys)) if keys else np.zeros(0, dtype=np.int64)
+
+    def excluded(self, i, j):
+        ''' boolean mask of the pairs (i, j) in the exclusions.'''
+        keys = np.minimum(i, j).astype(np.int64) * self.natoms + np.maximum(i, j)
+        pos = np.searchsorted(self.exclusions, keys)
+        pos[pos == len(self.exclusions)] = 0
+        return (self.exclusions[pos] == keys) if len(self.exclusions) else np.zeros(len(keys), dtype=bool)
+
+    def nonBondedPairs(self, xyz, cutoff=SWITCH_OUTER, box=None):
+        ''' pairs (i, j) closer than 'cutoff' that are not excluded.'''
+        from granules.structure.neighbors import CellList
+
+        i, j, _ = CellList(xyz, cutoff, box).pairs()
+        keep = ~self.excluded(i, j)
+        return i[keep], j[keep]
+
+
+def charmmEvaluate(terms, xyz, box=None, virial=False, pairs=None,
+                   inner=SWITCH_INNER, outer=SWITCH_OUTER, electrostatics='charmm',
+                   alpha=DSF_ALPHA, epsilonRF=np.inf, pme=None):
+    ''' Energies, forces and (optionally) virial of a CHARMM system in one
+        pass over each kind of term.
+
+        Parameter
+        ----------
+        terms : CharmmTerms
+            gathered terms and parameters
+
+        xyz : array (N,3)
+            atom coordinates
+
+        box : array of 3 floats or None
+            periodic cell lengths
+
+        virial : bool
+            also compute the virial
+
+        pairs : (i, j) arrays or None
+            non-bonded pairs to use instead of searching them, without the
+            exclusions (pairs beyond 'outer' are ignored)
+
+        inner, outer : float
+            non-bonded switching cutoffs
+
+        electrostatics : str
+            Coulomb model of the non-bonded pairs: 'charmm' (switched),
+            'dsf' (damped shifted force, Wolf), 'rf' (reaction field) or
+            'pme' (particle-mesh Ewald, needs 'box'). 1-4 pairs always use
+            plain Coulomb.
+
+        alpha : float
+            damping parameter of 'dsf' (1/A)
+
+        epsilonRF : float
+            dielectric constant beyond the cutoff for 'rf' (default: conducting)
+
+        pme : granules.analysis.pme.PME or None
+            reciprocal-space grid for 'pme' (its alpha replaces 'alpha').
+            By default alpha gives erfc(alpha outer) = 1e-5 on a 1 A grid
+            with cubic B-splines.
+
+        Returns
+            (dict of energies per kind of term, forces (N,3), virial (3,3) or None)
+            with 'pme' the reciprocal-space energy is reported as 'kspace'
+    '''
+    xyz = np.asarray(xyz, dtype=float).reshape(-1, 3)
+    natoms = len(xyz)
+    energies = {}
+    forces = np.zeros((natoms, 3))
+    W = np.zeros((3, 3)) if virial else None
+
+    def add(name, result):
+        nonlocal W
+        energies[name] = np.sum(result[0])
+        forces[:] += result[1]
+        if virial: W += result[2]
+
+    add('bond', bondForces(xyz, terms.bonds, terms.bondK, terms.bondR0, box, virial))
+    add('angle', angleForces(xyz, terms.angles, terms.angleK, terms.angleTheta0,
+                             terms.angleKub, terms.angleS0, box, virial))
+    add('dihedral', dihedralForces(xyz, terms.dihedrals, terms.dihedralK, terms.dihedralN,
+                                   terms.dihedralDelta, box, virial))
+    add('improper', improperForces(xyz, terms.impropers, terms.improperK, terms.improperPsi0,
+                                   box, virial))
+
+    # 1-4 pairs, never cut off nor switched
+    i, j = terms.pairs14[:, 0], terms.pairs14[:, 1]
+    elj, ecoul, f, w = pairForces(xyz, i, j,
+                                  np.sqrt(terms.lj14Epsilon[i] * terms.lj14Epsilon[j]),
+                                  terms.lj14Rmin2[i] + terms.lj14Rmin2[j],
+                                  terms.charge[i] * terms.charge[j], box, virial, np.inf, np.inf)
+    energies['lj14'] = np.sum(elj)
+    energies['coulomb14'] = np.sum(ecoul)
+    forces += f
+    if virial: W += w
+
+    if electrostatics == 'pme':
+        from granules.analysis.pme import PME, ewaldAlpha
+
+        if box is None: raise ValueError("particle-mesh Ewald needs a periodic box")
+        if pme is None: pme = PME(box, ewaldAlpha(outer))
+        alpha = pme.alpha
+        add('kspace', pme.reciprocal(xyz, terms.charge, virial))
+
+    i, j = terms.nonBondedPairs(xyz, outer, box) if pairs is None else pairs
+    elj, ecoul, f, w = pairForces(xyz, i, j,
+                                  np.sqrt(terms.ljEpsilon[i] * terms.ljEpsilon[j]),
+                                  terms.ljRmin2[i] + terms.ljRmin2[j],
+                                  terms.charge[i] * terms.charge[j], box, virial, inner, outer,
+                                  electrostatics, alpha, epsilonRF)
+    energies['lj'] = np.sum(elj)
+    energies['coulomb'] = np.sum(ecoul) + coulombSelfEnergy(terms.charge, electrostatics, outer, alpha)
+    forces += f
+    if virial: W += w
+
+    if electrostatics == 'pme':
+        # excluded pairs are not in the neighbor list, remove them from kspace
+        from granules.analysis.pme import excludedPairs
+
+        i, j = terms.exclusions // terms.natoms, terms.exclusions % terms.natoms
+        ecorr, f, w = excludedPairs(xyz, i, j, terms.charge[i] * terms.charge[j], alpha, box, virial)
+        energies['coulomb'] += np.sum(ecorr)
+        forces += f
+        if virial: W += w
+
+    return energies, forces, W
+
+
+def kineticTensor(velocities, masses):
+    ''' sum of m v (x) v (3,3) in kcal/mol of atoms with 'velocities'
+        (N,3) in A/fs and 'masses' (N) in g/mol.
+    '''
+    velocities = np.asarray(velocities, dtype=float).reshape(-1, 3)
+    return MVV2E * pairVirial(velocities * np.asarray(masses, dtype=float)[:, np.newaxis], velocities)
+
+
+def pressureTensor(W, volume, kinetic=None):
+    ''' pressure tensor (3,3) in atm, as LAMMPS compute pressure:
+        (kinetic + W) / volume.
+
+        Parameter
+        ----------
+        W : array (3,3)
+            virial sum r (x) f in kcal/mol (charmmEvaluate with virial=True)
+
+        volume : float
+            volume of the periodic cell in A^3
+
+        kinetic : array (3,3) or None
+            kinetic tensor (kineticTensor); None gives only the configurational part
+    '''
+    total = np.array(W, dtype=float) + (0 if kinetic is None else kinetic)
+    return NKTV2P * total / volume
+
+
+def bondedEnergies(terms, frames, box=None, rows=None):
+    ''' bond, angle, dihedral and improper energies of several frames at
+        once, broadcasting every kind of term over the frames.
+
+        Parameter
+        ----------
+        terms : CharmmTerms
+            gathered terms and parameters
+
+        frames : array (F,N,3)
+            atom coordinates of each frame
+
+        box : array of 3 floats or None
+            periodic cell lengths
+
+        rows : dict or None
+            only the terms in rows['bond'], rows['angle'], rows['dihedral']
+            and rows['improper'] (all terms by default)
+
+        Returns
+            dict of energies (F) per kind of term
+    '''
+    def norm(v): return np.sqrt(np.sum(v * v, axis=-1))
+
+    def dot(a, b): return np.sum(a * b, axis=-1)
+
+    def pick(name, *arrays):
+        return arrays if rows is None else tuple(a[rows[name]] for a in arrays)
+
+    energies = {}
+    index, K, r0 = pick('bond', terms.bonds, terms.bondK, terms.bondR0)
+    pos = termPositions(frames, index, box)
+    energies['bond'] = np.sum(K * (norm(pos[..., 1, :]) - r0) ** 2, axis=-1)
+
+    index, K, theta0, Kub, S0 = pick('angle', terms.angles, terms.angleK, terms.angleTheta0,
+                                     terms.angleKub, terms.angleS0)
+    pos = termPositions(frames, index, box)
+    a = pos[..., 0, :] - pos[..., 1, :]
+    b = pos[..., 2, :] - pos[..., 1, :]
+    theta = np.arccos(np.clip(dot(a, b) / (norm(a) * norm(b)), -1.0, 1.0))
+    energies['angle'] = np.sum(K * (theta - np.radians(theta0)) ** 2 +
+                               Kub * (norm(pos[..., 2, :]) - S0) ** 2, axis=-1)
+
+    for name, params in [('dihedral', (terms.dihedrals, terms.dihedralK, terms.dihedralN, terms.dihedralDelta)),
+                         ('improper', (terms.impropers, terms.improperK, terms.improperPsi0))]:
+        params = pick(name, *params)
+        pos = termPositions(frames, params[0], box)
+        b1 = pos[..., 1, :] - pos[..., 0, :]
+        b2 = pos[..., 2, :] - pos[..., 1, :]
+        b3 = pos[..., 3, :] - pos[..., 2, :]
+        n = np.cross(b2, b3)
+        phi = np.arctan2(norm(b2) * dot(b1, n), dot(np.cross(b1, b2), n))
+        if name == 'dihedral':
+            K, mult, delta = params[1:]
+            e = K * (1 + np.cos(mult * phi - np.radians(delta)))
+        else:
+            K, psi0 = params[1:]
+            dpsi = np.mod(phi - np.radians(psi0) + np.pi, 2 * np.pi) - np.pi
+            e = K * dpsi ** 2
+        energies[name] = np.sum(e, axis=-1)
+    return energies
+
+
+def charmmFrameEnergies(terms, frames, box=None, chunk=100,
+                        inner=SWITCH_INNER, outer=SWITCH_OUTER, electrostatics='charmm',
+                        alpha=DSF_ALPHA, epsilonRF=np.inf, pme=None):
+    ''' CHARMM energies of every frame of a trajectory block. Bonded terms
+        are evaluated for 'chunk' frames at a time in one broadcasted pass
+        (bondedEnergies); non-bonded terms frame by frame, reusing the
+        exclusions and 1-4 pairs gathered in 'terms'.
+
+        Parameter
+        ----------
+        terms : CharmmTerms
+            gathered terms and parameters
+
+        frames : array (F,N,3)
+            atom coordinates of each frame
+
+        chunk : int
+            frames per broadcasted pass, caps the memory used by the
+            bonded terms to about chunk * (number of terms) * 100 bytes
+
+        box, inner, outer, electrostatics, alpha, epsilonRF, pme :
+            as in charmmEvaluate
+
+        Returns
+            dict of energies (F) per kind of term
+    '''
+    frames = np.asarray(frames, dtype=float).reshape(-1, terms.natoms, 3)
+    if electrostatics == 'pme':
+        if box is None: raise ValueError("particle-mesh Ewald needs a periodic box")
+        if pme is None:
+            from granules.analysis.pme import PME, ewaldAlpha
+            pme = PME(box, ewaldAlpha(outer))
+
+    energies = {}
+    for start in range(0, len(frames), max(int(chunk), 1)):
+        block = frames[start:start + max(int(chunk), 1)]
+        bonded = bondedEnergies(terms, block, box)
+        nonbonded = [charmmNonBondedEnergies(terms, xyz, box, inner, outer, electrostatics,
+                                             alpha, epsilonRF, pme) for xyz in block]
+        for name in nonbonded[0]:
+            bonded[name] = np.array([e[name] for e in nonbonded])
+        for name, values in bonded.items():
+            energies.setdefault(name, []).append(values)
+    return {name: np.concatenate(values) for name, values in energies.items()}
+
+
+def charmmNonBondedEnergies(terms, xyz, box=None, inner=SWITCH_INNER, outer=SWITCH_OUTER,
+                            electrostatics='charmm', alpha=DSF_ALPHA, epsilonRF=np.inf, pme=None):
+    ''' non-bonded energies (lj14, coulomb14, lj, coulomb and, with 'pme',
+        kspace) of one frame, without forces. Parameters as in charmmEvaluate.
+    '''
+    energies = {}
+    i, j = terms.pairs14[:, 0], terms.pairs14[:, 1]
+    r2 = np.sum(minimumImage(xyz[j] - xyz[i], box) ** 2, axis=-1)
+    energies['lj14'], energies['coulomb14'] = pairEnergies(
+        r2, np.sqrt(terms.lj14Epsilon[i] * terms.lj14Epsilon[j]), terms.lj14Rmin2[i] + terms.lj14Rmin2[j],
+        terms.charge[i] * terms.charge[j], np.inf, np.inf)
+
+    if electrostatics == 'pme':
+        from granules.analysis.pme import excludedPairs
+
+        alpha = pme.alpha
+        energies['kspace'] = pme.reciprocal(xyz, terms.charge)[0]
+
+    i, j = terms.nonBondedPairs(xyz, outer, box)
+    r2 = np.sum(minimumImage(xyz[j] - xyz[i], box) ** 2, axis=-1)
+    energies['lj'], energies['coulomb'] = pairEnergies(
+        r2, np.sqrt(terms.ljEpsilon[i] * terms.ljEpsilon[j]), terms.ljRmin2[i] + terms.ljRmin2[j],
+        terms.charge[i] * terms.charge[j], inner, outer, electrostatics, alpha, epsilonRF)
+    energies['coulomb'] += coulombSelfEnergy(terms.charge, electrostatics, outer, alpha)
+
+    if electrostatics == 'pme':
+        i, j = terms.exclusions // terms.natoms, terms.exclusions % terms.natoms
+        energies['coulomb'] += np.sum(excludedPairs(xyz, i, j, terms.charge[i] * terms.charge[j],
+                                                    alpha, box)[0])
+    return energies
+
+
+def pairEnergies(r2, epsilon, rmin, qq, inner=SWITCH_INNER, outer=SWITCH_OUTER,
+                 electrostatics='charmm', alpha=DSF_ALPHA, epsilonRF=np.inf):
+    ''' total Lennard-Jones and Coulomb energies of pairs at squared
+        distances 'r2' (see pairForces).
+
+        Returns
+            (Lennard-Jones, Coulomb)
+    '''
+    s6 = (rmin * rmin / r2) ** 3
+    elj = epsilon * (s6 * s6 - 2 * s6) * charmmSwitch(r2, inner, outer)[0]
+    return np.sum(elj), np.sum(coulombPairs(r2, qq, electrostatics, inner, outer, alpha, epsilonRF)[0])
+
+
+def atomShares(index, energy, natoms):
+    ''' splits the energy of each term equally among its atoms 'index'
+        (M,k) and sums it per atom (natoms).
+    '''
+    index = np.asarray(index).reshape(len(energy), -1)
+    k = index.shape[1]
+    return np.bincount(index.ravel(), weights=np.repeat(np.asarray(energy) / k, k), minlength=natoms)
+
+
+def groupMatrix(gi, gj, energy, ngroups):
+    ''' interaction matrix (ngroups,ngroups) of pair energies between the
+        groups 'gi' and 'gj' of the two atoms. The matrix is symmetric; the
+        diagonal holds the energies within each group.
+    '''
+    keys = np.minimum(gi, gj) * ngroups + np.maximum(gi, gj)
+    upper = np.bincount(keys, weights=energy, minlength=ngroups * ngroups).reshape(ngroups, ngroups)
+    return upper + upper.T - np.diag(np.diag(upper))
+
+
+def charmmDecomposition(terms, xyz, groups=None, box=None, pairs=None,
+                        inner=SWITCH_INNER, outer=SWITCH_OUTER, electrostatics='charmm',
+                        alpha=DSF_ALPHA, epsilonRF=np.inf, pme=None):
+    ''' Per-atom energies and group-by-group non-bonded interaction matrices
+        from the per-term energies of one evaluation, with np.bincount.
+
+        The energy of every term is shared equally by its atoms (half of a
+        pair to each atom, a third of an angle to each of its atoms...), so
+        the per-atom energies add up to the totals of charmmEvaluate. With
+        'pme' the reciprocal-space energy, which is not pairwise, is left out.
+
+        Parameter
+        ----------
+        terms : CharmmTerms
+            gathered terms and parameters
+
+        xyz : array (N,3)
+            atom coordinates
+
+        groups : int array (N) or None
+            group (0..G-1) of each atom: residue, molecule, selection...
+
+        pairs : (i, j) arrays or None
+            non-bonded pairs already found, without the exclusions
+
+        box, inner, outer, electrostatics, alpha, epsilonRF, pme :
+            as in charmmEvaluate
+
+        Returns
+            (dict of per-atom energies (N) per kind of term,
+             dict of interaction matrices (G,G) per kind of non-bonded term
+             (lj14, coulomb14, lj, coulomb) or None without groups)
+    '''
+    xyz = np.asarray(xyz, dtype=float).reshape(-1, 3)
+    natoms = len(xyz)
+    atoms = {}
+    atoms['bond'] = atomShares(terms.bonds, bondForces(xyz, terms.bonds, terms.bondK, terms.bondR0, box)[0], natoms)
+    atoms['angle'] = atomShares(terms.angles,
+                                angleForces(xyz, terms.angles, terms.angleK, terms.angleTheta0,
+                                            terms.angleKub, terms.angleS0, box)[0], natoms)
+    atoms['dihedral'] = atomShares(terms.dihedrals,
+                                   dihedralForces(xyz, terms.dihedrals, terms.dihedralK,
+                                                  terms.dihedralN, terms.dihedralDelta, box)[0], natoms)
+    atoms['improper'] = atomShares(terms.impropers,
+                                   improperForces(xyz, terms.impropers, terms.improperK,
+                                                  terms.improperPsi0, box)[0], natoms)
+
+    pairTerms = []
+    i, j = terms.pairs14[:, 0], terms.pairs14[:, 1]
+    elj, ecoul = pairForces(xyz, i, j, np.sqrt(terms.lj14Epsilon[i] * terms.lj14Epsilon[j]),
+                            terms.lj14Rmin2[i] + terms.lj14Rmin2[j],
+                            terms.charge[i] * terms.charge[j], box, False, np.inf, np.inf)[:2]
+    pairTerms += [('lj14', i, j, elj), ('coulomb14', i, j, ecoul)]
+
+    if electrostatics == 'pme':
+        if box is None: raise ValueError("particle-mesh Ewald needs a periodic box")
+        if pme is None:
+            from granules.analysis.pme import ewaldAlpha
+            alpha = ewaldAlpha(outer)
+        else:
+            alpha = pme.alpha
+
+    i, j = terms.nonBondedPairs(xyz, outer, box) if pairs is None else pairs
+    elj, ecoul = pairForces(xyz, i, j, np.sqrt(terms.ljEpsilon[i] * terms.ljEpsilon[j]),
+                            terms.ljRmin2[i] + terms.ljRmin2[j], terms.charge[i] * terms.charge[j],
+                            box, False, inner, outer, electrostatics, alpha, epsilonRF)[:2]
+    if electrostatics == 'pme':
+        from granules.analysis.pme import excludedPairs
+
+        ei, ej = terms.exclusions // terms.natoms, terms.exclusions % terms.natoms
+        ecorr = excludedPairs(xyz, ei, ej, terms.charge[ei] * terms.charge[ej], alpha, box)[0]
+        i, j, ecoul = np.concatenate([i, ei]), np.concatenate([j, ej]), np.concatenate([ecoul, ecorr])
+        elj = np.concatenate([elj, np.zeros(len(ei))])
+    pairTerms += [('lj', i, j, elj), ('coulomb', i, j, ecoul)]
+
+    for name, i, j, e in pairTerms:
+        atoms[name] = atomShares(np.column_stack([i, j]), e, natoms)
+    # self energies (dsf, pme) of each charge
+    atoms['coulomb'] += coulombSelfEnergy(np.ones(1), electrostatics, outer, alpha) * terms.charge ** 2
+
+    if groups is None: return atoms, None
+    groups = np.asarray(groups, dtype=int)
+    ngroups = groups.max() + 1 if len(groups) else 0
+    return atoms, {name: groupMatrix(groups[i], groups[j], e, ngroups) for name, i, j, e in pairTerms}
+
+
+def finiteDifferenceForces(energy, xyz, h=1e-5):
+    ''' forces -dE/dx by central differences of 'energy(xyz)' (for testing).'''
+    forces = np.zeros_like(xyz)
+    for a in range(len(xyz)):
+        for c in range(3):
+            x = xyz.copy()
+            x[a, c] += h
+            ep = energy(x)
+            x[a, c] -= 2 * h
+            forces[a, c] = -(ep - energy(x)) / (2 * h)
+    return forces
+
+
+#=============================================================================
+if __name__ == "__main__":  # tests
+    import time
+
+    rng = np.random.default_rng(3)
+
+    # finite differences on a few random terms; without a periodic box the
+    # virial must equal sum x (x) F
+    xyz   = rng.uniform(0, 4, (12, 3))
+    index = np.array([[0, 1, 2, 3], [4, 5, 6, 7], [8, 9, 10, 11], [0, 1, 2, 3], [3, 5, 7, 9]])
+    K, n, delta = rng.uniform(0.1, 2, 5), np.array([1, 2, 3, 6, 2]), np.array([0, 180, 0, 90, 120])
+    r0, kub = rng.uniform(1, 2, 5), rng.uniform(0, 50, 5)
+    for name, kernel, idx, params in [
+            ("bond", bondForces, index[:, :2], (K, r0)),
+            ("angle", angleForces, index[:, :3], (K, delta, kub, r0)),
+            ("dihedral", dihedralForces, index, (K, n, delta)),
+            ("improper", improperForces, index, (K, delta))]:
+        energy, forces, W = kernel(xyz, idx, *params, virial=True)
+        fd = finiteDifferenceForces(lambda x: kernel(x, idx, *params)[0].sum(), xyz)
+        print("{:8}: max |F - F(finite differences)| = {:.2e}, virial error = {:.2e}".format(
+              name, np.abs(forces - fd).max(), np.abs(W - xyz.T @ forces).max()))
+
+    i, j = np.triu_indices(len(xyz), 1)
+    eps, rmin, qq = rng.uniform(0.01, 0.2, len(i)), rng.uniform(2, 4, len(i)), rng.uniform(-1, 1, len(i))
+    elj, ecoul, forces, W = pairForces(xyz, i, j, eps, rmin, qq, virial=True, inner=2.0, outer=4.0)
+    fd = finiteDifferenceForces(lambda x: np.sum(pairForces(x, i, j, eps, rmin, qq,
+                                                            inner=2.0, outer=4.0)[:2]), xyz)
+    print("{:8}: max |F - F(finite differences)| = {:.2e}, virial error = {:.2e} (relative)".format(
+          "pair", np.abs(forces - fd).max() / np.abs(fd).max(),
+          np.abs(W - xyz.T @ forces).max() / np.abs(W).max()))
+
+    # Coulomb models: forces, and energy and force going to zero at the cutoff
+    for method in ELECTROSTATICS:
+        energy = lambda x: np.sum(pairForces(x, i, j, eps, rmin, qq, inner=2.0, outer=4.0,
+                                             electrostatics=method)[1])
+        forces = pairForces(xyz, i, j, 0 * eps, rmin, qq, inner=2.0, outer=4.0, electrostatics=method)[2]
+        fd = finiteDifferenceForces(energy, xyz)
+        e, rf = coulombPairs(np.array([4.0 - 1e-6]) ** 2, 1.0, method, 2.0, 4.0)
+        print("{:8}: max |F - F(finite differences)| = {:.2e}, E(Rc) = {:.1e}, F(Rc) = {:.1e}".format(
+              method, np.abs(forces - fd).max() / np.abs(fd).max(), e[0], rf[0] / 4.0))
 
-def computeChainTorsionForces():
-    
\ No newline at end of file
+    # array speed
+    natoms = 100000
+    xyz    = np.cumsum(rng.normal(0, 1, (natoms, 3)), axis=0)   # random chain
+    index  = rng.integers(0, natoms - 3, 100000)[:, np.newaxis] + np.arange(4)
+    K, n, delta = rng.uniform(0.1, 2, len(index)), rng.integers(1, 4, len(index)), np.zeros(len(index))
+    start = time.time()
+    dihedralForces(xyz, index, K, n, delta)
+    improperForces(xyz, index, K, delta)
+    print("100000 dihedrals and 100000 impropers in {:.3f} s".format(time.time() - start))
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Incremental CHARMM energies for Monte Carlo moves and placement scans.
+
+When a few atoms move only the terms and pairs that contain them change.
+IncrementalEnergy keeps, for every kind of bonded term, the list of terms
+of each atom (compressed rows, as a cell list) and a cell list of the atoms
+built with a skin, so a move of k atoms costs O(k) whatever the size of
+the system. The cell list is rebuilt once some atom has drifted more than
+the skin from the position it was binned at.
+
+Units are those of LAMMPS 'real'.
+"""
+import numpy as np
+
+from granules.analysis.energy import (SWITCH_INNER, SWITCH_OUTER, DSF_ALPHA, minimumImage,
+                                      bondedEnergies, charmmNonBondedEnergies, pairEnergies)
+
+BONDED = ['bond', 'angle', 'dihedral', 'improper']
+
+
+def atomTermIndex(index, natoms):
+    ''' per-atom index of the terms given by rows of atom indices (M,k).
+
+        Returns
+            (term rows sorted by atom, first position of each atom, count of each atom)
+    '''
+    atoms  = np.asarray(index, dtype=int).ravel()
+    order  = np.argsort(atoms, kind='stable')
+    counts = np.bincount(atoms, minlength=natoms)
+    starts = np.cumsum(counts) - counts
+    return order // max(index.shape[1], 1), starts, counts
+
+
+class IncrementalEnergy:
+    ''' Energy of a CHARMM system that is updated move by move.
+
+        Parameters
+        ----------
+        terms : granules.analysis.energy.CharmmTerms
+
+        xyz : array (N,3)
+            starting coordinates (copied)
+
+        box : array of 3 floats or None
+            periodic cell lengths
+
+        skin : float
+            extra width of the cells, in A. Larger skins rebuild the cell
+            list less often but visit more candidate pairs per move.
+
+        inner, outer, electrostatics, alpha, epsilonRF :
+            as in granules.analysis.energy.charmmEvaluate. 'pme' is not
+            supported: its reciprocal part couples every pair of atoms.
+
+        Attributes
+        ----------
+        energies : dict
+            current energy of each kind of term
+
+        energy : float
+            current total energy
+    '''
+
+    def __init__(self, terms, xyz, box=None, skin=2.0, inner=SWITCH_INNER, outer=SWITCH_OUTER,
+                 electrostatics='charmm', alpha=DSF_ALPHA, epsilonRF=np.inf):
+        if electrostatics == 'pme':
+            raise ValueError("incremental energies need short ranged electrostatics ('charmm', 'dsf' or 'rf')")
+        self.terms  = terms
+        self.xyz    = np.array(xyz, dtype=float).reshape(-1, 3)
+        self.box    = None if box is None else np.asarray(box, dtype=float)
+        self.skin   = float(skin)
+        self.params = (inner, outer, electrostatics, alpha, epsilonRF)
+
+        self.index = {name: atomTermIndex(index, terms.natoms) for name, index in
+                      [('bond', terms.bonds), ('angle', terms.angles), ('dihedral', terms.dihedrals),
+                       ('improper', terms.impropers), ('pair14', terms.pairs14)]}
+        self._binAtoms()
+
+        self.energies = bondedEnergies(terms, self.xyz, self.box)
+        self.energies.update(charmmNonBondedEnergies(terms, self.xyz, self.box, *self.params))
+        self.energies = {name: float(e) for name, e in self.energies.items()}
+
+    @property
+    def energy(self):
+        return sum(self.energies.values())
+
+    def _binAtoms(self):
+        from granules.structure.neighbors import CellList
+
+        self.cells = CellList(self.xyz.copy(), self.params[1] + self.skin, self.box)
+        self.drift = 0.0
+
+    def _termsOf(self, name, moved):
+        ''' rows of the terms of kind 'name' that contain any of the moved atoms.'''
+        rows, starts, counts = self.index[name]
+        cnt = counts[moved]
+        pos = np.repeat(starts[moved] - (np.cumsum(cnt) - cnt), cnt) + np.arange(cnt.sum())
+        return np.unique(rows[pos])
+
+    def _pairsOf(self, moved, newXyz):
+        ''' non-excluded pairs with at least one moved atom that may be
+            within the outer cutoff before or after the move, each pair once.
+        '''
+        q, a, _ = self.cells.query(np.vstack([self.xyz[moved], newXyz]), self.params[1] + self.skin)
+        keep = ~np.isin(a, moved)
+        keys = np.unique(moved[q[keep] % len(moved)].astype(np.int64) * self.terms.natoms + a[keep])
+        i, j = np.triu_indices(len(moved), 1)
+        i = np.concatenate([keys // self.terms.natoms, moved[i]])
+        j = np.concatenate([keys % self.terms.natoms, moved[j]])
+        keep = ~self.terms.excluded(i, j)
+        return i[keep], j[keep]
+
+    def _localEnergies(self, rows, pairs):
+        ''' energies of the terms in 'rows' and of the candidate 'pairs'.'''
+        terms, xyz, box = self.terms, self.xyz, self.box
+        outer = self.params[1]
+        energies = {name: float(e) for name, e in bondedEnergies(terms, xyz, box, rows).items()}
+
+        p14 = terms.pairs14[rows['pair14']]
+        i, j = p14[:, 0], p14[:, 1]
+        r2 = np.sum(minimumImage(xyz[j] - xyz[i], box) ** 2, axis=-1)
+        energies['lj14'], energies['coulomb14'] = pairEnergies(
+            r2, np.sqrt(terms.lj14Epsilon[i] * terms.lj14Epsilon[j]), terms.lj14Rmin2[i] + terms.lj14Rmin2[j],
+            terms.charge[i] * terms.charge[j], np.inf, np.inf)
+
+        i, j = pairs
+        r2 = np.sum(minimumImage(xyz[j] - xyz[i], box) ** 2, axis=-1)
+        near = r2 < outer * outer
+        i, j, r2 = i[near], j[near], r2[near]
+        energies['lj'], energies['coulomb'] = pairEnergies(
+            r2, np.sqrt(terms.ljEpsilon[i] * terms.ljEpsilon[j]), terms.ljRmin2[i] + terms.ljRmin2[j],
+            terms.charge[i] * terms.charge[j], *self.params)
+        return energies
+
+    def deltas(self, moved, newXyz):
+        ''' change of the energy of each kind of term if the atoms 'moved'
+            (indices, without repetitions) were at 'newXyz' (k,3). The
+            current coordinates are not changed.
+
+            returns dict of energy differences
+        '''
+        moved  = np.asarray(moved, dtype=int).ravel()
+        newXyz = np.asarray(newXyz, dtype=float).reshape(-1, 3)
+        if len(np.unique(moved)) != len(moved):
+            raise ValueError("repeated atoms in 'moved'")
+        rows  = {name: self._termsOf(name, moved) for name in BONDED + ['pair14']}
+        pairs = self._pairsOf(moved, newXyz)
+
+        old = self._localEnergies(rows, pairs)
+        saved = self.xyz[moved]
+        self.xyz[moved] = newXyz
+        try:
+            new = self._localEnergies(rows, pairs)
+        finally:
+            self.xyz[moved] = saved
+        return {name: new[name] - old[name] for name in old}
+
+    def delta(self, moved, newXyz):
+        ''' change of the total energy if the atoms 'moved' were at 'newXyz'.'''
+        return sum(self.deltas(moved, newXyz).values())
+
+    def accept(self, moved, newXyz):
+        ''' moves the atoms 'moved' to 'newXyz' and updates the energies.
+
+            returns the change of the total energy
+        '''
+        moved  = np.asarray(moved, dtype=int).ravel()
+        deltas = self.deltas(moved, newXyz)
+        for name, d in deltas.items(): self.energies[name] += d
+        self.xyz[moved] = np.asarray(newXyz, dtype=float).reshape(-1, 3)
+
+        # atoms binned more than a skin away could miss pairs
+        drift = np.sqrt(np.sum(self.cells.minimumImage(self.xyz[moved] - self.cells.xyz[moved]) ** 2, axis=1))
+        self.drift = max(self.drift, drift.max(initial=0.0))
+        if self.drift > self.skin: self._binAtoms()
+        return sum(deltas.values())
+
+
+#=============================================================================
+if __name__ == "__main__":  # tests
+    import time
+    from granules.analysis.energy import CharmmTerms
+
+    rng = np.random.default_rng(7)
+
+    def waterBox(nmol):
+        ''' rigid-geometry TIP3P-like waters on a grid with random orientations.'''
+        side = int(np.ceil(nmol ** (1.0/3)))
+        L = side * 3.1
+        centers = (np.indices((side,) * 3).reshape(3, -1).T[:nmol] + 0.5) * 3.1
+        u = rng.normal(size=(nmol, 3)); u /= np.linalg.norm(u, axis=1)[:, None]
+        v = np.cross(u, rng.normal(size=(nmol, 3))); v /= np.linalg.norm(v, axis=1)[:, None]
+        h1 = centers + 0.9572 * (np.cos(0.9119) * u + np.sin(0.9119) * v)
+        h2 = centers + 0.9572 * (np.cos(0.9119) * u - np.sin(0.9119) * v)
+        xyz = np.stack([centers, h1, h2], axis=1).reshape(-1, 3)
+        o = np.arange(nmol) * 3
+        none = np.zeros((0, 4), dtype=int)
+        terms = CharmmTerms(3 * nmol, np.tile([-0.834, 0.417, 0.417], nmol),
+                            np.tile([0.1521, 0.046, 0.046], nmol), np.tile([1.7682, 0.2245, 0.2245], nmol),
+                            np.column_stack([np.repeat(o, 2), np.column_stack([o + 1, o + 2]).ravel()]),
+                            np.full(2 * nmol, 450.0), np.full(2 * nmol, 0.9572),
+                            np.column_stack([o + 1, o, o + 2]), np.full(nmol, 55.0), np.full(nmol, 104.52),
+                            np.zeros(nmol), np.zeros(nmol),
+                            none, [], [], [], none, [], [])
+        return terms, xyz, np.full(3, side * 3.1)
+
+    for electrostatics in ['charmm', 'dsf']:
+        terms, xyz, box = waterBox(1000)
+        inc = IncrementalEnergy(terms, xyz, box, electrostatics=electrostatics)
+        for step in range(200):
+            m = 3 * rng.integers(len(xyz) // 3)
+            moved = np.arange(m, m + 3)
+            inc.accept(moved, inc.xyz[moved] + rng.normal(scale=0.3, size=3))
+        full = IncrementalEnergy(terms, inc.xyz, box, electrostatics=electrostatics).energy
+        print("{:7s} after 200 accepted moves: incremental {:.8f}  full {:.8f}".format(
+              electrostatics, inc.energy, full))
+
+    print("\nper-move cost of displacing one water")
+    for nmol in [1000, 8000, 27000]:
+        terms, xyz, box = waterBox(nmol)
+        inc = IncrementalEnergy(terms, xyz, box)
+        t0 = time.time()
+        for step in range(200):
+            m = 3 * rng.integers(nmol)
+            moved = np.arange(m, m + 3)
+            inc.delta(moved, inc.xyz[moved] + rng.normal(scale=0.3, size=3))
+        t1 = time.time()
+        IncrementalEnergy(terms, xyz, box)
+        t2 = time.time()
+        print("{:7d} atoms: {:7.3f} ms per move, {:8.1f} ms full evaluation".format(
+              len(xyz), (t1 - t0) / 200 * 1000, (t2 - t1) * 1000))
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Smooth particle-mesh Ewald (Essmann et al., J. Chem. Phys. 103, 8577 (1995))
+for orthorhombic periodic cells, with NumPy FFTs.
+
+The Coulomb energy of a periodic system is split in
+    real space       COULOMB qi qj erfc(alpha r)/r on the neighbor list
+                     (granules.analysis.energy.coulombPairs, 'pme')
+    reciprocal space charges spread on a grid with B-splines (PME.reciprocal)
+    self energy      -COULOMB alpha/sqrt(pi) sum q^2
+    exclusions       -COULOMB qi qj erf(alpha r)/r for the excluded pairs
+                     (excludedPairs)
+
+Units are those of LAMMPS 'real'.
+"""
+import numpy as np
+
+from granules.analysis.energy import COULOMB, scatter, minimumImage, pairVirial
+
+
+def ewaldAlpha(cutoff, tolerance=1e-5):
+    ''' splitting parameter alpha (1/A) with erfc(alpha cutoff) = tolerance.'''
+    from scipy.special import erfcinv
+    return erfcinv(tolerance) / cutoff
+
+
+def fftSize(n):
+    ''' smallest integer >= n whose only prime factors are 2, 3 and 5.'''
+    n = max(int(np.ceil(n)), 1)
+    while True:
+        m = n
+        for p in (2, 3, 5):
+            while m % p == 0: m //= p
+        if m == 1: return n
+        n += 1
+
+
+def bsplineWeights(w, order):
+    ''' cardinal B-spline weights of 'order' and their derivatives for the
+        fractional grid coordinates w (N) in [0,1). Weight p goes to the grid
+        point floor(u) + p.
+
+        Returns
+            (weights (N,order), derivatives (N,order))
+    '''
+    w = np.asarray(w, dtype=float)
+    data = np.zeros((len(w), order))
+    data[:, 0] = 1 - w
+    data[:, 1] = w
+    for j in range(3, order):
+        div = 1.0 / (j - 1)
+        data[:, j - 1] = div * w * data[:, j - 2]
+        for k in range(1, j - 1):
+            data[:, j - k - 1] = div * ((w + k) * data[:, j - k - 2] + (j - k - w) * data[:, j - k - 1])
+        data[:, 0] = div * (1 - w) * data[:, 0]
+
+    deriv = np.empty_like(data)
+    deriv[:, 0] = -data[:, 0]
+    deriv[:, 1:] = data[:, :-1] - data[:, 1:]
+
+    div = 1.0 / (order - 1)
+    data[:, order - 1] = div * w * data[:, order - 2]
+    for k in range(1, order - 1):
+        data[:, order - k - 1] = div * ((w + k) * data[:, order - k - 2] + (order - k - w) * data[:, order - k - 1])
+    data[:, 0] = div * (1 - w) * data[:, 0]
+    return data, deriv
+
+
+def bsplineModuli(K, order):
+    ''' |b(m)|^2 of the B-spline interpolation for m = 0..K-1 (Essmann eq. 4.4).'''
+    M = bsplineWeights(np.zeros(1), order)[0][0]
+    m = np.arange(K)
+    arg = 2 * np.pi * np.outer(m, np.arange(order)) / K
+    denom = np.abs(np.exp(1j * arg) @ M) ** 2
+    # odd orders vanish at the Nyquist frequency
+    small = denom < 1e-7
+    denom[small] = 0.5 * (denom[np.roll(small, 1)] + denom[np.roll(small, -1)])
+    return 1.0 / denom
+
+
+class PME:
+    ''' Reciprocal-space part of smooth particle-mesh Ewald.
+
+        Parameters
+        ----------
+        box : array of 3 floats
+            lengths of the orthorhombic periodic cell
+
+        alpha : float
+            Ewald splitting parameter (1/A), see ewaldAlpha()
+
+        spacing : float
+            maximum grid spacing (A)
+
+        order : int
+            B-spline interpolation order (4 is cubic)
+
+        grid : 3 ints or None
+            number of grid points along each axis instead of the ones
+            given by 'spacing'
+    '''
+
+    def __init__(self, box, alpha, spacing=1.0, order=4, grid=None):
+        self.box     = np.asarray(box, dtype=float).reshape(3)
+        self.alpha   = float(alpha)
+        self.order   = int(order)
+        self.spacing = float(spacing)
+        self.grid    = np.array([fftSize(L / spacing) for L in self.box]) if grid is None \
+                       else np.asarray(grid, dtype=int).reshape(3)
+
+        # influence function B(m) C(m) on the half spectrum of rfftn
+        K = self.grid
+        m = [np.fft.fftfreq(K[0]) * K[0], np.fft.fftfreq(K[1]) * K[1], np.fft.rfftfreq(K[2]) * K[2]]
+        mx, my, mz = np.meshgrid(m[0] / self.box[0], m[1] / self.box[1], m[2] / self.box[2], indexing='ij')
+        m2 = mx * mx + my * my + mz * mz
+        m2[0, 0, 0] = 1.0
+        volume = np.prod(self.box)
+        C = np.exp(-np.pi**2 * m2 / self.alpha**2) / (np.pi * volume * m2)
+        C[0, 0, 0] = 0.0
+        B = [bsplineModuli(K[d], self.order) for d in range(3)]
+        self.influence = C * B[0][:, None, None] * B[1][None, :, None] * B[2][None, None, :len(m[2])]
+
+        # for the virial: terms counted twice in the half spectrum and the
+        # tensor factors delta_ab - 2 (1 + pi^2 m^2/alpha^2) m_a m_b / m^2
+        self._twice = np.full(len(m[2]), 2.0)
+        self._twice[0] = 1.0
+        if K[2] % 2 == 0: self._twice[-1] = 1.0
+        factor = 2 * (1 + np.pi**2 * m2 / self.alpha**2) / m2
+        vecs = (mx, my, mz)
+        self._virialFactors = np.array([[(a == b) - factor * vecs[a] * vecs[b] for b in range(3)]
+                                        for a in range(3)])
+
+    @classmethod
+    def fromPBC(cls, pbc, alpha, spacing=1.0, order=4):
+        ''' PME for the cell of a NAMDdata.PBC object.'''
+        from granules.structure.neighbors import boxLengths
+        return cls(boxLengths(pbc), alpha, spacing, order)
+
+    def _splines(self, xyz):
+        u = np.mod(xyz / self.box, 1.0) * self.grid
+        base = np.floor(u).astype(int)
+        splines = [bsplineWeights(u[:, d] - base[:, d], self.order) for d in range(3)]
+        points = [np.mod(base[:, d, None] + np.arange(self.order), self.grid[d]) for d in range(3)]
+        return splines, points
+
+    def reciprocal(self, xyz, charge, virial=False):
+        ''' reciprocal-space energy, forces and, optionally, virial.
+
+            Parameter
+            ----------
+            xyz : array (N,3)
+                atom coordinates
+
+            charge : array (N)
+                atom charges
+
+            virial : bool
+                also compute the virial sum r (x) f
+
+            Returns
+                (energy, forces (N,3), virial (3,3) or None)
+        '''
+        xyz = np.asarray(xyz, dtype=float).reshape(-1, 3)
+        charge = np.asarray(charge, dtype=float)
+        K = self.grid
+        ((Mx, dMx), (My, dMy), (Mz, dMz)), (px, py, pz) = self._splines(xyz)
+
+        # spread the charges, one plane of x weights at a time to bound memory
+        yz = (py[:, :, None] * K[2] + pz[:, None, :]).reshape(len(xyz), -1)
+        wyz = (My[:, :, None] * Mz[:, None, :]).reshape(len(xyz), -1)
+        Q = np.zeros(np.prod(K))
+        for a in range(self.order):
+            flat = (px[:, a, None] * (K[1] * K[2]) + yz).ravel()
+            Q += np.bincount(flat, weights=((charge * Mx[:, a])[:, None] * wyz).ravel(), minlength=len(Q))
+        Q = Q.reshape(K)
+
+        FQ = np.fft.rfftn(Q)
+        phi = COULOMB * np.prod(K) * np.fft.irfftn(self.influence * FQ, s=tuple(K))
+        energy = 0.5 * np.sum(Q * phi)
+
+        # interpolate the gradient of the potential back to the atoms
+        phiFlat = phi.ravel()
+        dyz = [(dMy[:, :, None] * Mz[:, None, :]).reshape(len(xyz), -1),
+               (My[:, :, None] * dMz[:, None, :]).reshape(len(xyz), -1)]
+        grad = np.zeros((len(xyz), 3))
+        for a in range(self.order):
+            values = phiFlat[px[:, a, None] * (K[1] * K[2]) + yz]
+            grad[:, 0] += dMx[:, a] * np.sum(values * wyz, axis=1)
+            grad[:, 1] += Mx[:, a] * np.sum(values * dyz[0], axis=1)
+            grad[:, 2] += Mx[:, a] * np.sum(values * dyz[1], axis=1)
+        forces = -charge[:, None] * grad * (K / self.box)
+
+        W = None
+        if virial:
+            em = 0.5 * COULOMB * self.influence * np.abs(FQ) ** 2 * self._twice
+            W = np.einsum('abijk,ijk->ab', self._virialFactors, em)
+        return energy, forces, W
+
+
+def excludedPairs(xyz, i, j, qq, alpha, box=None, virial=False):
+    ''' removes the reciprocal-space interaction of excluded pairs:
+        E = -COULOMB qi qj erf(alpha r)/r
+
+        Returns
+            (energy of each pair, forces (N,3), virial (3,3) or None)
+    '''
+    from scipy.special import erf
+
+    d = minimumImage(xyz[j] - xyz[i], box)
+    r = np.sqrt(np.sum(d * d, axis=-1))
+    energy = -COULOMB * qq * erf(alpha * r) / r
+    # force on j divided by r
+    fr = (energy + COULOMB * qq * 2 * alpha / np.sqrt(np.pi) * np.exp(-(alpha * r) ** 2)) / r**2
+    fj = fr[:, np.newaxis] * d
+    forces = scatter(np.concatenate([i, j]), np.concatenate([-fj, fj]), len(xyz))
+    return energy, forces, (pairVirial(d, fj) if virial else None)
+
+
+#=============================================================================
+if __name__ == "__main__":  # tests
+    import time
+    from granules.analysis.energy import coulombPairs, finiteDifferenceForces
+    from granules.structure.neighbors import CellList
+
+    rng = np.random.default_rng(11)
+
+    def ewaldReference(xyz, charge, box, alpha, kmax):
+        ''' reciprocal energy and forces by direct summation over wave vectors.'''
+        n = np.arange(-kmax, kmax + 1)
+        m = np.array(np.meshgrid(n, n, n, indexing='ij')).reshape(3, -1).T
+        m = m[np.any(m != 0, axis=1)] / box
+        m2 = np.sum(m * m, axis=1)
+        keep = np.exp(-np.pi**2 * m2 / alpha**2) > 1e-16
+        m, m2 = m[keep], m2[keep]
+        arg = 2 * np.pi * xyz @ m.T
+        S = charge @ np.exp(1j * arg)
+        C = COULOMB * np.exp(-np.pi**2 * m2 / alpha**2) / (np.pi * np.prod(box) * m2)
+        energy = 0.5 * np.sum(C * np.abs(S)**2)
+        forces = -2 * np.pi * charge[:, None] * ((np.imag(np.exp(-1j * arg) * S) * C) @ m)
+        return energy, forces
+
+    # small neutral system: PME against direct Ewald sums and finite differences
+    box = np.array([20.0, 22.0, 24.0])
+    xyz = rng.uniform(0, 1, (60, 3)) * box
+    charge = rng.uniform(-1, 1, 60)
+    charge -= charge.mean()
+    alpha = ewaldAlpha(9.0)
+    reference = ewaldReference(xyz, charge, box, alpha, 20)
+    pme = PME(box, alpha, spacing=0.5, order=6)
+    energy, forces, W = pme.reciprocal(xyz, charge, virial=True)
+    print("reciprocal energy {:.6f}, Ewald sum {:.6f}".format(energy, reference[0]))
+    print("max |F - F(Ewald)| = {:.2e}".format(np.abs(forces - reference[1]).max()))
+    fd = finiteDifferenceForces(lambda x: pme.reciprocal(x, charge)[0], xyz)
+    print("max |F - F(finite differences)| = {:.2e}".format(np.abs(forces - fd).max()))
+
+    # virial: W_aa = -dE/d(ln L_a) with scaled coordinates
+    h = 1e-6
+    for a in range(3):
+        scale = np.ones(3)
+        scale[a] += h
+        e1 = PME(box * scale, alpha, order=6, grid=pme.grid).reciprocal(xyz * scale, charge)[0]
+        scale[a] -= 2 * h
+        e0 = PME(box * scale, alpha, order=6, grid=pme.grid).reciprocal(xyz * scale, charge)[0]
+        print("W[{0}{0}] = {1:.6f}, -dE/dln L = {2:.6f}".format(a, W[a, a], -(e1 - e0) / (2 * h)))
+
+    # time vs accuracy on a water-like box of 30000 charges
+    natoms = 30000
+    side = (natoms / 0.1) ** (1.0/3)
+    box = np.array([side] * 3)
+    xyz = rng.uniform(0, side, (natoms, 3))
+    charge = np.tile([-0.834, 0.417, 0.417], natoms // 3)
+    alpha = ewaldAlpha(10.0)
+    reference = PME(box, alpha, spacing=0.4, order=10).reciprocal(xyz, charge)
+    scale = np.sqrt(np.mean(reference[1] ** 2))
+    print("\n{} charges, {:.1f} A box, alpha = {:.3f}".format(natoms, side, alpha))
+    print("spacing order  grid          time (s)  rel. RMS force error  energy error")
+    for spacing in [1.5, 1.0, 0.75]:
+        for order in [4, 6, 8]:
+            start = time.time()
+            pme = PME(box, alpha, spacing, order)
+            energy, forces, _ = pme.reciprocal(xyz, charge)
+            elapsed = time.time() - start
+            print("{:7.2f} {:5d}  {:12s}  {:8.3f}  {:20.2e}  {:12.2e}".format(
+                  spacing, order, "x".join(str(k) for k in pme.grid), elapsed,
+                  np.sqrt(np.mean((forces - reference[1]) ** 2)) / scale, abs(energy - reference[0])))
+
+    # real-space part on the same system for comparison
+    start = time.time()
+    i, j, r = CellList(xyz, 10.0, box).pairs()
+    coulombPairs(r * r, charge[i] * charge[j], 'pme', 10.0, 10.0, alpha)
+    print("real space ({} pairs < 10 A): {:.3f} s".format(len(i), time.time() - start))
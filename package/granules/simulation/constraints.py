@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""-------------------------------------------------------------------------
+  constraints.py
+  Part of granules Version 0.1.0, October, 2019
+
+
+    Copyright 2019: José O.  Sotero Esteva, Lyxaira M. Glass Rivera,
+    Computational Science Group, Department of Mathematics,
+    University of Puerto Rico at Humacao
+    <jose.sotero@upr.edu>.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License version 3 as published by
+    the Free Software Foundation.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program (gpl.txt).  If not, see <http://www.gnu.org/licenses/>.
+
+    Acknowledgements: The main funding source for this project has been provided
+    by the UPR-Penn Partnership for Research and Education in Materials program,
+    USA National Science Foundation grant number DMR-0934195.
+"""
+
+import sys
+import numpy as np
+import pandas as pd
+
+SHAKE_MAX_ATOMS  = 4      # largest cluster accepted by LAMMPS fix shake
+HYDROGEN_MASS    = 3.5    # atoms lighter than this (g/mol) are hydrogens, also repartitioned ones
+
+
+def atomRows(atoms, ids):
+    ''' rows of 'atoms' (AtomsDF) of the atom IDs in 'ids' (any shape).'''
+    ids = np.asarray(ids)
+    return pd.Index(atoms.aID.values).get_indexer(ids.ravel()).reshape(ids.shape)
+
+
+def bondComponents(natoms, rows):
+    ''' connected component of every atom in the graph of the bonds given
+        by rows of atom indices (M,2).
+    '''
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    graph = coo_matrix((np.ones(len(rows)), (rows[:, 0], rows[:, 1])), shape=(natoms, natoms))
+    return connected_components(graph, directed=False)[1]
+
+
+def shakeTypes(lammpsdata, hydrogenMass=HYDROGEN_MASS, water=True):
+    ''' Bond types to constrain (every bond of the type has a hydrogen,
+        H-H bonds of rigid water models excluded) and, with 'water', angle
+        types to constrain (every angle of the type is H-X-H in a molecule
+        of 3 atoms).
+
+        returns (list of bond types, list of angle types)
+    '''
+    prop, top = lammpsdata.atomproperty, lammpsdata.topologia
+    atoms = prop.atoms
+    light = prop.atomMasses() < hydrogenMass
+
+    rows = atomRows(atoms, top.bonds[['Atom1', 'Atom2']].values)
+    withH = pd.Series(light[rows].any(axis=1)).groupby(top.bonds.bType.values)
+    mixed = withH.any() & ~withH.all()
+    if mixed.any():
+        sys.stderr.write("shakeTypes: bond types {} mix bonds with and without hydrogens, "
+                         "not constrained\n".format(list(mixed.index[mixed])))
+    bothH = pd.Series(light[rows].all(axis=1)).groupby(top.bonds.bType.values).all()
+    bondTypes = withH.all() & ~bothH
+    bondTypes = [int(t) for t in bondTypes.index[bondTypes.values]]
+
+    angleTypes = []
+    if water and len(top.angles):
+        component = bondComponents(len(atoms), rows)
+        size = np.bincount(component, minlength=len(atoms))
+        arows = atomRows(atoms, top.angles[['Atom1', 'Atom2', 'Atom3']].values)
+        isWater = light[arows[:, 0]] & light[arows[:, 2]] & ~light[arows[:, 1]] & \
+                  (size[component[arows[:, 1]]] == 3)
+        isWater = pd.Series(isWater).groupby(top.angles.anType.values).all()
+        angleTypes = [int(t) for t in isWater.index[isWater.values]]
+    return bondTypes, angleTypes
+
+
+def shakeClusters(lammpsdata, bondTypes, angleTypes=(), maxAtoms=SHAKE_MAX_ATOMS):
+    ''' Clusters that LAMMPS fix shake would build from the bonds of
+        'bondTypes' and the angles of 'angleTypes', checked against its
+        limits: each cluster is a central atom bonded to at most
+        maxAtoms - 1 others, clusters do not share atoms and angle
+        constraints only go on clusters of 3 atoms around their center.
+
+        returns DataFrame with one row per cluster: central atom ID,
+                number of atoms and whether its angle is constrained
+    '''
+    prop, top = lammpsdata.atomproperty, lammpsdata.topologia
+    atoms  = prop.atoms
+    natoms = len(atoms)
+    bonds  = top.bonds[top.bonds.bType.isin(bondTypes)]
+    rows   = atomRows(atoms, bonds[['Atom1', 'Atom2']].values)
+
+    component = bondComponents(natoms, rows)
+    involved  = np.zeros(natoms, dtype=bool)
+    involved[rows.ravel()] = True
+    degree = np.bincount(rows.ravel(), minlength=natoms)
+    size   = np.bincount(component[involved], minlength=natoms)
+    edges  = np.bincount(component[rows[:, 0]], minlength=natoms)
+
+    # central atom: the one with most constrained bonds in its cluster
+    order  = np.lexsort((-degree, component))
+    order  = order[involved[order]]
+    first  = np.r_[True, component[order][1:] != component[order][:-1]]
+    center = order[first]
+    label  = component[center]
+
+    bad = (size[label] > maxAtoms) | (edges[label] != size[label] - 1) | \
+          ((size[label] > 2) & (degree[center] != size[label] - 1))
+    if bad.any():
+        raise ValueError("SHAKE clusters around atoms {} are larger than {} atoms, connected or not "
+                         "star shaped".format(list(atoms.aID.values[center[bad]][:10]), maxAtoms))
+
+    withAngle = np.zeros(len(center), dtype=bool)
+    angles = top.angles[top.angles.anType.isin(angleTypes)]
+    if len(angles):
+        arows = atomRows(atoms, angles[['Atom1', 'Atom2', 'Atom3']].values)
+        where = np.searchsorted(label, component[arows[:, 1]])
+        ok = involved[arows[:, 1]] & (center[np.minimum(where, len(center) - 1)] == arows[:, 1]) & \
+             (size[component[arows[:, 1]]] == 3) & \
+             (component[arows[:, 0]] == component[arows[:, 1]]) & involved[arows[:, 0]] & \
+             (component[arows[:, 2]] == component[arows[:, 1]]) & involved[arows[:, 2]]
+        if not ok.all():
+            raise ValueError("SHAKE angles {} are not on clusters of 3 atoms around their central "
+                             "atom".format(list(angles.anID.values[~ok][:10])))
+        withAngle[where] = True
+
+    return pd.DataFrame({'center': atoms.aID.values[center], 'atoms': size[label], 'angle': withAngle})
+
+
+def fixShake(lammpsdata, fixId='shake', group='all', tolerance=1e-4, iterations=20, output=0,
+             hydrogenMass=HYDROGEN_MASS, water=True, validate=True):
+    ''' LAMMPS command that constrains the bonds to hydrogens and, with
+        'water', the angles of water molecules:
+            fix shake all shake 0.0001 20 0 b 2 4 a 7
+
+        Parameter
+        ----------
+        fixId, group : str
+            fix and group IDs
+
+        tolerance, iterations, output : fix shake parameters
+
+        hydrogenMass, water : as in shakeTypes
+
+        validate : bool
+            check the clusters against the LAMMPS limits (shakeClusters)
+
+        returns str
+    '''
+    bondTypes, angleTypes = shakeTypes(lammpsdata, hydrogenMass, water)
+    if not bondTypes:
+        raise ValueError("no bonds to hydrogen atoms to constrain")
+    if validate: shakeClusters(lammpsdata, bondTypes, angleTypes)
+
+    command = "fix {} {} shake {:g} {} {} b {}".format(fixId, group, tolerance, iterations, output,
+                                                      " ".join(str(t) for t in bondTypes))
+    if angleTypes: command += " a " + " ".join(str(t) for t in angleTypes)
+    return command
+
+
+#=============================================================================
+if __name__ == "__main__":  # tests
+    import os
+    from granules.structure.NAMDdata import NAMDdata
+    from granules.structure.LAMMPSdata import LammpsData
+
+    os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tests", "chignolin"))
+    l = LammpsData()
+    l.loadNAMDdata(NAMDdata("2rvd_autopsf.pdb", "2rvd_autopsf.psf", "par_all36_prot.prm"))
+    print(fixShake(l))
+    print(shakeClusters(l, *shakeTypes(l)).atoms.value_counts().sort_index())
+
+    # all bonds: clusters grow beyond what fix shake accepts
+    try:
+        shakeClusters(l, l.topologia.bonds.bType.unique())
+    except ValueError as e:
+        print("expected error:", str(e)[:90], "...")
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""-------------------------------------------------------------------------
+  dynamics.py
+  Part of granules Version 0.1.0, October, 2019
+
+
+    Copyright 2019: José O.  Sotero Esteva, Lyxaira M. Glass Rivera,
+    Computational Science Group, Department of Mathematics,
+    University of Puerto Rico at Humacao
+    <jose.sotero@upr.edu>.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License version 3 as published by
+    the Free Software Foundation.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program (gpl.txt).  If not, see <http://www.gnu.org/licenses/>.
+
+    Acknowledgements: The main funding source for this project has been provided
+    by the UPR-Penn Partnership for Research and Education in Materials program,
+    USA National Science Foundation grant number DMR-0934195.
+"""
+
+import time
+import numpy as np
+import pandas as pd
+
+from granules.analysis.energy import MVV2E, BOLTZMANN
+
+THERMOSTATS = [None, 'langevin', 'nose-hoover']
+
+
+def writeDumpFrame(stream, step, ids, types, xyz, maxsMins=None):
+    ''' Writes one frame of a LAMMPS dump ('atom id type x y z'), readable
+        by AtomsDF.updateCoordinates and Box.loadFromDump.
+
+        Parameter
+        ----------
+        stream : open text stream (granules.structure.streams.openStream)
+
+        step : int
+            time step of the frame
+
+        ids, types : int arrays (N)
+            atom IDs and types
+
+        xyz : array (N,3)
+            coordinates
+
+        maxsMins : list or None
+            [xlo, xhi, ylo, yhi, zlo, zhi] of a periodic box; None writes
+            the bounds of the coordinates as non-periodic
+    '''
+    if maxsMins is None:
+        bounds, flags = np.column_stack([xyz.min(axis=0), xyz.max(axis=0)]), "ff ff ff"
+    else:
+        bounds, flags = np.reshape(maxsMins, (3, 2)), "pp pp pp"
+    stream.write("ITEM: TIMESTEP\n{}\nITEM: NUMBER OF ATOMS\n{}\nITEM: BOX BOUNDS {}\n".format(
+                 step, len(xyz), flags))
+    stream.write("".join("{:.6f} {:.6f}\n".format(lo, hi) for lo, hi in bounds))
+    stream.write("ITEM: ATOMS id type x y z\n")
+    table = pd.DataFrame({'id': ids, 'type': types, 'x': xyz[:, 0], 'y': xyz[:, 1], 'z': xyz[:, 2]})
+    table.to_csv(stream, sep=' ', header=False, index=False, float_format='%.6f')
+
+
+class VelocityVerlet:
+    ''' Velocity Verlet integrator in LAMMPS 'real' units (A, fs, g/mol,
+        kcal/mol) with an optional thermostat:
+            'langevin'     half a friction/noise step before and after each
+                           velocity Verlet step (OBABO splitting)
+            'nose-hoover'  one Nose-Hoover thermostat variable, integrated
+                           in half steps around each velocity Verlet step
+
+        Parameters
+        ----------
+        forces : function
+            forces(xyz) -> (dict of energies, forces (N,3), virial), e.g.
+            granules.simulation.forces.VerletForces
+
+        xyz, velocities : arrays (N,3)
+            starting coordinates (A) and velocities (A/fs), copied
+
+        masses : array (N)
+            g/mol
+
+        dt : float
+            time step, fs
+
+        thermostat : None, 'langevin' or 'nose-hoover'
+
+        temperature : float
+            target temperature, K
+
+        damping : float
+            relaxation time of the thermostat, fs
+
+        seed : int or None
+            seed of the random numbers of the Langevin thermostat
+    '''
+
+    def __init__(self, forces, xyz, velocities, masses, dt=1.0, thermostat=None,
+                 temperature=300.0, damping=100.0, seed=None):
+        if thermostat not in THERMOSTATS:
+            raise ValueError("unknown thermostat '{}', use one of {}".format(thermostat, THERMOSTATS))
+        self.forces      = forces
+        self.xyz         = np.array(xyz, dtype=float).reshape(-1, 3)
+        self.velocities  = np.array(velocities, dtype=float).reshape(-1, 3)
+        self.masses      = np.asarray(masses, dtype=float)
+        self.dt          = float(dt)
+        self.thermostat  = thermostat
+        self.temperature = float(temperature)
+        self.damping     = float(damping)
+        self.rng         = np.random.default_rng(seed)
+        self.step        = 0
+
+        self.invMass = 1.0 / (MVV2E * self.masses[:, np.newaxis])   # (kcal/mol/A) / (g/mol) -> A/fs^2
+        self.dof     = max(3 * len(self.xyz) - 3, 1)
+        self.xi      = 0.0                                           # Nose-Hoover friction, 1/fs
+        self.Q       = self.dof * BOLTZMANN * self.temperature * self.damping ** 2
+        self._evaluate()
+
+    def _evaluate(self):
+        energies, self.f, _ = self.forces(self.xyz)
+        self.potential = sum(energies.values())
+
+    def kineticEnergy(self):
+        ''' kinetic energy, kcal/mol.'''
+        return 0.5 * MVV2E * np.sum(self.masses[:, np.newaxis] * self.velocities ** 2)
+
+    def currentTemperature(self):
+        ''' instantaneous temperature, K, with 3N - 3 degrees of freedom.'''
+        return 2 * self.kineticEnergy() / (self.dof * BOLTZMANN)
+
+    def _langevin(self, dt):
+        c = np.exp(-dt / self.damping)
+        sigma = np.sqrt((1 - c * c) * BOLTZMANN * self.temperature * self.invMass)
+        self.velocities = c * self.velocities + sigma * self.rng.standard_normal(self.velocities.shape)
+
+    def _noseHoover(self, dt):
+        target = self.dof * BOLTZMANN * self.temperature
+        self.xi += 0.5 * dt * (2 * self.kineticEnergy() - target) / self.Q
+        self.velocities *= np.exp(-self.xi * dt)
+        self.xi += 0.5 * dt * (2 * self.kineticEnergy() - target) / self.Q
+
+    def _thermostat(self, dt):
+        if self.thermostat == 'langevin':      self._langevin(dt)
+        elif self.thermostat == 'nose-hoover': self._noseHoover(dt)
+
+    def advance(self, steps=1):
+        ''' integrates 'steps' time steps.'''
+        dt = self.dt
+        for _ in range(steps):
+            self._thermostat(0.5 * dt)
+            self.velocities += 0.5 * dt * self.f * self.invMass
+            self.xyz += dt * self.velocities
+            self._evaluate()
+            self.velocities += 0.5 * dt * self.f * self.invMass
+            self._thermostat(0.5 * dt)
+            self.step += 1
+
+    def thermo(self):
+        ''' dict with step, temperature and potential, kinetic and total energies.'''
+        kinetic = self.kineticEnergy()
+        return {'step': self.step, 'temperature': self.currentTemperature(), 'potential': self.potential,
+                'kinetic': kinetic, 'total': self.potential + kinetic}
+
+
+def runDynamics(lammpsdata, steps, dt=1.0, thermostat='langevin', temperature=300.0, damping=100.0,
+                seed=None, trajectory=None, every=100, thermo=100, terms=None, skin=2.0,
+                inner=8.0, outer=10.0, electrostatics='charmm', alpha=0.2, epsilonRF=np.inf, pme=None):
+    ''' Runs molecular dynamics of a LammpsData object with the CHARMM force
+        field and stores the final coordinates and velocities in its atoms
+        and velocities tables.
+
+        Parameter
+        ----------
+        lammpsdata : LammpsData
+            coordinates from atomproperty.atoms, velocities (A/fs) from
+            atomproperty.velocities, masses from atomproperty.masses
+
+        steps : int
+            number of time steps
+
+        dt, thermostat, temperature, damping, seed : as in VelocityVerlet
+
+        trajectory : str, stream or None
+            LAMMPS dump written every 'every' steps through
+            granules.structure.streams.openStream (may be compressed)
+
+        every, thermo : int
+            steps between trajectory frames and between rows of the log
+
+        terms, skin, inner, outer, electrostatics, alpha, epsilonRF, pme :
+            as in granules.simulation.minimize.minimize
+
+        returns (DataFrame with one row every 'thermo' steps, ns/day)
+    '''
+    from granules.simulation.forces import VerletForces
+    from granules.structure.streams import openStream
+
+    prop  = lammpsdata.atomproperty
+    atoms = prop.atoms
+    if terms is None: terms = lammpsdata.forceField.charmmTerms(prop, lammpsdata.topologia)
+    forces = VerletForces(terms, lammpsdata.region.lengths(), skin, inner, outer,
+                          electrostatics, alpha, epsilonRF, pme)
+    md = VelocityVerlet(forces, atoms[['x', 'y', 'z']].values.astype(float), prop.atomVelocities(),
+                        prop.atomMasses(), dt, thermostat, temperature, damping, seed)
+
+    out = None if trajectory is None else openStream(trajectory, 'w')
+    ids, types = atoms.aID.values, atoms.aType.values
+    log = [md.thermo()]
+    start = time.time()
+    try:
+        if out: writeDumpFrame(out, 0, ids, types, md.xyz, lammpsdata.region.maxsMins)
+        while md.step < steps:
+            md.advance(1)
+            if out and md.step % every == 0:
+                writeDumpFrame(out, md.step, ids, types, md.xyz, lammpsdata.region.maxsMins)
+            if md.step % thermo == 0: log.append(md.thermo())
+    finally:
+        if out: out.close()
+    elapsed = time.time() - start
+
+    atoms[['x', 'y', 'z']] = md.xyz
+    prop.velocities.setToZero(atoms)
+    prop.velocities[['Vx', 'Vy', 'Vz']] = md.velocities
+    nsPerDay = steps * dt * 1e-6 / max(elapsed, 1e-12) * 86400
+    return pd.DataFrame(log).set_index('step'), nsPerDay
+
+
+#=============================================================================
+if __name__ == "__main__":  # tests
+    import os
+    from granules.structure.NAMDdata import NAMDdata
+    from granules.structure.LAMMPSdata import LammpsData
+
+    os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tests", "chignolin"))
+    ch = NAMDdata("2rvd_autopsf.pdb", "2rvd_autopsf.psf", "par_all36_prot.prm")
+    l = LammpsData()
+    l.loadNAMDdata(ch)
+    l.minimize('lbfgs', maxSteps=500)
+    l.atomproperty.velocities.setMaxwellBoltzmann(l.atomproperty.atoms, l.atomproperty.masses, 300.0, seed=1)
+
+    for thermostat in ['langevin', 'nose-hoover', None]:
+        log, nsPerDay = runDynamics(l, 1000, dt=1.0, thermostat=thermostat, seed=1,
+                                    trajectory="chignolin.dump.gz", thermo=250)
+        print("{}: {:.3f} ns/day for chignolin ({} atoms)".format(thermostat, nsPerDay, len(l.atomproperty.atoms)))
+        print(log.round(3))
+    os.remove("chignolin.dump.gz")
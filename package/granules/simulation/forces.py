@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""-------------------------------------------------------------------------
+  forces.py
+  Part of granules Version 0.1.0, October, 2019
+
+
+    Copyright 2019: José O.  Sotero Esteva, Lyxaira M. Glass Rivera,
+    Computational Science Group, Department of Mathematics,
+    University of Puerto Rico at Humacao
+    <jose.sotero@upr.edu>.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License version 3 as published by
+    the Free Software Foundation.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program (gpl.txt).  If not, see <http://www.gnu.org/licenses/>.
+
+    Acknowledgements: The main funding source for this project has been provided
+    by the UPR-Penn Partnership for Research and Education in Materials program,
+    USA National Science Foundation grant number DMR-0934195.
+"""
+
+import numpy as np
+
+from granules.analysis.energy import (SWITCH_INNER, SWITCH_OUTER, DSF_ALPHA,
+                                      charmmEvaluate, minimumImage)
+
+
+class VerletForces:
+    ''' CHARMM energies and forces of a system whose atoms move a little
+        between calls. Non-bonded pairs are searched within outer + skin
+        (a Verlet list) and reused until some atom has moved more than half
+        the skin since the search.
+
+        Parameters
+        ----------
+        terms : granules.analysis.energy.CharmmTerms
+
+        box : array of 3 floats or None
+            periodic cell lengths
+
+        skin : float
+            extra distance of the pair list, in A
+
+        inner, outer, electrostatics, alpha, epsilonRF, pme :
+            as in granules.analysis.energy.charmmEvaluate. With 'pme' the
+            grid is built once for the box.
+
+        Attributes
+        ----------
+        builds, calls : int
+            pair searches and evaluations done so far
+    '''
+
+    def __init__(self, terms, box=None, skin=2.0, inner=SWITCH_INNER, outer=SWITCH_OUTER,
+                 electrostatics='charmm', alpha=DSF_ALPHA, epsilonRF=np.inf, pme=None):
+        self.terms = terms
+        self.box   = None if box is None else np.asarray(box, dtype=float)
+        self.skin  = float(skin)
+        if electrostatics == 'pme' and pme is None:
+            from granules.analysis.pme import PME, ewaldAlpha
+
+            if self.box is None: raise ValueError("particle-mesh Ewald needs a periodic box")
+            pme = PME(self.box, ewaldAlpha(outer))
+        self.params = dict(inner=inner, outer=outer, electrostatics=electrostatics,
+                           alpha=alpha, epsilonRF=epsilonRF, pme=pme)
+
+        self.reference = None
+        self.builds    = 0
+        self.calls     = 0
+
+    def pairs(self, xyz):
+        ''' non-bonded pairs (i, j) for coordinates 'xyz', searched again
+            only when the current list could miss a pair within outer.
+        '''
+        if self.reference is not None:
+            moved = np.sum(minimumImage(xyz - self.reference, self.box) ** 2, axis=1).max(initial=0.0)
+            if 4 * moved <= self.skin * self.skin: return self.list
+        self.list      = self.terms.nonBondedPairs(xyz, self.params['outer'] + self.skin, self.box)
+        self.reference = np.array(xyz, dtype=float)
+        self.builds   += 1
+        return self.list
+
+    def __call__(self, xyz, virial=False):
+        ''' (dict of energies, forces (N,3), virial (3,3) or None) at 'xyz'.'''
+        xyz = np.asarray(xyz, dtype=float).reshape(-1, 3)
+        self.calls += 1
+        return charmmEvaluate(self.terms, xyz, self.box, virial, self.pairs(xyz), **self.params)
+
+    def energy(self, xyz):
+        ''' total energy and forces (N,3) at 'xyz'.'''
+        energies, forces, _ = self(xyz)
+        return sum(energies.values()), forces
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""-------------------------------------------------------------------------
+  minimize.py
+  Part of granules Version 0.1.0, October, 2019
+
+
+    Copyright 2019: José O.  Sotero Esteva, Lyxaira M. Glass Rivera,
+    Computational Science Group, Department of Mathematics,
+    University of Puerto Rico at Humacao
+    <jose.sotero@upr.edu>.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License version 3 as published by
+    the Free Software Foundation.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program (gpl.txt).  If not, see <http://www.gnu.org/licenses/>.
+
+    Acknowledgements: The main funding source for this project has been provided
+    by the UPR-Penn Partnership for Research and Education in Materials program,
+    USA National Science Foundation grant number DMR-0934195.
+"""
+
+import numpy as np
+
+METHODS = ['fire', 'lbfgs']
+
+
+def _converged(e, eOld, forces, etol, ftol):
+    ''' LAMMPS minimize criteria: relative energy change below etol or
+        largest force below ftol.
+    '''
+    if np.sqrt(np.sum(forces * forces, axis=1).max(initial=0.0)) < ftol: return True
+    return eOld is not None and abs(e - eOld) < etol * 0.5 * (abs(e) + abs(eOld) + 1e-12)
+
+
+def fire(energy, xyz, maxSteps=1000, etol=1e-8, ftol=0.1, masses=None, dtStart=1.0, dtMax=10.0,
+         maxMove=0.1, nMin=5, fInc=1.1, fDec=0.5, alphaStart=0.1, fAlpha=0.99):
+    ''' Minimizes with FIRE (Bitzek et al., Phys. Rev. Lett. 97, 170201 (2006))
+        with steps of at most 'maxMove' A per atom, which keeps strong
+        clashes from blowing the structure apart.
+
+        Parameter
+        ----------
+        energy : function
+            energy(xyz) -> (total energy, forces (N,3))
+
+        xyz : array (N,3)
+            starting coordinates
+
+        maxSteps : int
+            maximum number of steps
+
+        etol, ftol : float
+            stop when the relative energy change is below etol after more
+            than nMin downhill steps or when the largest force is below
+            ftol (kcal/mol/A)
+
+        masses : array (N) or None
+            atom masses in g/mol (default: 1); time steps are in fs
+
+        other parameters are those of the FIRE algorithm
+
+        returns (coordinates, energy, steps, converged)
+    '''
+    from granules.analysis.energy import MVV2E
+
+    x = np.array(xyz, dtype=float).reshape(-1, 3)
+    v = np.zeros_like(x)
+    masses = np.ones(len(x)) if masses is None else np.asarray(masses, dtype=float)
+    invMass = 1.0 / (MVV2E * masses[:, np.newaxis])
+    dt, alpha, downhill = dtStart, alphaStart, 0
+    e, f = energy(x)
+    eOld = None
+    for step in range(maxSteps):
+        if _converged(e, eOld, f, etol, ftol): return x, e, step, True
+
+        power = np.sum(f * v)
+        if power > 0:
+            fnorm = np.sqrt(np.sum(f * f))
+            v = (1 - alpha) * v + alpha * np.sqrt(np.sum(v * v)) * f / fnorm
+            downhill += 1
+            if downhill > nMin:
+                dt = min(dt * fInc, dtMax)
+                alpha *= fAlpha
+        else:
+            v[:] = 0.0
+            dt *= fDec
+            alpha, downhill = alphaStart, 0
+
+        v += dt * f * invMass
+        dx = dt * v
+        longest = np.sqrt(np.sum(dx * dx, axis=1).max(initial=0.0))
+        if longest > maxMove: dx *= maxMove / longest
+        x += dx
+
+        eNew, f = energy(x)
+        eOld = e if downhill > nMin else None
+        e = eNew
+    return x, e, maxSteps, _converged(e, eOld, f, etol, ftol)
+
+
+def lbfgs(energy, xyz, maxSteps=1000, etol=1e-8, ftol=0.1, memory=10):
+    ''' Minimizes with L-BFGS (scipy.optimize.minimize, method 'L-BFGS-B').
+
+        Parameter
+        ----------
+        energy : function
+            energy(xyz) -> (total energy, forces (N,3))
+
+        xyz : array (N,3)
+            starting coordinates
+
+        maxSteps : int
+            maximum number of iterations
+
+        etol, ftol : float
+            relative energy change and largest force (kcal/mol/A) to stop at
+
+        memory : int
+            number of corrections kept
+
+        returns (coordinates, energy, steps, converged)
+    '''
+    from scipy.optimize import minimize
+
+    shape = np.shape(xyz)
+
+    def fun(flat):
+        e, f = energy(flat.reshape(shape))
+        return e, -f.ravel()
+
+    # scipy's pgtol is the largest gradient component, a bit stricter than ftol
+    result = minimize(fun, np.asarray(xyz, dtype=float).ravel(), jac=True, method='L-BFGS-B',
+                      options=dict(maxiter=maxSteps, maxcor=memory, ftol=etol,
+                                   gtol=ftol / np.sqrt(3), maxfun=2 * maxSteps))
+    return result.x.reshape(shape), float(result.fun), int(result.nit), bool(result.success)
+
+
+def minimize(lammpsdata, method='fire', maxSteps=1000, etol=1e-8, ftol=0.1, terms=None, skin=2.0,
+             inner=8.0, outer=10.0, electrostatics='charmm', alpha=0.2, epsilonRF=np.inf, pme=None,
+             **options):
+    ''' Minimizes the CHARMM energy of a LammpsData object and stores the
+        relaxed coordinates in its atoms table. Non-bonded pairs are kept in
+        a Verlet list (VerletForces) searched again only when needed.
+
+        Parameter
+        ----------
+        lammpsdata : LammpsData
+
+        method : str
+            'fire' or 'lbfgs'
+
+        maxSteps, etol, ftol : as in fire and lbfgs
+
+        terms : CharmmTerms or None
+            terms gathered by ForceFieldData.charmmTerms
+
+        skin : float
+            extra distance of the pair list (A)
+
+        inner, outer, electrostatics, alpha, epsilonRF, pme :
+            as in ForceFieldData.charmmEvaluate
+
+        options : extra parameters of fire or lbfgs
+
+        returns dict with the final energy, the largest force, number of
+        steps, energy evaluations and pair searches, and convergence
+    '''
+    from granules.simulation.forces import VerletForces
+
+    if method not in METHODS:
+        raise ValueError("unknown minimization method '{}', use one of {}".format(method, METHODS))
+    atoms = lammpsdata.atomproperty.atoms
+    if terms is None: terms = lammpsdata.forceField.charmmTerms(lammpsdata.atomproperty, lammpsdata.topologia)
+    forces = VerletForces(terms, lammpsdata.region.lengths(), skin, inner, outer,
+                          electrostatics, alpha, epsilonRF, pme)
+
+    xyz = atoms[['x', 'y', 'z']].values.astype(float)
+    if method == 'fire': options.setdefault('masses', lammpsdata.atomproperty.atomMasses())
+    run = fire if method == 'fire' else lbfgs
+    xyz, e, steps, converged = run(forces.energy, xyz, maxSteps, etol, ftol, **options)
+    atoms[['x', 'y', 'z']] = xyz
+
+    f = forces.energy(xyz)[1]
+    return {'energy': e, 'maxForce': np.sqrt(np.sum(f * f, axis=1).max(initial=0.0)),
+            'steps': steps, 'evaluations': forces.calls - 1, 'builds': forces.builds,
+            'converged': converged}
+
+
+#=============================================================================
+if __name__ == "__main__":  # tests
+    import os, time
+    from granules.structure.NAMDdata import NAMDdata
+    from granules.structure.LAMMPSdata import LammpsData
+
+    os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tests", "chignolin"))
+    ch = NAMDdata("2rvd_autopsf.pdb", "2rvd_autopsf.psf", "par_all36_prot.prm")
+    for method in METHODS:
+        l = LammpsData()
+        l.loadNAMDdata(ch)
+        # a clash: two atoms of different residues on top of each other
+        l.atomproperty.atoms.loc[10, ['x', 'y', 'z']] = l.atomproperty.atoms.loc[100, ['x', 'y', 'z']].values + 0.3
+        e0 = l.charmmEvaluate()[0].sum()
+        t = time.time()
+        result = minimize(l, method, maxSteps=2000, ftol=1.0)
+        print("{:6s}: E {:12.2f} -> {:9.2f} kcal/mol, max |F| {:6.3f}, {:4d} steps, "
+              "{:4d} evaluations, {:3d} pair searches, converged {}, {:5.2f} s".format(
+              method, e0, result['energy'], result['maxForce'], result['steps'],
+              result['evaluations'], result['builds'], result['converged'], time.time() - t))
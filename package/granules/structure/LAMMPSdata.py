@@ -32,7 +32,6 @@
 
 import pandas as pd
 import numpy as np
-import random
 
 try:
     import networkx as nx
@@ -79,6 +78,98 @@ def detectAtomTypes(charmm):
     types           .set_index('Type', inplace=True)
     return types.to_dict()['ID']
 
+
+def typeCodes(charmm):
+    ''' numbers the CHARMM atom types of charm.psf.atoms in order of first
+        appearance (the same numbering as detectAtomTypes, starting at 0).
+
+    Parameter
+    -------------
+    charmm : NAMDdata
+        a NAMDdata object
+
+    Returns:
+        (array with the type code of each atom indexed by atom ID,
+         array of type names indexed by code)
+    '''
+    psf = charmm.psf.atoms
+    codes, names = pd.factorize(psf['Type'])
+    byID = np.full(int(psf['ID'].max()) + 1 if len(psf) else 1, -1, dtype=codes.dtype)
+    byID[psf['ID'].values.astype(int)] = codes
+    return byID, np.asarray(names)
+
+
+def termTemplates(charmm, terms, columns):
+    ''' Groups molecular topology terms (bonds, angles, ...) by the tuple of
+        CHARMM types of their atoms. The template of a term determines its
+        LAMMPS type and its coefficients, so those are resolved once per
+        template and broadcast to the terms with array indexing.
+
+    Parameter
+    -------------
+    charmm : NAMDdata
+        a NAMDdata object
+
+    terms : DataFrame
+        table with atom IDs in 'columns'
+
+    columns : list of str
+        atom ID columns of 'terms'
+
+    Returns:
+        (template number of each term, starting at 1 in order of first
+         appearance, list with the type tuple of each template)
+    '''
+    byID, names = typeCodes(charmm)
+    codes = pd.DataFrame({c:byID[terms[c].values.astype(int)] for c in columns})
+    if len(codes) == 0:
+        return np.zeros(0, dtype=int), []
+    template = codes.groupby(columns, sort=False).ngroup().values + 1
+    tuples   = [tuple(names[list(row)]) for row in codes.drop_duplicates().values]
+    return template, tuples
+
+
+def typeTuples(charmm, terms, columns):
+    ''' Returns the tuple of CHARMM types of the atoms of each row of 'terms'.
+
+    Parameter
+    -------------
+    charmm : NAMDdata
+        a NAMDdata object
+
+    terms : DataFrame
+        table with atom IDs in 'columns'
+
+    columns : list of str
+        atom ID columns of 'terms'
+    '''
+    byID, names = typeCodes(charmm)
+    return list(zip(*(names[byID[terms[c].values.astype(int)]] for c in columns)))
+
+
+def atomRows(atoms, terms, columns):
+    ''' Returns the rows of 'atoms' (0-based) of the atoms of each term.
+
+    Parameter
+    -------------
+    atoms : AtomsDF
+        atoms table
+
+    terms : DataFrame
+        table with atom IDs in 'columns'
+
+    columns : list of str
+        atom ID columns of 'terms'
+
+    Returns:
+        int array (len(terms), len(columns))
+    '''
+    ids = atoms['aID'].values.astype(int)
+    byID = np.full(ids.max() + 1 if len(ids) else 1, -1, dtype=int)
+    byID[ids] = np.arange(len(ids))
+    return np.column_stack([byID[terms[c].values.astype(int)] for c in columns]) if len(terms) \
+           else np.zeros((0, len(columns)), dtype=int)
+
 #Clase para generar el archivo de configuracion para simulaciones en Lammps
 class InFileGenerator():
     '''Write the default configuration for a .in file'''
@@ -184,6 +275,18 @@ class AtomPropertyData():
         coordMass = coordMass[['x','y','z']]
 
         return coordMass.mean()
+
+    def atomMasses(self):
+        '''Regresa la masa de cada atomo (array), en el orden de self.atoms.'''
+        mass = self.masses.set_index('aType')['Mass']
+        return mass.loc[self.atoms.aType.values].values.astype(float)
+
+    def atomVelocities(self):
+        '''Regresa las velocidades (N,3) en el orden de self.atoms; cero
+            para atomos sin velocidad.'''
+        if len(self.velocities) == 0: return np.zeros((len(self.atoms), 3))
+        vel = self.velocities.set_index('vID')[['Vx', 'Vy', 'Vz']]
+        return vel.reindex(self.atoms.aID.values).fillna(0.0).values.astype(float)
     
    
   
@@ -236,417 +339,357 @@ class ForceFieldData():
         self.dihedralCoeffs.setFromNAMD(charmm, topology.dihedrals)
         self.improperCoeffs.setFromNAMD(charmm, topology.impropers)
         
-     def charmmNonBondEnergy(self,atompropertydata,topologia):
-        ''' Computes CHARMM Lennard-Jones energy.
-            Formula: Eps,i,j[(Rmin,i,j/ri,j)**12 - 2(Rmin,i,j/ri,j)**6]
-                    Eps,i,j = sqrt(eps,i * eps,j)
-                    Rmin,i,j = Rmin/2,i + Rmin/2,j
-
-            Computes CHARMM Coulumb energy.
-            Formula: qi qj/rij / epsilon_0
-
-            returns (L-J, Coulomb)
+     def charmmTerms(self,atompropertydata,topologia):
+        ''' Gathers the atom indices and CHARMM parameters of all the terms
+            into arrays (granules.analysis.energy.CharmmTerms). The result can
+            be passed to charmmEvaluate() to skip this step in repeated evaluations.
         '''
-        from scipy.constants import epsilon_0, physical_constants
-
-        NONB_CUTOFF = 13.0
-
-        print("ForceFieldData.charmmNonBondEnergy")
-        
-        # generate all pairs of atoms IDs
-        atoms = atompropertydata.atoms.copy() #Cambio
-        atomIds = atoms[['aID']]
-        print("ForceFieldData.charmmNonBondEnergy atomIds.columns=", atomIds.columns)
-        atomIds = atomIds.assign(key=np.ones(len(atomIds)))
-        #atomIds['key'] = np.ones(len(atomIds))
-        #print("ForceFieldData.charmmNonBondEnergy atomIds.columns=", atomIds.columns)
-        atomIds = pd.merge(atomIds, atomIds, on='key')[['aID_x', 'aID_y']]
-        atomIds = atomIds[atomIds['aID_x'] < atomIds['aID_y']]
-
-        atomIds['nbID'] = np.arange(len(atomIds))
-
-        # compute pairwise distances
-        print("ForceFieldData.charmmNonBondEnergy len(atomIds) =", len(atomIds))
-        from scipy.spatial.distance import pdist
-        atomIds['rij'] = pdist(atoms.set_index('aID')[['x', 'y', 'z']].values)
-        atomIds = atomIds[atomIds['rij'] < NONB_CUTOFF]
-
-        # remove bonded atoms
-        atomIds['p'] = list(zip(atomIds.aID_x, atomIds.aID_y))
-        bonds = topologia.bonds.copy()
-        bonds['p'] = list(zip(bonds.Atom1, bonds.Atom2))
-        atomIds = atomIds.set_index('p').join(bonds.set_index('p'))
-        atomIds = atomIds[atomIds.bID.isna()][['aID_x','aID_y','nbID','rij']].reset_index(drop=True)
-        del bonds
-
-        # remove angled atoms
-        atomIds['p'] = list(zip(atomIds.aID_x, atomIds.aID_y))
-        angles = topologia.angles.copy()
-        angles['p'] = list(zip(angles.Atom1, angles.Atom3))
-        atomIds = atomIds.set_index('p').join(angles.set_index('p'))
-        atomIds = atomIds[atomIds.anID.isna()][['aID_x','aID_y','nbID','rij']].reset_index(drop=True)
-        del angles
-
-        # get atom types and charges
-        atomIds = atomIds.set_index('aID_x').join(atompropertydata.atoms[['aID', 'Q']].set_index('aID'))
-        atomIds.rename(columns={'Q':'qi'}, inplace=True)
-        atomIds = atomIds.join(atompropertydata.atoms[['aID', 'aType']].set_index('aID')).reset_index(drop=True)
-        atomIds.rename(columns={'aType':'aiType'}, inplace=True)
-        atomIds = atomIds.set_index('aID_y').join(atompropertydata.atoms[['aID', 'Q']].set_index('aID'))
-        atomIds = atomIds.join(atompropertydata.atoms[['aID', 'aType']].set_index('aID')).reset_index(drop=True)
-        atomIds.rename(columns={'aType':'ajType', 'Q':'qj'}, inplace=True)
-        print("ForceFieldData.charmmNonBondEnergy len(atomIds (clean)) =", len(atomIds))
-
-        # get epsilons and sigmas for each atom type
-        atomIds = atomIds.set_index('aiType').join(
-                        self.pairCoeffs.set_index('aType')
-                 ).reset_index(drop=True)
-        atomIds.drop(columns=['epsilon1_4', 'sigma1_4'], inplace=True)
-        atomIds.rename(columns={'epsilon':'epsilon_i', 'sigma':'sigma_i'}, inplace=True)
-        atomIds = atomIds.set_index('ajType').join(
-                        self.pairCoeffs.set_index('aType')
-                 ).reset_index(drop=True).drop(columns=['epsilon1_4', 'sigma1_4'])
-        atomIds.rename(columns={'epsilon':'epsilon_j', 'sigma':'sigma_j'}, inplace=True)
-
-        # compute epsilon and sigma
-        atomIds['epsilon'] = np.sqrt(atomIds.epsilon_i * atomIds.epsilon_j)
-        atomIds['sigma'] = atomIds.sigma_i + atomIds.sigma_j
-        atomIds.drop(columns=['epsilon_i', 'epsilon_j', 'sigma_i', 'sigma_j'], inplace=True)
-
-
-        atomIds.set_index('nbID', inplace=True)
-        print("ForceFieldData.charmmNonBondEnergy END")
-        #print(atomIds)
-        # return LJ and Coulomb
-        COULOMB = 332.0636
-
-        '''
-        return -np.sum(atomIds.epsilon * (atomIds.rij**12 - atomIds.rij**6)), \
-               np.sum((physical_constants['electric constant'][0] * atomIds.qi * atomIds.qj) / (atomIds.rij * epsilon_0))
-        '''
-        return -np.sum(atomIds.epsilon * ((atomIds.sigma/atomIds.rij)**12 - (atomIds.sigma/atomIds.rij)**6)), \
-               COULOMB * np.sum((atomIds.qi * atomIds.qj) / (atomIds.rij))
-
-     def charmmBondEnergy(self,atompropertydata,topologia):
-        ''' Computes CHARMM bond energy.
-
-            Formula: sum K * (bij - b0)**2
+        from granules.analysis.energy import CharmmTerms
+
+        atoms = atompropertydata.atoms
+        bonds, angles = topologia.bonds, topologia.angles
+        dihedrals, impropers = topologia.dihedrals, topologia.impropers
+
+        def coeffs(table, typeColumn, terms, termType, columns):
+            table = table.set_index(table[typeColumn].astype(int))
+            return table.loc[terms[termType].values.astype(int), columns].values.astype(float).T
+
+        pair = coeffs(self.pairCoeffs.drop_duplicates(subset='aType'), 'aType', atoms, 'aType',
+                      ['epsilon', 'sigma', 'epsilon1_4', 'sigma1_4'])
+        bondK, bondR0 = coeffs(self.bondCoeffs, 'bType', bonds, 'bType',
+                               ['Spring_Constant', 'Eq_Length'])
+        angleK, angleTheta0, angleKub, angleS0 = coeffs(self.angleCoeffs, 'anType', angles, 'anType',
+                                                       ['Ktheta', 'Theta0', 'Kub', 'S0'])
+        dihedralK, dihedralN, dihedralDelta = coeffs(self.dihedralCoeffs, 'dType', dihedrals, 'dType',
+                                                     ['Kchi', 'n', 'delta'])
+        improperK, improperPsi0 = coeffs(self.improperCoeffs, 'iType', impropers, 'iType',
+                                         ['Kpsi', 'psi0'])
+
+        return CharmmTerms(len(atoms), atoms.Q.values.astype(float), pair[0], pair[1],
+                           atomRows(atoms, bonds, ['Atom1', 'Atom2']), bondK, bondR0,
+                           atomRows(atoms, angles, ['Atom1', 'Atom2', 'Atom3']),
+                           angleK, angleTheta0, angleKub, angleS0,
+                           atomRows(atoms, dihedrals, ['Atom1', 'Atom2', 'Atom3', 'Atom4']),
+                           dihedralK, dihedralN, dihedralDelta,
+                           atomRows(atoms, impropers, ['Atom1', 'Atom2', 'Atom3', 'Atom4']),
+                           improperK, improperPsi0, pair[2], pair[3])
+
+     def charmmEvaluate(self,atompropertydata,topologia,box=None,virial=False,terms=None,
+                        inner=8.0,outer=10.0,electrostatics='charmm',alpha=0.2,epsilonRF=np.inf,
+                        pme=None):
+        ''' Computes CHARMM energies, forces and, optionally, the virial in
+            one pass over each kind of term (granules.analysis.energy.charmmEvaluate).
+
+            Parameter
+            ----------
+            atompropertydata : AtomPropertyData
+                atoms with coordinates, types and charges
+
+            topologia : MolecularTopologyData
+                bonds, angles, dihedrals and impropers
+
+            box : array of 3 floats or None
+                lengths of an orthorhombic periodic cell
+
+            virial : bool
+                also compute the virial sum r (x) f
+
+            terms : CharmmTerms or None
+                terms gathered by charmmTerms() for these tables
+
+            inner, outer : float
+                non-bonded cutoffs, the CHARMM switching function goes from 1
+                at inner to 0 at outer (LAMMPS lj/charmm/coul/charmm inner outer)
+
+            electrostatics : str
+                Coulomb model: 'charmm' (switched like L-J), 'dsf' (damped shifted
+                force, Wolf summation) or 'rf' (reaction field), all within outer,
+                or 'pme' (particle-mesh Ewald, needs box)
+
+            alpha : float
+                damping parameter of 'dsf' (1/A)
+
+            epsilonRF : float
+                dielectric constant beyond the cutoff for 'rf'
+
+            pme : granules.analysis.pme.PME or None
+                grid spacing, spline order and alpha for 'pme'
+                (default: 1 A, cubic, erfc(alpha outer) = 1e-5)
+
+            returns (Series of energies indexed by bond, angle, dihedral, improper,
+                     lj14, coulomb14, lj, coulomb,
+                     DataFrame with x, y, z forces indexed by aID,
+                     virial (3,3) or None)
         '''
-        bi = topologia.bonds.set_index('Atom1').join(
-                atompropertydata.atoms.set_index('aID')
-             )[['bID','x', 'y', 'z']].set_index('bID')
-
-        bj = topologia.bonds.set_index('Atom2').join(
-                atompropertydata.atoms.set_index('aID')
-             )[['bID','x', 'y', 'z']].set_index('bID')
-
-
-        bij = np.sqrt(np.sum((bi - bj) ** 2, axis='columns'))  # bonds lengths
-
-        coeffs = topologia.bonds[['bID','bType']].set_index('bType').join(
-                        self.bondCoeffs.set_index('bType')
-                 ).reset_index(drop=True)
-        K = coeffs[['bID','Spring_Constant']].set_index('bID').Spring_Constant
-        b0 = coeffs[['bID','Eq_Length']].set_index('bID').Eq_Length
-
-        return np.sum(K * (bij-b0)**2)
-
-
-     def charmmAngleEnergy(self,atompropertydata,topologia):
-        ''' Computes CHARMM angle energy.
-            Formula: sum K * (aij - a0)**2
-
+        from granules.analysis.energy import charmmEvaluate
+
+        if terms is None: terms = self.charmmTerms(atompropertydata,topologia)
+        atoms = atompropertydata.atoms
+        energies, forces, W = charmmEvaluate(terms, atoms[['x', 'y', 'z']].values.astype(float),
+                                             box=box, virial=virial, inner=inner, outer=outer,
+                                             electrostatics=electrostatics, alpha=alpha,
+                                             epsilonRF=epsilonRF, pme=pme)
+        return pd.Series(energies), self._atomForces(atoms, forces), W
+
+     def charmmFrameEnergies(self,atompropertydata,topologia,frames,box=None,chunk=100,terms=None,
+                             inner=8.0,outer=10.0,electrostatics='charmm',alpha=0.2,
+                             epsilonRF=np.inf,pme=None):
+        ''' Computes CHARMM energies of many frames: bonded terms broadcast
+            over 'chunk' frames at a time, non-bonded terms frame by frame
+            reusing the exclusions (granules.analysis.energy.charmmFrameEnergies).
+
+            Parameter
+            ----------
+            frames : array (F,N,3)
+                coordinates of the atoms, in the order of atompropertydata.atoms, in each frame
+
+            chunk : int
+                frames evaluated together, caps memory
+
+            other parameters as in charmmEvaluate
+
+            returns DataFrame with one row per frame and one column per kind of term
+        '''
+        from granules.analysis.energy import charmmFrameEnergies
+
+        if terms is None: terms = self.charmmTerms(atompropertydata,topologia)
+        energies = charmmFrameEnergies(terms, frames, box, chunk, inner, outer,
+                                       electrostatics, alpha, epsilonRF, pme)
+        table = pd.DataFrame(energies)
+        table.index.name = 'frame'
+        return table
+
+     def charmmDecomposition(self,atompropertydata,topologia,groups=None,box=None,terms=None,
+                             inner=8.0,outer=10.0,electrostatics='charmm',alpha=0.2,
+                             epsilonRF=np.inf,pme=None):
+        ''' Computes CHARMM energies per atom and non-bonded interaction
+            energies between groups of atoms (granules.analysis.energy.charmmDecomposition).
+
+            Parameter
+            ----------
+            groups : None, str, array-like
+                name of a column of atompropertydata.atoms (e.g. 'Mol_ID'), or
+                one label per atom (residue, chain, boolean selection...)
+
+            other parameters as in charmmEvaluate
+
+            returns (DataFrame of energies indexed by aID with one column per kind of term,
+                     dict of DataFrames (groups x groups) per kind of non-bonded term
+                     and 'total', labelled by group, or None)
+        '''
+        from granules.analysis.energy import charmmDecomposition
+
+        atoms = atompropertydata.atoms
+        if terms is None: terms = self.charmmTerms(atompropertydata,topologia)
+        codes, labels = None, None
+        if groups is not None:
+            if isinstance(groups, str): groups = atoms[groups].values
+            codes, labels = pd.factorize(np.asarray(groups), sort=True)
+
+        perAtom, matrices = charmmDecomposition(terms, atoms[['x', 'y', 'z']].values.astype(float),
+                                                codes, box, None, inner, outer,
+                                                electrostatics, alpha, epsilonRF, pme)
+        perAtom = pd.DataFrame(perAtom, index=pd.Index(atoms.aID.values, name='aID'))
+        if matrices is None: return perAtom, None
+
+        matrices['total'] = sum(matrices.values())
+        return perAtom, {name: pd.DataFrame(m, index=labels, columns=labels)
+                         for name, m in matrices.items()}
+
+     def charmmIncremental(self,atompropertydata,topologia,box=None,terms=None,skin=2.0,
+                           inner=8.0,outer=10.0,electrostatics='charmm',alpha=0.2,epsilonRF=np.inf):
+        ''' Returns an IncrementalEnergy (granules.analysis.incremental) that
+            updates the CHARMM energy when a few atoms move, at a cost that
+            does not depend on the size of the system.
+
+            Parameter
+            ----------
+            skin : float
+                extra width of the cells of its cell list
+
+            other parameters as in charmmEvaluate ('pme' is not supported)
+
+            Moved atoms are given as rows of atompropertydata.atoms (0-based).
         '''
-        bi = topologia.angles.set_index('Atom1').join(
-                atompropertydata.atoms.set_index('aID')
-             )[['anID','x', 'y', 'z']].set_index('anID')
+        from granules.analysis.incremental import IncrementalEnergy
 
-        bj = topologia.angles.set_index('Atom2').join(
-                atompropertydata.atoms.set_index('aID')
-             )[['anID','x', 'y', 'z']].set_index('anID')
+        if terms is None: terms = self.charmmTerms(atompropertydata,topologia)
+        return IncrementalEnergy(terms, atompropertydata.atoms[['x', 'y', 'z']].values.astype(float),
+                                 box, skin, inner, outer, electrostatics, alpha, epsilonRF)
 
-        bk = topologia.angles.set_index('Atom3').join(
-                atompropertydata.atoms.set_index('aID')
-             )[['anID','x', 'y', 'z']].set_index('anID')
+     def _atomForces(self, atoms, forces):
+        return pd.DataFrame(forces, columns=['x', 'y', 'z'],
+                            index=pd.Index(atoms.aID.values, name='aID'))
 
-        # compute angles
-        l1 = bi - bj
-        l2 = bk - bj
+     def charmmNonBondTerms(self,atompropertydata,topologia,inner=8.0,outer=10.0,terms=None):
+        ''' Computes CHARMM non-bonded energies and forces of the pairs
+            closer than the outer cutoff, switched from the inner one and
+            excluding 1-2, 1-3 and 1-4 pairs (granules.analysis.energy.pairForces).
 
-        norm1 = np.sqrt(np.square(l1).sum(axis=1))
-        norm2 = np.sqrt(np.square(l1).sum(axis=1))
-        dot = l1.x * l2.x + l1.y * l2.y + l1.z * l2.z
-        angles = np.arccos(dot / (norm1 * norm2))
+            'terms', here and in the other charmm*Terms, *Energy and *Force
+            methods, are the CharmmTerms of charmmTerms() reused between calls
+            (gathered again if None).
 
-        coeffs = topologia.angles[['anID','anType']].set_index('anType').join(
-                        self.angleCoeffs.set_index('anType')
-                 ).reset_index(drop=True)
+            returns (L-J energy of each pair, Coulomb energy of each pair,
+                     forces (N,3) on the atoms in the order of atompropertydata.atoms)
+        '''
+        from granules.analysis.energy import pairForces
 
-        K = coeffs[['anID','Ktheta']].set_index('anID').Ktheta
-        a0 = np.radians(coeffs[['anID','Theta0']].set_index('anID').Theta0)
+        if terms is None: terms = self.charmmTerms(atompropertydata,topologia)
+        xyz = atompropertydata.atoms[['x', 'y', 'z']].values.astype(float)
+        i, j = terms.nonBondedPairs(xyz, outer)
+        return pairForces(xyz, i, j, np.sqrt(terms.ljEpsilon[i] * terms.ljEpsilon[j]),
+                          terms.ljRmin2[i] + terms.ljRmin2[j], terms.charge[i] * terms.charge[j],
+                          inner=inner, outer=outer)[:3]
 
-        return np.sum(K * (angles-a0)**2)
+     def charmmBondTerms(self,atompropertydata,topologia,terms=None):
+        ''' Computes CHARMM bond energies and forces (granules.analysis.energy.bondForces).
 
-     def charmmDihedralsEnergy(self,atompropertydata,topologia):
-        ''' Computes CHARMM angle energy.
-            Formula: sum K * (1 + cos(n * x - d))
+            returns (energy of each row of topologia.bonds,
+                     forces (N,3) on the atoms in the order of atompropertydata.atoms)
         '''
-        bi = topologia.dihedrals.set_index('Atom1').join(
-                atompropertydata.atoms.set_index('aID')
-             )[['dID','x', 'y', 'z']].set_index('dID')
+        from granules.analysis.energy import bondForces
 
-        bj = topologia.dihedrals.set_index('Atom2').join(
-                atompropertydata.atoms.set_index('aID')
-             )[['dID','x', 'y', 'z']].set_index('dID')
+        if terms is None: terms = self.charmmTerms(atompropertydata,topologia)
+        return bondForces(atompropertydata.atoms[['x', 'y', 'z']].values.astype(float),
+                          terms.bonds, terms.bondK, terms.bondR0)[:2]
 
-        bk = topologia.dihedrals.set_index('Atom3').join(
-                atompropertydata.atoms.set_index('aID')
-             )[['dID','x', 'y', 'z']].set_index('dID')
+     def charmmAngleTerms(self,atompropertydata,topologia,terms=None):
+        ''' Computes CHARMM angle and Urey-Bradley energies and forces
+            (granules.analysis.energy.angleForces).
 
-        bl = topologia.dihedrals.set_index('Atom4').join(
-                atompropertydata.atoms.set_index('aID')
-             )[['dID','x', 'y', 'z']].set_index('dID')
-
-        # compute equations of planes
-        l1 = bi - bj
-        l2 = bk - bj
-        normals1 = np.cross(l1, l2)
-        normals1 = normals1 / np.linalg.norm(normals1, axis=1)[:, np.newaxis] 
+            returns (energy of each row of topologia.angles,
+                     forces (N,3) on the atoms in the order of atompropertydata.atoms)
+        '''
+        from granules.analysis.energy import angleForces
 
-        l1 = bj - bk
-        l2 = bl - bk
-        normals2 = np.cross(l1, l2)
-        normals2 = normals2 / np.linalg.norm(normals2, axis=1)[:, np.newaxis] 
+        if terms is None: terms = self.charmmTerms(atompropertydata,topologia)
+        return angleForces(atompropertydata.atoms[['x', 'y', 'z']].values.astype(float),
+                           terms.angles, terms.angleK, terms.angleTheta0,
+                           terms.angleKub, terms.angleS0)[:2]
 
-        angles = np.degrees(np.arccos(np.abs(np.einsum('ij,ij->i', normals1, normals2))))
+     def charmmDihedralTerms(self,atompropertydata,topologia,terms=None):
+        ''' Computes CHARMM dihedral energies and forces with the analytic
+            gradient (granules.analysis.energy.dihedralForces).
 
-        # get CHARMM constants
-        print(topologia.dihedrals)
-        coeffs = topologia.dihedrals[['dID','dType']].set_index('dType').join(
-                        self.dihedralCoeffs.set_index('dType')
-                 ).reset_index(drop=True)
-        K = coeffs[['dID','Kchi']].set_index('dID').Kchi
-        n = coeffs[['dID','n']].set_index('dID').n
-        d = coeffs[['dID','delta']].set_index('dID').delta
+            returns (energy of each row of topologia.dihedrals,
+                     forces (N,3) on the atoms in the order of atompropertydata.atoms)
+        '''
+        from granules.analysis.energy import dihedralForces
 
+        if terms is None: terms = self.charmmTerms(atompropertydata,topologia)
+        return dihedralForces(atompropertydata.atoms[['x', 'y', 'z']].values.astype(float),
+                              terms.dihedrals, terms.dihedralK, terms.dihedralN, terms.dihedralDelta)[:2]
 
+     def charmmImproperTerms(self,atompropertydata,topologia,terms=None):
+        ''' Computes CHARMM harmonic improper energies and forces with the
+            analytic gradient (granules.analysis.energy.improperForces).
 
-        return np.sum(K * (1 + np.cos(n * angles - d)))
-        '''
+            returns (energy of each row of topologia.impropers,
+                     forces (N,3) on the atoms in the order of atompropertydata.atoms)
         '''
+        from granules.analysis.energy import improperForces
 
+        if terms is None: terms = self.charmmTerms(atompropertydata,topologia)
+        return improperForces(atompropertydata.atoms[['x', 'y', 'z']].values.astype(float),
+                              terms.impropers, terms.improperK, terms.improperPsi0)[:2]
 
-     def charmmNonBondForce(self,atompropertydata,topologia):
+     def charmmNonBondEnergy(self,atompropertydata,topologia,inner=8.0,outer=10.0,terms=None):
         ''' Computes CHARMM Lennard-Jones energy.
-            Formula: Eps,i,j[(Rmin,i,j/ri,j)**12 - 2(Rmin,i,j/ri,j)**6]
+            Formula: S(rij) Eps,i,j[(Rmin,i,j/ri,j)**12 - 2(Rmin,i,j/ri,j)**6]
                     Eps,i,j = sqrt(eps,i * eps,j)
                     Rmin,i,j = Rmin/2,i + Rmin/2,j
 
             Computes CHARMM Coulumb energy.
-            Formula: qi qj/rij / epsilon_0
+            Formula: S(rij) 332.0636 qi qj/rij
+
+            S is the CHARMM switching function, 1 below inner and 0 beyond
+            outer (LAMMPS lj/charmm/coul/charmm inner outer). The sums skip
+            1-2, 1-3 and 1-4 pairs; the 1-4 energies, with the special 1-4
+            L-J parameters, are lj14 and coulomb14 of charmmEvaluate.
 
             returns (L-J, Coulomb)
         '''
-        from scipy.constants import epsilon_0, physical_constants
+        lj, coulomb, _ = self.charmmNonBondTerms(atompropertydata,topologia,inner,outer,terms)
+        return np.sum(lj), np.sum(coulomb)
 
-        NONB_CUTOFF = 13.0
-        print("ForceFieldData.charmmNonBondForce()")
-        
-        # generate all pairs of atoms IDs
-        atomIds = atompropertydata.atoms[['aID']].copy()
-        atomIds['key'] = np.ones(len(atomIds))
-        atomIds = pd.merge(atomIds, atomIds, on='key')[['aID_x', 'aID_y']]
-        atomIds = atomIds[atomIds['aID_x'] < atomIds['aID_y']]
-
-        atomIds['nbID'] = np.arange(len(atomIds))
-
-        # compute pairwise distances
-        print('ForceFieldData.charmmNonBondForce: len(atomIds)=', len(atomIds))
-        from scipy.spatial.distance import pdist
-        atomIds['rij'] = pdist(atompropertydata.atoms.set_index('aID')[['x', 'y', 'z']].values)
-        atomIds = atomIds[atomIds['rij'] < NONB_CUTOFF]
-
-        # remove bonded atoms
-        print('ForceFieldData.charmmNonBondForce: len(atomIds < NONB_CUTOFF)=', len(atomIds))
-        atomIds['p'] = list(zip(atomIds.aID_x, atomIds.aID_y))
-        bonds = topologia.bonds.copy()
-        bonds['p'] = list(zip(bonds.Atom1, bonds.Atom2))
-        atomIds = atomIds.set_index('p').join(bonds.set_index('p'))
-        atomIds = atomIds[atomIds.bID.isna()][['aID_x','aID_y','nbID','rij']].reset_index(drop=True)
-        del bonds
-        print('ForceFieldData.charmmNonBondForce: len(atomIds < NONB_CUTOFF -  BONDS)=', len(atomIds))
-
-        # remove angled atoms
-        atomIds['p'] = list(zip(atomIds.aID_x, atomIds.aID_y))
-        angles = topologia.angles.copy()
-        angles['p'] = list(zip(angles.Atom1, angles.Atom3))
-        atomIds = atomIds.set_index('p').join(angles.set_index('p'))
-        atomIds = atomIds[atomIds.anID.isna()][['aID_x','aID_y','nbID','rij']].reset_index(drop=True)
-        del angles
-        print('ForceFieldData.charmmNonBondForce: len(atomIds < NONB_CUTOFF -  BONDS - ABGLES)=',len(atomIds))
-
-        # get atom types and charges
-        atomIds = atomIds.set_index('aID_x', drop=False).join(atompropertydata.atoms[['aID', 'Q']].set_index('aID'))
-        atomIds.rename(columns={'Q':'qi'}, inplace=True)
-        atomIds = atomIds.join(atompropertydata.atoms[['aID', 'aType']].set_index('aID')).reset_index(drop=True)
-        atomIds.rename(columns={'aType':'aiType'}, inplace=True)
-        atomIds = atomIds.set_index('aID_y', drop=False).join(atompropertydata.atoms[['aID', 'Q']].set_index('aID'))
-        atomIds = atomIds.join(atompropertydata.atoms[['aID', 'aType']].set_index('aID')).reset_index(drop=True)
-        atomIds.rename(columns={'aType':'ajType', 'Q':'qj'}, inplace=True)
-
-        # get epsilons and sigmas for each atom type
-        #areglar error
-        sameTypes = self.pairCoeffs[ self.pairCoeffs['aType'] == self.pairCoeffs['aType2'] ]
-        sameTypes.drop('aType2', axis=1, inplace=True) 
-        
-        atomIds = atomIds.set_index('aiType').join(
-                        sameTypes.set_index('aType')
-                 ).reset_index(drop=True)
-        atomIds.drop(columns=['epsilon1_4', 'sigma1_4'], inplace=True)
-        atomIds.rename(columns={'epsilon':'epsilon_i', 'sigma':'sigma_i'}, inplace=True)
-        atomIds = atomIds.set_index('ajType').join(
-                        sameTypes.set_index('aType')
-                 ).reset_index(drop=True).drop(columns=['epsilon1_4', 'sigma1_4'])
-        atomIds.rename(columns={'epsilon':'epsilon_j', 'sigma':'sigma_j'}, inplace=True)
-
-        # compute epsilon and sigma
-        atomIds['epsilon'] = np.sqrt(atomIds.epsilon_i * atomIds.epsilon_j)
-        atomIds['sigma'] = atomIds.sigma_i + atomIds.sigma_j
-        atomIds.drop(columns=['epsilon_i', 'epsilon_j', 'sigma_i', 'sigma_j'], inplace=True)
-
-
-        atomIds.set_index('nbID', drop=False, inplace=True)
-        # return LJ and Coulomb
-        COULOMB = 332.0636
-
-
-        bi = atomIds.set_index('aID_x').join(
-                atompropertydata.atoms.set_index('aID')
-             )[['nbID', 'x', 'y', 'z']].set_index('nbID')
-        bj = atomIds.set_index('aID_y').join(
-                atompropertydata.atoms.set_index('aID')
-             )[['nbID', 'x', 'y', 'z']].set_index('nbID')
-        
-        bij = (bj - bi).div(atomIds.rij, axis=0)
-        
-        forces = -atomIds.epsilon * (-12 * (atomIds.sigma**12/atomIds.rij**13) + 6 * (atomIds.sigma**6/atomIds.rij**7)) - COULOMB * (atomIds.qi * atomIds.qj) / (atomIds.rij**2)
-        wi = bij.mul(forces, axis=0)
-        wj = bij.mul(-forces, axis=0)
-        
-        fi = wi.join(atomIds[['nbID', 'aID_x']].set_index('nbID')).groupby('aID_x').sum()
-        fj = wj.join(atomIds[['nbID', 'aID_y']].set_index('nbID')).groupby('aID_y').sum()
-        ff = fj.add(fi, axis=0, fill_value=0)
+     def charmmBondEnergy(self,atompropertydata,topologia,terms=None):
+        ''' Computes CHARMM bond energy.
 
-        return ff
+            Formula: sum K * (bij - b0)**2
+        '''
+        return np.sum(self.charmmBondTerms(atompropertydata,topologia,terms)[0])
 
+     def charmmAngleEnergy(self,atompropertydata,topologia,terms=None):
+        ''' Computes CHARMM angle energy.
+            Formula: sum K * (aij - a0)**2 + Kub * (sik - s0)**2
+        '''
+        return np.sum(self.charmmAngleTerms(atompropertydata,topologia,terms)[0])
 
-     def charmmBondForce(self,atompropertydata,topologia):
-        ''' Computes CHARMM bond energy.
-            Formula: sum K * (bij - b0)**2
+     def charmmDihedralsEnergy(self,atompropertydata,topologia,terms=None):
+        ''' Computes CHARMM dihedral energy.
+            Formula: sum K * (1 + cos(n * x - d))
+        '''
+        return np.sum(self.charmmDihedralTerms(atompropertydata,topologia,terms)[0])
 
+     def charmmImproperEnergy(self,atompropertydata,topologia,terms=None):
+        ''' Computes CHARMM improper energy.
+            Formula: sum K * (x - x0)**2
         '''
-        bi = topologia.bonds.set_index('Atom1').join(
-                atompropertydata.atoms.set_index('aID')
-             )[['bID','x', 'y', 'z']].set_index('bID')
+        return np.sum(self.charmmImproperTerms(atompropertydata,topologia,terms)[0])
 
-        bj = topologia.bonds.set_index('Atom2').join(
-                atompropertydata.atoms.set_index('aID')
-             )[['bID','x', 'y', 'z']].set_index('bID')
+     def charmmNonBondForce(self,atompropertydata,topologia,inner=8.0,outer=10.0,terms=None):
+        ''' Computes CHARMM Lennard-Jones and Coulomb forces, switched and
+            cut off as in charmmNonBondEnergy.
 
-        bij = bj - bi  # bonds
-        rbij = np.sqrt(np.sum((bij) ** 2, axis='columns'))  # bonds lengths
+            returns DataFrame with x, y, z forces indexed by aID
+        '''
+        forces = self.charmmNonBondTerms(atompropertydata,topologia,inner,outer,terms)[2]
+        return self._atomForces(atompropertydata.atoms, forces)
 
-        coeffs = topologia.bonds[['bID','bType']].set_index('bType').join(
-                        self.bondCoeffs.set_index('bType')
-                 ).reset_index(drop=True)
-        K = coeffs[['bID','Spring_Constant']].set_index('bID').Spring_Constant
-        b0 = coeffs[['bID','Eq_Length']].set_index('bID').Eq_Length
+     def charmmBondForce(self,atompropertydata,topologia,terms=None):
+        ''' Computes CHARMM bond forces.
+            Formula: -grad sum K * (bij - b0)**2
 
-        forces = -2 * K * (rbij-b0)
-        
-        bij = bij.div(rbij, axis=0)  # normalize
-        wi = bij.mul(forces, axis=0)
-        wj = bij.mul(-forces, axis=0)
-        
-        fi = wi.join(topologia.bonds.set_index('bID'))[['x','y','z','Atom1']].groupby('Atom1').sum()
-        fj = wi.join(topologia.bonds.set_index('bID'))[['x','y','z','Atom2']].groupby('Atom2').sum()
-        fi.index.names = ['aID']
-        fj.index.names = ['aID']
-        ff = fi.add(fj, axis=0, fill_value=0)
+            returns DataFrame with x, y, z forces indexed by aID
+        '''
+        forces = self.charmmBondTerms(atompropertydata,topologia,terms)[1]
+        return self._atomForces(atompropertydata.atoms, forces)
 
-        return ff
+     def charmmAngleForce(self,atompropertydata,topologia,terms=None):
+        ''' Computes CHARMM angle forces.
+            Formula: -grad sum K * (aij - a0)**2 + Kub * (sik - s0)**2
 
+            returns DataFrame with x, y, z forces indexed by aID
+        '''
+        forces = self.charmmAngleTerms(atompropertydata,topologia,terms)[1]
+        return self._atomForces(atompropertydata.atoms, forces)
 
+     def charmmDihedralForce(self,atompropertydata,topologia,terms=None):
+        ''' Computes CHARMM dihedral forces.
+            Formula: -grad sum K * (1 + cos(n * x - d))
 
-     def charmmAngleForce(self,atompropertydata,topologia):
-        ''' Computes CHARMM angle energy.
-            Formula: sum K * (aij - a0)**2
+            returns DataFrame with x, y, z forces indexed by aID
         '''
-        
-        print("ForceFieldData.charmmAngleForce")
-        bi = topologia.angles.set_index('Atom1').join(
-                atompropertydata.atoms.set_index('aID')
-             )[['anID','x', 'y', 'z']].set_index('anID')
-
-        bj = topologia.angles.set_index('Atom2').join(
-                atompropertydata.atoms.set_index('aID')
-             )[['anID','x', 'y', 'z']].set_index('anID')
-
-        bk = topologia.angles.set_index('Atom3').join(
-                atompropertydata.atoms.set_index('aID')
-             )[['anID','x', 'y', 'z']].set_index('anID')
-
-        # compute angles
-        l1 = bi - bj
-        l2 = bk - bj
-
-        norm1 = np.sqrt(np.square(l1).sum(axis=1))
-        norm2 = np.sqrt(np.square(l1).sum(axis=1))
-        dot = l1.x * l2.x + l1.y * l2.y + l1.z * l2.z
-        angles = np.arccos(dot / (norm1 * norm2))
-
-        coeffs = topologia.angles[['anID','anType']].set_index('anType').join(
-                        self.angleCoeffs.set_index('anType')
-                 ).reset_index(drop=True)
-
-        K = coeffs[['anID','Ktheta']].set_index('anID').Ktheta
-        a0 = np.radians(coeffs[['anID','Theta0']].set_index('anID').Theta0)
-
-        c11 = l1.x * l1.x + l1.y * l1.y + l1.z * l1.z
-        c12 = l1.x * l2.x + l1.y * l2.y + l1.z * l2.z
-        c22 = l2.x * l2.x + l2.y * l2.y + l2.z * l2.z
-        cd = np.sqrt(c11 * c22)
-        c = c12 / cd
-        
-        forces = -2 * K * (angles-a0)
-        
-        w1 = l1.mul(c12 / c11, axis=0).add(-l2, axis=0).mul(forces / cd, axis=0)
-        w2 = l1.sub(l2.mul(c12 / c22, axis=0),  axis=0).mul(forces / cd, axis=0)
-
-        #print(self.angles.columns.values)
-        f1 = w1.join(topologia.angles.set_index('anID'))[['x','y','z','Atom1']].groupby('Atom1').sum()
-        f2 = w1.sub(w2, axis=0).join(topologia.angles.set_index('anID'))[['x','y','z','Atom2']].groupby('Atom2').sum()
-        f3 = w2.join(topologia.angles.set_index('anID'))[['x','y','z','Atom3']].groupby('Atom3').sum()
-        f1.index.names = ['aID']
-        f2.index.names = ['aID']
-        f3.index.names = ['aID']
-
-        ff = f1.add(f2.add(f3, axis=0, fill_value=0), axis=0, fill_value=0)
-        #print (ff)
-        print("ForceFieldData.charmmAngleForce  END")
-        return ff
-
-     def charmmForce(self,atompropertydata,topologia):
-        print("ForceFieldData.charmmForce()")
-        return self.charmmNonBondForce(atompropertydata,topologia).add(
-                self.charmmBondForce(atompropertydata,topologia), axis=0).add(
-                self.charmmAngleForce(atompropertydata,topologia), axis=0)
-        
-     def charmmEnergy(self,atompropertydata,topologia):
-        return self.charmmNonBondEnergy(atompropertydata,topologia).add(
-                self.charmmBondEnergy(atompropertydata,topologia)).add(
-                self.charmmAngleEnergy(atompropertydata,topologia)).add(
-                self.charmmDihedralsEnergy(atompropertydata,topologia))
+        forces = self.charmmDihedralTerms(atompropertydata,topologia,terms)[1]
+        return self._atomForces(atompropertydata.atoms, forces)
+
+     def charmmImproperForce(self,atompropertydata,topologia,terms=None):
+        ''' Computes CHARMM improper forces.
+            Formula: -grad sum K * (x - x0)**2
+
+            returns DataFrame with x, y, z forces indexed by aID
+        '''
+        forces = self.charmmImproperTerms(atompropertydata,topologia,terms)[1]
+        return self._atomForces(atompropertydata.atoms, forces)
+
+     def charmmForce(self,atompropertydata,topologia,box=None):
+        ''' total CHARMM forces, DataFrame with x, y, z forces indexed by aID.'''
+        return self.charmmEvaluate(atompropertydata,topologia,box)[1]
+
+     def charmmEnergy(self,atompropertydata,topologia,box=None):
+        ''' total CHARMM energy.'''
+        return self.charmmEvaluate(atompropertydata,topologia,box)[0].sum()
 
 	
 
@@ -662,7 +705,32 @@ class AtomProperty(LammpsBodySection):#cambiado LammpsBodySection
  '''
    
 class MolecularTopology(LammpsBodySection):
-    pass
+
+    def setFromPSF(self, charmm, psfTerms, idColumn, typeColumn):
+        ''' Replaces self with the terms of a PSF section. Each distinct tuple
+            of CHARMM atom types becomes a LAMMPS type, numbered in order of
+            first appearance.
+
+        Parameter
+        -----------------
+        charmm : NAMDdata
+            NAMDdata object
+
+        psfTerms : DataFrame
+            PSF section with columns atom1, atom2, ...
+
+        idColumn, typeColumn : str
+            names of the ID and type columns of self
+        '''
+        psfColumns  = [c for c in psfTerms.columns if c.startswith('atom')]
+        template, _ = termTemplates(charmm, psfTerms, psfColumns)
+
+        terms = pd.DataFrame({idColumn   : np.arange(1, len(psfTerms)+1),
+                              typeColumn : template})
+        for c in psfColumns:
+            terms['A' + c[1:]] = psfTerms[c].values.astype(int)
+
+        super(MolecularTopology, self).__init__(terms)
 '''
     def __init__(self):
         pass
@@ -745,8 +813,11 @@ class AtomsDF(AtomProperty):
         return self
 
     def updateCoordinates(self,archivo):
-        '''Actualiza las coordenadas x,y,z del dataframe'''
-        fill = open(archivo,"r")
+        '''Actualiza las coordenadas x,y,z del dataframe.
+           'archivo' es el nombre de un dump de LAMMPS (puede estar comprimido) o un stream.'''
+        from granules.structure.streams import openStream
+
+        fill = openStream(archivo)
         coor = []
         
         for i in reversed(fill.readlines()):#crea una lista del archivo en reversa
@@ -818,6 +889,48 @@ class VelocitiesDF(AtomProperty):
 
         super(VelocitiesDF, self).__init__(sel)
 
+    def setMaxwellBoltzmann(self, atoms, masses, temperature, seed=None, zeroMomentum=True, exact=True):
+        ''' Sets velocities of atoms (A/fs) drawn from the Maxwell-Boltzmann
+            distribution at 'temperature' (K), all at once.
+
+        Parameter
+        -----------------
+        atoms     : AtomsDF
+            an AtomsDF object
+
+        masses    : MassesDF
+            mass of each atom type
+
+        temperature : float
+            target temperature in K
+
+        seed : int or None
+            seed of the random numbers, for reproducible velocities
+
+        zeroMomentum : bool
+            remove the center of mass momentum
+
+        exact : bool
+            rescale so that the temperature, with 3N - 3 degrees of freedom
+            when zeroMomentum, is exactly 'temperature' (as LAMMPS velocity create)
+        '''
+        from granules.analysis.energy import MVV2E, BOLTZMANN
+
+        mass = masses.set_index('aType')['Mass']
+        mass = mass.loc[atoms.aType.values].values.astype(float)[:, np.newaxis]
+        rng  = np.random.default_rng(seed)
+        vel  = rng.standard_normal((len(atoms), 3)) * np.sqrt(BOLTZMANN * temperature / (MVV2E * mass))
+
+        if zeroMomentum and len(vel):
+            vel -= np.sum(mass * vel, axis=0) / mass.sum()
+        if exact and len(vel) > 1:
+            dof = 3 * len(vel) - (3 if zeroMomentum else 0)
+            current = MVV2E * np.sum(mass * vel * vel) / (dof * BOLTZMANN)
+            if current > 0: vel *= np.sqrt(temperature / current)
+
+        self.setToZero(atoms)
+        self[['Vx', 'Vy', 'Vz']] = vel
+
 #===================================================================
 
 class AnglesDF(MolecularTopology):
@@ -835,41 +948,7 @@ class AnglesDF(MolecularTopology):
             NAMDdata object
         '''
 
-        # extract info from charmm
-        psf_types   = charmm.psf.atoms[['ID', 'Type']].set_index('ID').to_dict()['Type']
-        #print(psf_types)
-
-        # substitute atoms numbers with charmm atom types
-        angles     = charmm.psf.angles.copy()
-        angles['atom1'] = angles['atom1'].map(psf_types)
-        angles['atom2'] = angles['atom2'].map(psf_types)
-        angles['atom3'] = angles['atom3'].map(psf_types)
-        angles['atuple'] = list(zip(angles.atom1, angles.atom2, angles.atom3))
-        angles.drop(columns=['atom1', 'atom2', 'atom3'], inplace=True)
-        #print(angles)
-
-        # build translation dict
-        btypes = angles.copy().drop_duplicates(inplace=False)
-        #print(btypes)
-        btypes['ID'] = np.arange(1, len(btypes)+1)
-        btypes.set_index('atuple', inplace=True)
-        btypeToInt = btypes.to_dict()['ID']
-        #print(btypeToInt)
-        btypes.reset_index(inplace=True)
-
-        # final table
-        angles['ID'] = np.arange(1, len(angles)+1)
-        angles['Type'] = angles['atuple'].map(btypeToInt)
-        angles.drop(columns=['atuple'], inplace=True)
-        angles['Atom1'] = charmm.psf.angles.copy()['atom1']
-        angles['Atom2'] = charmm.psf.angles.copy()['atom2']
-        angles['Atom3'] = charmm.psf.angles.copy()['atom3']
-
-        angles.rename(columns={'ID':'anID', 'Type':'anType'}, inplace=True)
-        #print(angles)
-
-        super(AnglesDF, self).__init__(angles)
-        #print(self.dtypes)
+        self.setFromPSF(charmm, charmm.psf.angles, 'anID', 'anType')
 
 class BondsDF(MolecularTopology):
     def __init__(self,data=None, dtype=None, copy=False):
@@ -886,40 +965,13 @@ class BondsDF(MolecularTopology):
             NAMDdata object
         '''
 
-        # extract info from charmm
-        psf_types   = charmm.psf.atoms[['ID', 'Type']].set_index('ID').to_dict()['Type']
-
-        # substitute atoms numbers with charmm atom types
-        bonds     = charmm.psf.bonds.copy()
-        bonds['atom1'] = bonds['atom1'].map(psf_types)
-        bonds['atom2'] = bonds['atom2'].map(psf_types)
-        bonds['atuple'] = list(zip(bonds.atom1, bonds.atom2))
-        bonds.drop(columns=['atom1', 'atom2'], inplace=True)
-
-        # build translation dict
-        btypes = bonds.copy().drop_duplicates(inplace=False)
-        #print(btypes)
-        btypes['ID'] = np.arange(1, len(btypes)+1)
-        btypes.set_index('atuple', inplace=True)
-        btypeToInt = btypes.to_dict()['ID']
-        btypes.reset_index(inplace=True)
-
-        # final table
-        bonds['ID'] = np.arange(1, len(bonds)+1)
-        bonds['Type'] = bonds['atuple'].map(btypeToInt)
-        bonds.drop(columns=['atuple'], inplace=True)
-        bonds['Atom1'] = charmm.psf.bonds.copy()['atom1']
-        bonds['Atom2'] = charmm.psf.bonds.copy()['atom2']
-
-        bonds.rename(columns={'ID':'bID', 'Type':'bType'}, inplace=True)
-
-        super(BondsDF, self).__init__(bonds)
+        self.setFromPSF(charmm, charmm.psf.bonds, 'bID', 'bType')
         
 
        
 class DihedralsDF(MolecularTopology):
     def __init__(self,data=None, dtype=None, copy=False):
-        dtypes = {'dID':[0], 'dType':[0], 'atom1':[0], 'atom2':[0], 'atom3':[0], 'atom4':[0]}
+        dtypes = {'dID':[0], 'dType':[0], 'Atom1':[0], 'Atom2':[0], 'Atom3':[0], 'Atom4':[0]}
         super(DihedralsDF, self).__init__(data=dtypes, copy=copy, columns=dtypes.keys())
         super(DihedralsDF, self).__init__(self.drop([0]))
 
@@ -932,49 +984,12 @@ class DihedralsDF(MolecularTopology):
             NAMDdata object
         '''
 
-        # extract info from charmm
-        psf_types   = charmm.psf.atoms[['ID', 'Type']].set_index('ID').to_dict()['Type']
-        #print(psf_types)
-
-        # substitute atoms numbers with charmm atom types
-        dihes     = charmm.psf.dihedrals.copy()
-        #print(charmm.psf.dihedrals)
-        dihes['atom1'] = dihes['atom1'].map(psf_types)
-        dihes['atom2'] = dihes['atom2'].map(psf_types)
-        dihes['atom3'] = dihes['atom3'].map(psf_types)
-        dihes['atom4'] = dihes['atom4'].map(psf_types)
-        dihes['atuple'] = list(zip(dihes.atom1, dihes.atom2, dihes.atom3, dihes.atom4))
-        dihes.drop(columns=['atom1', 'atom2', 'atom3', 'atom4'], inplace=True)
-        #print(dihes)
-
-        # build translation dict
-        btypes = dihes.copy().drop_duplicates(inplace=False)
-        #print(btypes)
-        btypes['ID'] = np.arange(1, len(btypes)+1)
-        btypes.set_index('atuple', inplace=True)
-        btypeToInt = btypes.to_dict()['ID']
-        #print(btypeToInt)
-        btypes.reset_index(inplace=True)
-
-        # final table
-        dihes['ID'] = np.arange(1, len(dihes)+1)
-        dihes['Type'] = dihes['atuple'].map(btypeToInt)
-        dihes.drop(columns=['atuple'], inplace=True)
-        dihes['Atom1'] = charmm.psf.dihedrals.copy()['atom1']
-        dihes['Atom2'] = charmm.psf.dihedrals.copy()['atom2']
-        dihes['Atom3'] = charmm.psf.dihedrals.copy()['atom3']
-        dihes['Atom4'] = charmm.psf.dihedrals.copy()['atom4']
-
-        dihes.rename(columns={'ID':'dID', 'Type':'dType'}, inplace=True)
-        #print(dihes)
-
-        super(DihedralsDF, self).__init__(dihes)
-        #print(self.dtypes)
+        self.setFromPSF(charmm, charmm.psf.dihedrals, 'dID', 'dType')
 
 
 class ImpropersDF(MolecularTopology):
     def __init__(self,data=None, dtype=None, copy=False):
-        dtypes = {'iID':[0], 'iType':[0], 'atom1':[0], 'atom2':[0], 'atom3':[0], 'atom4':[0]}
+        dtypes = {'iID':[0], 'iType':[0], 'Atom1':[0], 'Atom2':[0], 'Atom3':[0], 'Atom4':[0]}
         super(ImpropersDF, self).__init__(data=dtypes, copy=copy, columns=dtypes.keys())
         super(ImpropersDF, self).__init__(self.drop([0]))
 
@@ -987,43 +1002,7 @@ class ImpropersDF(MolecularTopology):
             NAMDdata object
         '''
 
-        # extract info from charmm
-        psf_types   = charmm.psf.atoms[['ID', 'Type']].set_index('ID').to_dict()['Type']
-        #print(psf_types)
-
-        # substitute atoms numbers with charmm atom types
-        impros     = charmm.psf.impropers.copy()
-        impros['atom1'] = impros['atom1'].map(psf_types)
-        impros['atom2'] = impros['atom2'].map(psf_types)
-        impros['atom3'] = impros['atom3'].map(psf_types)
-        impros['atom4'] = impros['atom4'].map(psf_types)
-        impros['atuple'] = list(zip(impros.atom1, impros.atom2, impros.atom3))
-        impros.drop(columns=['atom1', 'atom2', 'atom3', 'atom4'], inplace=True)
-        #print(impros)
-
-        # build translation dict
-        btypes = impros.copy().drop_duplicates(inplace=False)
-        #print(btypes)
-        btypes['ID'] = np.arange(1, len(btypes)+1)
-        btypes.set_index('atuple', inplace=True)
-        btypeToInt = btypes.to_dict()['ID']
-        #print(btypeToInt)
-        btypes.reset_index(inplace=True)
-
-        # final table
-        impros['ID'] = np.arange(1, len(impros)+1)
-        impros['Type'] = impros['atuple'].map(btypeToInt)
-        impros.drop(columns=['atuple'], inplace=True)
-        impros['Atom1'] = charmm.psf.impropers.copy()['atom1']
-        impros['Atom2'] = charmm.psf.impropers.copy()['atom2']
-        impros['Atom3'] = charmm.psf.impropers.copy()['atom3']
-        impros['Atom4'] = charmm.psf.impropers.copy()['atom4']
-
-        impros.rename(columns={'ID':'iID', 'Type':'iType'}, inplace=True)
-        #print(impros)
-
-        super(ImpropersDF, self).__init__(impros)
-        #print(self.dtypes)
+        self.setFromPSF(charmm, charmm.psf.impropers, 'iID', 'iType')
 
 
 #===================================================================
@@ -1044,36 +1023,22 @@ class PairCoeffs(ForceField):
             AtomsDF object associateed with these PairCoeffs
         '''
 
-        # extract info from charmm
-        psf_types   = charmm.psf.atoms[['ID', 'Type']].set_index('ID').to_dict()['Type']
-        #print(psf_types)
-
-        # substitute atoms numbers with charmm atom types
-        nonbonded       = mass.copy()
-        nonbonded['types'] = nonbonded.aType.map(psf_types)
-        nonbonded.drop(columns=['Mass'], inplace=True)
-        #print(nonbonded)
+        # CHARMM name of each LAMMPS atom type (numbered as in detectAtomTypes)
+        _, names = typeCodes(charmm)
+        types    = names[mass.aType.values.astype(int) - 1]
 
         prmFF = charmm.prm.nonbonded.getCoeffs()
-        #print("Aqui el DF: ",prmFF)
 
         # add charge and energy to atoms
-        nonbonded['epsilon'] = nonbonded.types.map(prmFF.epsilon.to_dict())
-        nonbonded['sigma'] = nonbonded.types.map(prmFF.Rmin2.to_dict())
-        nonbonded['epsilon1_4'] = nonbonded.types.map(prmFF.epsilon.to_dict())
-        nonbonded['sigma1_4'] = nonbonded.types.map(prmFF.Rmin2.to_dict())
-        nonbonded.drop(columns=['types'], inplace=True)
-        
-        nonbonded.rename(columns={'aID':'aType'}, inplace=True)
-        #Columna nueva para el Lennard-Jones y reorganizacion columna
-        print("Antes:\n",nonbonded)
-        nonbonded['aType2'] = nonbonded['aType']
-        nonbonded = nonbonded[['aType','aType2', 'epsilon','sigma','epsilon1_4','sigma1_4']]
-        print("aqui el nonbonded, la tabla:\n",nonbonded)
+        nonbonded = pd.DataFrame({'aType' : mass.aType.values,
+                                  'aType2': mass.aType.values})
+        nonbonded['epsilon']    = pd.Series(types).map(prmFF.epsilon.to_dict()).values
+        nonbonded['sigma']      = pd.Series(types).map(prmFF.Rmin2.to_dict()).values
+        nonbonded['epsilon1_4'] = pd.Series(types).map(prmFF.epsilon1_4.to_dict()).values
+        nonbonded['sigma1_4']   = pd.Series(types).map(prmFF.Rmin2_1_4.to_dict()).values
 
         super(PairCoeffs, self).__init__(nonbonded)
         #print("\nPairCoeffs Nans:\n",nonbonded.isna().sum())
-        #print(self.dtypes)
 
 
 
@@ -1093,38 +1058,24 @@ class AngleCoeffs(ForceField):
             AnglesDF object associateed with these AngleCoeffs
         '''
 
-        # extract info from charmm
-        psf_types   = charmm.psf.atoms[['ID', 'Type']].set_index('ID').to_dict()['Type']
-        #print(psf_types)
-
-        # substitute atoms numbers with charmm atom types
-        angles     = angles.copy()
-        angles.Atom1 = angles.Atom1.map(psf_types)
-        angles.Atom2 = angles.Atom2.map(psf_types)
-        angles.Atom3 = angles.Atom3.map(psf_types)
-        angles['atuple'] = list(zip(angles.Atom1, angles.Atom2, angles.Atom3))
-        angles.drop(columns=['anID', 'Atom1', 'Atom2', 'Atom3'], inplace=True)
-        angles.drop_duplicates(inplace=True)
+        # one angle per type is enough to find its CHARMM types
+        first  = angles.drop_duplicates(subset='anType')
+        tuples = pd.Series(typeTuples(charmm, first, ['Atom1', 'Atom2', 'Atom3']), dtype=object)
 
         prmFF = charmm.prm.angles.getCoeffs()
 
-        # add Kb and b0 to bonds
-        angles['Ktheta'] = angles.atuple.map(prmFF.Ktheta.to_dict())
-        #angles['Ktheta'] = angles.atuple.apply(findWithX, args=(prmFF.Ktheta.to_dict(),) )
-        angles['Theta0'] = angles.atuple.map(prmFF.Theta0.to_dict())
-        angles['Kub'] = angles.atuple.map(prmFF.Kub.to_dict())
-        angles['S0'] = angles.atuple.map(prmFF.S0.to_dict())
-        angles.drop(columns=['atuple'], inplace=True)
-        #print(angles)
+        # add Ktheta, Theta0, Kub and S0 to angle types
+        angles = pd.DataFrame({'anType':first.anType.values})
+        angles['Ktheta'] = tuples.map(prmFF.Ktheta.to_dict()).values
+        angles['Theta0'] = tuples.map(prmFF.Theta0.to_dict()).values
+        angles['Kub']    = tuples.map(prmFF.Kub.to_dict()).values
+        angles['S0']     = tuples.map(prmFF.S0.to_dict()).values
         #print(angles.isna().sum())
 
         angles.fillna(0.0, inplace=True)
 
-        angles.rename(columns={'ID':'anType'}, inplace=True)
-
         super(AngleCoeffs, self).__init__(angles)
         #print("\nAngleCoeffs Nans:\n",angles.isna().sum())
-        #print("Nans:\n",self)
 
 
 
@@ -1144,41 +1095,33 @@ class BondCoeffs(ForceField):
             BondsDF object associateed with these BondCoeffs
         '''
 
-        # extract info from charmm
-        psf_types   = charmm.psf.atoms[['ID', 'Type']].set_index('ID').to_dict()['Type']
-        #print(psf_types)
-
-        # substitute atoms numbers with charmm atom types
-        bonds     = bonds.copy()
-        bonds.Atom1 = bonds.Atom1.map(psf_types)
-        bonds.Atom2 = bonds.Atom2.map(psf_types)
-        bonds['atuple'] = list(zip(bonds.Atom1, bonds.Atom2))
-        bonds.drop(columns=['bID', 'Atom1', 'Atom2'], inplace=True)
-        bonds.drop_duplicates(inplace=True)
-        #print(bonds)
+        # one bond per type is enough to find its CHARMM types
+        first  = bonds.drop_duplicates(subset='bType')
+        tuples = pd.Series(typeTuples(charmm, first, ['Atom1', 'Atom2']), dtype=object)
 
         prmFF = charmm.prm.bonds.getCoeffs()
 
-
-        # add Kb and b0 to bonds
-        bonds['Spring_Constant'] = bonds.atuple.map(prmFF.Kb.to_dict())
-        bonds['Eq_Length'] = bonds.atuple.map(prmFF.b0.to_dict())
-        bonds.drop(columns=['atuple'], inplace=True)
-        #print(bonds)
+        # add Kb and b0 to bond types
+        bonds = pd.DataFrame({'bType':first.bType.values})
+        bonds['Spring_Constant'] = tuples.map(prmFF.Kb.to_dict()).values
+        bonds['Eq_Length']       = tuples.map(prmFF.b0.to_dict()).values
         #print("\nBondCoeffs Nans:\n",bonds.isna().sum())
 
-        bonds.rename(columns={'ID':'bType'}, inplace=True)
-
         super(BondCoeffs, self).__init__(bonds)
-        #print(self.dtypes)
 
 
 class DihedralCoeffs(ForceField):
     def __init__(self,data=None, dtype=None, copy=False):
-        super(DihedralCoeffs, self).__init__(data=data, columns=['dType', 'Kchi', 'n', 'delta'], dtype=dtype, copy=copy)
+        super(DihedralCoeffs, self).__init__(data=data, columns=['dType', 'Kchi', 'n', 'delta', 'Weighting_Factor'], dtype=dtype, copy=copy)
 
     def setFromNAMD(self, charmm, dihedrals):
         ''' Extracts info from PRM and PSF objects into self.
+            CHARMM dihedrals may have several terms (multiplicities) but
+            LAMMPS dihedral style charmm has one term per type, so the
+            dihedrals with n terms are listed n times in 'dihedrals', each
+            with the type of one term. Only the first term has a non-zero
+            weighting factor so that the 1-4 pair is counted once.
+            Dihedrals without parameters are removed.
 
         Parameter
         -----------------
@@ -1186,50 +1129,44 @@ class DihedralCoeffs(ForceField):
             NAMDdata object
 
         dihedrals : DihedralsDF
-            AnglesDF object associateed with these AngleCoeffs
+            DihedralsDF object associated with these DihedralCoeffs (modified)
         '''
+        import sys
 
-        # extract info from charmm
-        psf_types   = charmm.psf.atoms[['ID', 'Type']].set_index('ID').to_dict()['Type']
-
-        # substitute atoms numbers with charmm atom types
-
-        dihedrals     = dihedrals.copy()
-        dihedrals.Atom1 = dihedrals.Atom1.map(psf_types)
-        dihedrals.Atom2 = dihedrals.Atom2.map(psf_types)
-        dihedrals.Atom3 = dihedrals.Atom3.map(psf_types)
-        dihedrals.Atom4 = dihedrals.Atom4.map(psf_types)
-        dihedrals['atuple'] = list(zip(dihedrals.Atom1, dihedrals.Atom2, dihedrals.Atom3, dihedrals.Atom4))
-        dihedrals.drop(columns=['dID', 'Atom1', 'Atom2', 'Atom3', 'Atom4'], inplace=True)
-        dihedrals.drop_duplicates(inplace=True)
-        #print(dihedrals)
-
-        prmFF = charmm.prm.dihedrals.getCoeffs()
-
-        # add Kb and b0 to bonds
-        #dihedrals['Kchi'] = dihedrals.atuple.map(prmFF.Kchi.to_dict())
-        #dihedrals['n'] = dihedrals.atuple.map(prmFF.n.to_dict())
-        #dihedrals['delta'] = dihedrals.atuple.map(prmFF.delta.to_dict())
-        dihedrals['Kchi'] = dihedrals.atuple.apply(findWithX, args=(prmFF.Kchi.to_dict(),) )
-        dihedrals['n'] = dihedrals.atuple.apply(findWithX, args=(prmFF.n.to_dict(),) )
-        dihedrals['delta'] = dihedrals.atuple.apply(findWithX, args=(prmFF.delta.to_dict(),) )
-        #print(dihedrals)
-        dihedrals.drop(columns=['atuple'], inplace=True)
-        #print("\nDihedralCoeffs Nans:\n",dihedrals.isna().sum())
-
-        dihedrals = dihedrals.dropna()
-        dihedrals['Type'] = dihedrals.index = np.arange(1, len(dihedrals)+1)
-        dihedrals['Weighting_Factor'] = float(random.randint(0,2)/2)    #Is given randomly for now
-
-        dihedrals.rename(columns={'ID':'dType'}, inplace=True)
-        del dihedrals['Type']
-        
-        super(DihedralCoeffs, self).__init__(dihedrals.astype({'Kchi':float, 'n':int, 'delta':int,'Weighting_Factor':float}))
+        # one dihedral per type is enough to find its CHARMM types
+        first  = dihedrals.drop_duplicates(subset='dType')
+        tuples = typeTuples(charmm, first, ['Atom1', 'Atom2', 'Atom3', 'Atom4'])
+
+        # one search (with 'X' wildcards) per type
+        params = charmm.prm.dihedrals.getTerms()
+        found  = [findWithX(t, params) for t in tuples]
+        missing = [t for t, p in zip(tuples, found) if not isinstance(p, tuple)]
+        if missing:
+            sys.stderr.write("WARNING: no parameters for dihedrals {}, they will be removed.\n".format(missing))
+
+        # one LAMMPS type per term
+        terms = pd.DataFrame([(oldType, k, n, d, i) 
+                              for oldType, p in zip(first.dType.values, found) if isinstance(p, tuple)
+                              for i, (k, n, d) in enumerate(p)],
+                             columns=['oldType', 'Kchi', 'n', 'delta', 'term'])
+        terms['dType'] = np.arange(1, len(terms)+1)
+        terms['Weighting_Factor'] = np.where(terms.term == 0, 1.0, 0.0)
+        terms.index = terms.dType.values
+
+        expanded = dihedrals.rename(columns={'dType':'oldType'}).merge(
+                        terms[['oldType', 'term', 'dType']], on='oldType', sort=False)
+        expanded = expanded.sort_values(['dID', 'term'], kind='stable')
+        expanded['dID'] = np.arange(1, len(expanded)+1)
+        expanded.index = expanded.dID.values
+        pd.DataFrame.__init__(dihedrals, expanded[['dID', 'dType', 'Atom1', 'Atom2', 'Atom3', 'Atom4']])
+
+        super(DihedralCoeffs, self).__init__(terms[['dType', 'Kchi', 'n', 'delta', 'Weighting_Factor']].astype(
+                {'Kchi':float, 'n':int, 'delta':int, 'Weighting_Factor':float}))
 
 
 class ImproperCoeffs(ForceField):
     def __init__(self,data=None, dtype=None, copy=False):
-        super(ImproperCoeffs, self).__init__(data=data, columns=['iType', 'Kchi', 'n', 'delta'], dtype=dtype, copy=copy)
+        super(ImproperCoeffs, self).__init__(data=data, columns=['iType', 'Kpsi', 'psi0'], dtype=dtype, copy=copy)
 
     def setFromNAMD(self, charmm, impropers):
         ''' Extracts info from PRM and PSF objects into self.
@@ -1243,39 +1180,22 @@ class ImproperCoeffs(ForceField):
             AnglesDF object associateed with these AngleCoeffs
         '''
 
-        # extract info from charmm
-        psf_types   = charmm.psf.atoms[['ID', 'Type']].set_index('ID').to_dict()['Type']
-        #print(psf_types)
-
-        # substitute atoms numbers with charmm atom types
-
-        impropers     = impropers.copy()
-        impropers.Atom1 = impropers.Atom1.map(psf_types)
-        impropers.Atom2 = impropers.Atom2.map(psf_types)
-        impropers.Atom3 = impropers.Atom3.map(psf_types)
-        impropers.Atom4 = impropers.Atom4.map(psf_types)
-        impropers['atuple'] = list(zip(impropers.Atom1, impropers.Atom2, impropers.Atom3, impropers.Atom4))
-        impropers.drop(columns=['iID', 'Atom1', 'Atom2', 'Atom3', 'Atom4'], inplace=True)
-        impropers.drop_duplicates(inplace=True)
-        #print(impropers)
-
-        prmFF = charmm.prm.impropers.getCoeffs()
-        #print(prmFF)
-
-        # add Kb and b0 to bonds
-        impropers['Kpsi'] = impropers.atuple.apply(findWithX, args=(prmFF.Kpsi.to_dict(),) )
-        impropers['psi0'] = impropers.atuple.apply(findWithX, args=(prmFF.psi0.to_dict(),) )
-        #impropers['Kpsi'] = impropers.atuple.map(prmFF.Kpsi.to_dict())
-        #impropers['psi0'] = impropers.atuple.map(prmFF.psi0.to_dict())
-        #print(impropers)
-        impropers.drop(columns=['atuple'], inplace=True)
+        # one improper per type is enough to find its CHARMM types
+        first  = impropers.drop_duplicates(subset='iType')
+        tuples = typeTuples(charmm, first, ['Atom1', 'Atom2', 'Atom3', 'Atom4'])
+
+        # one search (with 'X' wildcards) per type
+        prmFF  = charmm.prm.impropers.getCoeffs()
+        params = dict(zip(prmFF.index, zip(prmFF.Kpsi, prmFF.psi0)))
+        found  = [findWithX(t, params) for t in tuples]
+        found  = [p if isinstance(p, tuple) else (np.nan, np.nan) for p in found]
+
+        impropers = pd.DataFrame(found, columns=['Kpsi', 'psi0'])
+        impropers.insert(0, 'iType', first.iType.values)
         #print("\nImproperCoeffs Nans:\n",impropers.isna().sum())
 
-        impropers['Type'] = impropers.index = np.arange(1, len(impropers)+1)
+        impropers.index = np.arange(1, len(impropers)+1)
 
-        impropers.rename(columns={'ID':'iType'}, inplace=True)
-        del impropers['Type']
-        
         super(ImproperCoeffs, self).__init__(impropers)
  
 
@@ -1311,10 +1231,26 @@ class LammpsData():
             self.read(file)
         
 
-    def read(self, filename):
+    def read(self, filename, compact=False, singlePrecision=False):
+        ''' reads a LAMMPS data file into self.
+
+            Parameter
+            ----------
+            filename : str or file-like object
+                name of file (gzip, bz2 or xz compressed files are accepted) or open stream
+
+            compact : bool
+                store IDs and types as int32 and image flags as int8
+                (see granules.structure.compact)
+
+            singlePrecision : bool
+                with compact, store coordinates as float32
+        '''
     
+        from granules.structure.streams import openStream
+
         #Abrir el archivo para leer datos
-        arch = open(filename, 'r')
+        arch = openStream(filename)
         serial = 1
         ind = 0
         num = []
@@ -1332,6 +1268,13 @@ class LammpsData():
             
             key = linea.strip()
             data = []
+
+            # box bounds
+            if key[-7:] in ["xlo xhi", "ylo yhi", "zlo zhi"]:
+                caja += [float(x) for x in key.split()[:2]]
+                if len(caja) == 6: self.region.setMinsMaxs(caja)
+                continue
+
             #Si encuentro la seccion deseada en el archivo
             if key in keywords:
             
@@ -1356,20 +1299,34 @@ class LammpsData():
                 if key == 'Pair Coeffs': self.forceField.pairCoeffs.add(data)
                 if key == 'Bond Coeffs': self.forceField.bondCoeffs.add(data)
                 if key == 'Angle Coeffs': self.forceField.angleCoeffs.add(data)                
-                if key == 'Dihedral Coeffs': self.topologia.dihedralCoeffs.add(data)
+                if key == 'Dihedral Coeffs': self.forceField.dihedralCoeffs.add(data)
                 if key == 'Improper Coeffs':self.forceField.improperCoeffs.add(data)
                 if key == 'Atoms': self.atomproperty.atoms.add(data)                
-                if key == 'Velociteies': self.atomproperty.velocities.add(data)   
+                if key == 'Velocities': self.atomproperty.velocities.add(data)   
                 if key == 'Bonds': self.topologia.bonds.add(data)
                 if key == 'Angles': self.topologia.angles.add(data)                
                 if key == 'Dihedrals': self.topologia.dihedrals.add(data)
                 if key == 'Impropers':self.topologia.impropers.add(data)                
               
         arch.close()                
+
+        if compact: self.compact(singlePrecision)
            
 
-    def loadNAMDdata(self, charmm):
-        ''' loads data from NAMDdata object into self.'''
+    def loadNAMDdata(self, charmm, compact=False, singlePrecision=False):
+        ''' loads data from NAMDdata object into self.
+
+            Parameter
+            ----------
+            charmm : NAMDdata
+                source structure and force field
+
+            compact : bool
+                store the resulting tables with compact column types
+
+            singlePrecision : bool
+                with compact, store coordinates as float32
+        '''
         #print("loadNAMDdata=",charmm.psf.dihedrals)
         
         #AtomPropertyData
@@ -1384,6 +1341,8 @@ class LammpsData():
         
         # MolecularTopologyData
         self.region.setFromNAMD(charmm)
+
+        if compact: self.compact(singlePrecision)
        
         '''
         self.pairCoeffs.setFromNAMD(charmm, self.masses)
@@ -1409,9 +1368,17 @@ class LammpsData():
 
 
     def writeConf(self, filename):
+        ''' writes self as a LAMMPS data file.
+
+            Parameter
+            ----------
+            filename : str or file-like object
+                name of file, compressed when it ends in .gz, .bz2 or .xz, or open stream
+        '''
         import sys
+        from granules.structure.streams import openStream
 
-        cfile = open(filename, "w")
+        cfile = openStream(filename, "w")
 
 
         # Sección automática
@@ -1544,106 +1511,209 @@ class LammpsData():
             cfile.write("\n")
         else:
             sys.stderr.write("WARNING: No impropers to write.\n")
+
+        cfile.close()
     
     
+    def compact(self, singlePrecision=False):
+        ''' converts IDs and types to int32 and image flags to int8 in place
+            (see granules.structure.compact).
+
+            Parameter
+            ----------
+            singlePrecision : bool
+                also store the coordinates and velocities as float32
+        '''
+        from granules.structure.compact import compactDtypes
+
+        for table in self.tables():
+            pd.DataFrame.__init__(table, compactDtypes(table, singlePrecision))
+
+    def tables(self):
+        ''' the atom-property, molecular topology and force field tables.'''
+        return [self.atomproperty.atoms, self.atomproperty.velocities, self.atomproperty.masses,
+                self.topologia.bonds, self.topologia.angles,
+                self.topologia.dihedrals, self.topologia.impropers,
+                self.forceField.pairCoeffs, self.forceField.bondCoeffs, self.forceField.angleCoeffs,
+                self.forceField.dihedralCoeffs, self.forceField.improperCoeffs]
+
+    def bytesPerAtom(self):
+        ''' memory used by all the tables divided by the number of atoms.'''
+        from granules.structure.compact import bytesPerAtom
+        return bytesPerAtom(len(self.atomproperty.atoms), *self.tables())
+
     def charmmForce(self):
         '''Hace una llamada a la funcion charmmForce() de la clase forceField() 
-            para poder printiar los datos.'''
+            y regresa las fuerzas (DataFrame indexado por aID).'''
         
-        print("LammpsData.charmmForce()")
-        self.forceField.charmmForce(self.atomproperty,self.topologia)
-
-    def append(self,other):
-        '''Une dos objetos de LammpsData, sus dataframes individuales'''
-        # OH YEAH
-        self.forceField.angleCoeffs = self.forceField.angleCoeffs.append(other.forceField.angleCoeffs)
-        self.forceField.bondCoeffs = self.forceField.bondCoeffs.append(other.forceField.bondCoeffs)
-        self.forceField.dihedralCoeffs = self.forceField.dihedralCoeffs.append(other.forceField.dihedralCoeffs)
-        self.forceField.improperCoeffs = self.forceField.improperCoeffs.append(other.forceField.improperCoeffs)
-        self.forceField.pairCoeffs = self.forceField.pairCoeffs.append(other.forceField.pairCoeffs)
-        #Oh YEaSH
-        self.atomproperty.atoms = self.atomproperty.atoms.append(other.atomproperty.atoms)
-        self.atomproperty.velocities = self.atomproperty.velocities.append(other.atomproperty.velocities)
-        self.atomproperty.masses = self.atomproperty.masses.append(other.atomproperty.masses)
-        #yeyeyeye
-        self.topologia.angles = self.topologia.angles.append(other.topologia.angles)
-        self.topologia.bonds = self.topologia.bonds.append(other.topologia.bonds)
-        self.topologia.dihedrals = self.topologia.dihedrals.append(other.topologia.dihedrals)
-        self.topologia.impropers = self.topologia.impropers.append(other.topologia.impropers)
+        return self.forceField.charmmForce(self.atomproperty,self.topologia,self.region.lengths())
 
-        
-    def copy(self):#modifica
+    def charmmEvaluate(self, virial=False, terms=None, inner=8.0, outer=10.0,
+                       electrostatics='charmm', alpha=0.2, epsilonRF=np.inf, pme=None):
+        ''' CHARMM energies, forces and, optionally, virial of self in one
+            pass, with periodic boundaries when the region defines a box
+            (see ForceFieldData.charmmEvaluate).
+        '''
+        return self.forceField.charmmEvaluate(self.atomproperty, self.topologia,
+                                              self.region.lengths(), virial, terms, inner, outer,
+                                              electrostatics, alpha, epsilonRF, pme)
+
+    def charmmDecomposition(self, groups=None, terms=None, inner=8.0, outer=10.0,
+                            electrostatics='charmm', alpha=0.2, epsilonRF=np.inf, pme=None):
+        ''' CHARMM energies per atom and between groups of atoms of self
+            (see ForceFieldData.charmmDecomposition).
+        '''
+        return self.forceField.charmmDecomposition(self.atomproperty, self.topologia, groups,
+                                                   self.region.lengths(), terms, inner, outer,
+                                                   electrostatics, alpha, epsilonRF, pme)
+
+    def charmmFrameEnergies(self, frames, chunk=100, terms=None, inner=8.0, outer=10.0,
+                            electrostatics='charmm', alpha=0.2, epsilonRF=np.inf, pme=None):
+        ''' CHARMM energies of each frame (F,N,3) of a trajectory of self,
+            one row per frame (see ForceFieldData.charmmFrameEnergies).
+        '''
+        return self.forceField.charmmFrameEnergies(self.atomproperty, self.topologia, frames,
+                                                   self.region.lengths(), chunk, terms, inner, outer,
+                                                   electrostatics, alpha, epsilonRF, pme)
+
+    def pressure(self, terms=None, inner=8.0, outer=10.0,
+                 electrostatics='charmm', alpha=0.2, epsilonRF=np.inf, pme=None):
+        ''' Pressure of self in atm, as LAMMPS compute pressure, from the
+            CHARMM virial, the velocities (A/fs) and masses of the atoms and
+            the volume of the region box. Parameters as in charmmEvaluate.
+
+            returns (pressure, DataFrame (3,3) with the pressure tensor)
+        '''
+        from granules.analysis.energy import kineticTensor, pressureTensor
+
+        if self.region.lengths() is None:
+            raise ValueError("pressure needs a periodic box in self.region")
+        W = self.charmmEvaluate(True, terms, inner, outer, electrostatics, alpha, epsilonRF, pme)[2]
+        kinetic = kineticTensor(self.atomproperty.atomVelocities(), self.atomproperty.atomMasses())
+        tensor = pressureTensor(W, self.region.volume(), kinetic)
+        return np.trace(tensor) / 3, pd.DataFrame(tensor, index=['x', 'y', 'z'], columns=['x', 'y', 'z'])
+
+    def minimize(self, method='fire', maxSteps=1000, etol=1e-8, ftol=0.1, **options):
+        ''' Relaxes the coordinates of self with the CHARMM force field
+            (see granules.simulation.minimize.minimize).
+        '''
+        from granules.simulation.minimize import minimize
+        return minimize(self, method, maxSteps, etol, ftol, **options)
+
+    def runDynamics(self, steps, dt=1.0, thermostat='langevin', temperature=300.0, **options):
+        ''' Runs velocity Verlet molecular dynamics of self with the CHARMM
+            force field (see granules.simulation.dynamics.runDynamics).
+
+            returns (DataFrame with the thermodynamic log, ns/day)
+        '''
+        from granules.simulation.dynamics import runDynamics
+        return runDynamics(self, steps, dt, thermostat, temperature, **options)
+
+    def fixShake(self, fixId='shake', group='all', **options):
+        ''' LAMMPS 'fix shake' command for the bonds to hydrogens and the
+            water angles of self (see granules.simulation.constraints.fixShake).
+        '''
+        from granules.simulation.constraints import fixShake
+        return fixShake(self, fixId, group, **options)
+
+    def repartitionHydrogenMass(self, hydrogenMass=3.024, **options):
+        ''' Moves mass from heavy atoms to their hydrogens, splitting atom
+            types as needed (see granules.transformation.hydrogenMass).
+        '''
+        from granules.transformation.hydrogenMass import repartitionHydrogenMass
+        return repartitionHydrogenMass(self, hydrogenMass, **options)
+
+    def reorder(self, curve='hilbert', keepMolecules=True, bits=10):
+        ''' Sorts and renumbers the atoms along a Hilbert or Morton curve
+            so that neighbors in space are neighbors in memory (see
+            granules.transformation.reorder).
+        '''
+        from granules.transformation.reorder import reorderAtoms
+        return reorderAtoms(self, curve, keepMolecules, bits)
+
+    def replicate(self, nx=1, ny=1, nz=1):
+        ''' Tiles the periodic system into nx * ny * nz copies with shifted
+            IDs, as the LAMMPS replicate command (see
+            granules.transformation.replicate).
+        '''
+        from granules.transformation.replicate import replicate
+        return replicate(self, nx, ny, nz)
+
+    def charmmIncremental(self, terms=None, skin=2.0, inner=8.0, outer=10.0,
+                          electrostatics='charmm', alpha=0.2, epsilonRF=np.inf):
+        ''' IncrementalEnergy of self for Monte Carlo moves and placement
+            scans (see ForceFieldData.charmmIncremental).
+        '''
+        return self.forceField.charmmIncremental(self.atomproperty, self.topologia,
+                                                 self.region.lengths(), terms, skin, inner, outer,
+                                                 electrostatics, alpha, epsilonRF)
+
+    def append(self, *others):
+        ''' Appends one or more LammpsData objects to self in one concatenation
+            per table, shifting their atom, molecule and term IDs and merging
+            types with equal parameters (see granules.transformation.merge).
+            The tables of self are replaced in place.
+        '''
+        from granules.transformation.merge import mergeSystems
+
+        merged = mergeSystems([self] + list(others))
+        for table, new in zip(self.tables(), merged.tables()):
+            pd.DataFrame.__init__(table, new)
+        self.region.setMinsMaxs(merged.region.maxsMins)
+
+    def copy(self, deep=True):
+        ''' Copy of self, with its own region.
+
+            Parameter
+            ----------
+            deep : bool
+                False shares data with self: the force field, masses and
+                topology tables are shallow copies and only atoms and
+                velocities, the tables that minimization, dynamics and
+                coordinate edits write into, are copied. Replacing whole
+                tables or columns, as the transformations in
+                granules.transformation do, leaves self untouched; writing
+                into a shared table (.loc, +=) also changes self.
+        '''
         ld = LammpsData()
-        # OH YEAH
-        ld.forceField.angleCoeffs = self.forceField.angleCoeffs.copy()
-        ld.forceField.bondCoeffs = self.forceField.bondCoeffs.copy()
-        ld.forceField.dihedralCoeffs = self.forceField.dihedralCoeffs.copy()
-        ld.forceField.improperCoeffs = self.forceField.improperCoeffs.copy()
-        ld.forceField.pairCoeffs = self.forceField.pairCoeffs.copy()
-        # OH YEAHHH
-        ld.atomproperty.atoms = self.atomproperty.atoms.copy()
-        ld.atomproperty.velocities = self.atomproperty.velocities.copy()
-        ld.atomproperty.masses = self.atomproperty.masses.copy()
-        # OH YEAHHH
-        ld.topologia.angles = self.topologia.angles.copy()
-        ld.topologia.bonds = self.topologia.bonds.copy()
-        ld.topologia.dihedrals = self.topologia.dihedrals.copy()
-        ld.topologia.impropers = self.topologia.impropers.copy()
-        
+        sections = [('forceField', ['angleCoeffs', 'bondCoeffs', 'dihedralCoeffs', 'improperCoeffs', 'pairCoeffs']),
+                    ('atomproperty', ['atoms', 'velocities', 'masses']),
+                    ('topologia', ['angles', 'bonds', 'dihedrals', 'impropers'])]
+        for section, names in sections:
+            for name in names:
+                table = getattr(getattr(self, section), name)
+                setattr(getattr(ld, section), name, table.copy(deep=deep or name in ['atoms', 'velocities']))
+        if self.region.maxsMins is not None:
+            ld.region.setMinsMaxs(list(self.region.maxsMins))
         return ld
     
-    def selectAtom(self,atomNumber):
-        '''Funcion que elimina un tipo de atomo deseado del dataframe'''
-        
-        # AtompropertyData 
-        #atoms
-        self.atomproperty.atoms.drop(self.atomproperty.atoms[self.atomproperty.atoms.aType == atomNumber].index, inplace=True)#elimina el atomo indicado
-        self.atomproperty.atoms.reset_index(inplace=True)#reset el index, crea una copia del index
-        self.atomproperty.atoms.drop(['index','aID'],axis = 1, inplace=True)#elimina la copia y la columna afectada
-        self.atomproperty.atoms.insert(0, "aID", [*range(1,len(self.atomproperty.atoms)+1)], True)#inserta columna nueva en la afectada("aID")
-        #velocity
-        self.atomproperty.velocities.drop(self.atomproperty.velocities.tail(166-len(self.atomproperty.atoms)).index,inplace = True) #elimina velocidades dependiendo a los atomos eliminados
-        #masses
-         #chequea
-         
-        #TopologiaData
-        #bonds
-        #Cambio para que busque en los Atomos enves de Type
-        self.topologia.bonds = self.topologia.bonds.ix[self.topologia.bonds['Atom1'] != atomNumber ]#devuelve los rows que no contengan el atomNumber
-        self.topologia.bonds = self.topologia.bonds.ix[self.topologia.bonds['Atom2'] != atomNumber ]#devuelve los rows que no contengan el atomNumber
-        self.topologia.bonds  = self.topologia.bonds.reset_index(drop=True)#resetea el indice y elimina la copia
-        self.topologia.bonds['bID'] = [i for i in range(1,len(self.topologia.bonds)+1 )]#resetea el indice en la columna 'bType'
-        #angles
-        self.topologia.angles = self.topologia.angles.ix[self.topologia.angles['Atom3'] != atomNumber ]#devuelve los rows que no contengan el atomNumber
-        self.topologia.bonds = self.topologia.bonds.ix[self.topologia.bonds['Atom1'] != atomNumber ]#devuelve los rows que no contengan el atomNumber
-        self.topologia.bonds = self.topologia.bonds.ix[self.topologia.bonds['Atom2'] != atomNumber ]#devuelve los rows que no contengan el atomNumber
-        self.topologia.angles  = self.topologia.angles.reset_index(drop=True)#resetea el indice y elimina la copia
-        self.topologia.angles['anID'] = [i for i in range(1,len(self.topologia.angles)+1 )]#resetea el indice en la columna 'anType'
-        #improper######modifica desde aqui
-        self.topologia.impropers = self.topologia.impropers.ix[self.topologia.impropers['iType'] != atomNumber ]#devuelve los rows que no contengan el atomNumber
-        self.topologia.impropers  = self.topologia.impropers.reset_index(drop=True)#resetea el indice y elimina la copia
-        self.topologia.impropers['iID'] = [i for i in range(1,len(self.topologia.impropers)+1 )]#resetea el indice en la columna 'iType'
-        #dihedral
-        self.topologia.dihedrals = self.topologia.dihedrals.ix[self.topologia.dihedrals['dType'] != atomNumber ]#devuelve los rows que no contengan el atomNumber
-        self.topologia.dihedrals  = self.topologia.dihedrals.reset_index(drop=True)#resetea el indice y elimina la copia
-        self.topologia.dihedrals['dID'] = [i for i in range(1,len(self.topologia.dihedrals)+1 )]#resetea el indice en la columna 'dType'
-        
-        #ForceFieldData 
-        #self.forceField.angleCoeffs
-            #Falta
-        
-        
-      
-       
+    def select(self, query, labels=None):
+        ''' Boolean mask over the atoms table of the atoms matched by 'query',
+            e.g. "type 1:3 and within 5 of mol 2" (see
+            granules.structure.selection; 'labels' from atomLabels give
+            names, residues, chains and segments).
+        '''
+        from granules.structure.selection import select
+        return select(self, query, labels)
 
-        
+    def subset(self, mask, labels=None, renumberTypes=True):
+        ''' New LammpsData with the atoms in 'mask' (boolean array or query
+            for select) and the terms among them, renumbered (see
+            granules.structure.selection.subset).
         '''
-        #forceFieldSectio composi
-        self.forceField = ForceFieldData()
-        # molecular topology sections
-        self.topologia = MolecularTopologyData()
+        from granules.structure.selection import subset
+        if isinstance(mask, str): mask = self.select(mask, labels)
+        return subset(self, mask, renumberTypes)
+
+    def selectAtom(self,atomNumber):
+        '''Funcion que elimina un tipo de atomo deseado del dataframe, con los
+            terminos que lo incluyen. Los tipos no cambian.
         '''
-      
+        sub = self.subset("not type {}".format(atomNumber), renumberTypes=False)
+        for table, new in zip(self.tables(), sub.tables()):
+            pd.DataFrame.__init__(table, new)
+
+
 _AVOGRADRO_CONSTANT_ = 6.02214129e+23
 
 class Region:
@@ -1729,13 +1799,12 @@ class Box(Region):
         '''
         
         try:
-            self.setMinsMaxs([charmm.pbc.cellOrigin[0],
-                              charmm.pbc.cellBasisVector1[0],
-                              charmm.pbc.cellOrigin[1],
-                              charmm.pbc.cellBasisVector2[1],
-                              charmm.pbc.cellOrigin[2],
-                              charmm.pbc.cellBasisVector3[2]
-                              ])
+            # NAMD's cellOrigin is the center of the cell
+            lengths = [charmm.pbc.cellBasisVector1[0],
+                       charmm.pbc.cellBasisVector2[1],
+                       charmm.pbc.cellBasisVector3[2]]
+            self.setMinsMaxs([x for o, l in zip(charmm.pbc.cellOrigin, lengths)
+                                for x in (o - l / 2, o + l / 2)])
         except: 
             self.setMinsMaxs(None)
 
@@ -1744,20 +1813,25 @@ class Box(Region):
 
         Parameter
         -----------------
-        filename : LAMMPS dump file
+        filename : LAMMPS dump file (may be compressed) or open stream
         '''
-        dump = open(filename, "r")
+        from granules.structure.streams import openStream
+
+        dump = openStream(filename)
         for linea in dump:
             if linea[:26] == "ITEM: BOX BOUNDS pp pp pp":
-                mismaxsstr = linea.readline().split(' ').append(
-                        linea.readline().split(' ')).append(
-                        linea.readline().split(' '))
+                mismaxsstr = next(dump).split() + next(dump).split() + next(dump).split()
                 self.setMinsMaxs([float(x) for x in mismaxsstr])
                 break
         dump.close()
 
     def setMinsMaxs(self, maxsMins):
         self.maxsMins = maxsMins
+
+    def lengths(self):
+        ''' box lengths along x, y and z (array), or None if the box is not defined.'''
+        if self.maxsMins is None: return None
+        return np.diff(np.array(self.maxsMins, dtype=float).reshape(3, 2), axis=1).ravel()
         
     def volume(self):
             '''
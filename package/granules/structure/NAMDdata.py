@@ -26,9 +26,79 @@
     USA National Science Foundation grant number DMR-0934195. 
 """
 
+import io
 import pandas as pd
 import numpy as np
 
+from granules.structure.compact import compactDtypes, bytesPerAtom
+from granules.structure.streams import openStream
+
+# covalent radii in Angstroms (Cordero et al., Dalton Trans. 2008)
+COVALENT_RADII = {'H':0.31, 'B':0.84, 'C':0.76, 'N':0.71, 'O':0.66, 'F':0.57,
+                  'NA':1.66, 'MG':1.41, 'SI':1.11, 'P':1.07, 'S':1.05, 'CL':1.02,
+                  'K':2.03, 'CA':1.76, 'MN':1.39, 'FE':1.32, 'CU':1.32, 'ZN':1.22,
+                  'SE':1.20, 'BR':1.20, 'I':1.39, 'LI':1.28}
+
+# value of each character in a hybrid-36 number, -1 for anything else
+_HY36_DIGITS = np.full(256, -1, dtype=np.int64)
+_HY36_DIGITS[48:58]  = np.arange(10)
+_HY36_DIGITS[65:91]  = np.arange(10, 36)
+_HY36_DIGITS[97:123] = np.arange(10, 36)
+
+
+def decodeHybrid36(field):
+    ''' Decodes fixed-width integers written in decimal or in the hybrid-36
+        encoding used by PDB files for serial numbers above 99,999 (A0000,
+        ..., ZZZZZ, a0000, ...) and residue numbers above 9,999.
+
+        Parameter
+        ----------
+        field : uint8 array (N, width)
+            characters of the field, one row per record
+
+        Returns
+            (values, valid) int64 and bool arrays. Blank and malformed fields
+            are not valid.
+    '''
+    field = np.asarray(field, dtype=np.uint8)
+    n, width = field.shape
+    digits = _HY36_DIGITS[field]
+    isDigit = (field >= 48) & (field <= 57)
+    minus   = field == 45
+    upper   = (field[:, 0] >= 65) & (field[:, 0] <= 90)
+    lower   = (field[:, 0] >= 97) & (field[:, 0] <= 122)
+
+    decimal = np.zeros(n, dtype=np.int64)
+    base36  = np.zeros(n, dtype=np.int64)
+    for k in range(width):
+        decimal = np.where(isDigit[:, k], decimal * 10 + digits[:, k], decimal)
+        base36  = base36 * 36 + digits[:, k]
+    decimal = np.where(minus.any(axis=1), -decimal, decimal)
+    decimalValid = np.all(isDigit | minus | (field == 32), axis=1) & isDigit.any(axis=1)
+
+    hybrid = base36 - 10 * 36**(width-1) + 10**width + np.where(lower, 26 * 36**(width-1), 0)
+    hybridValid = (upper | lower) & np.all(digits >= 0, axis=1)
+
+    return np.where(hybridValid, hybrid, decimal), hybridValid | decimalValid
+
+
+def encodeHybrid36(value, width):
+    ''' Returns 'value' as a 'width' characters string: decimal when it fits,
+        hybrid-36 otherwise (inverse of decodeHybrid36).
+    '''
+    if -10**(width-1) < value < 10**width: return str(value).rjust(width)
+    value -= 10**width
+    for letters in ["0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ", "0123456789abcdefghijklmnopqrstuvwxyz"]:
+        if value < 26 * 36**(width-1):
+            value += 10 * 36**(width-1)
+            code = ''
+            while value:
+                value, d = divmod(value, 36)
+                code = letters[d] + code
+            return code
+        value -= 26 * 36**(width-1)
+    raise ValueError("value too large for a hybrid-36 field of width {}".format(width))
+
 
 class PDB(pd.DataFrame):
     ''' Pandas DataFrame that stores data defined by the PDB format 
@@ -43,55 +113,83 @@ class PDB(pd.DataFrame):
                                            'Occupancy','TempFactor','Element','Charge']
         )
 
-    def readFile(self, filename):
+    def readFile(self, filename, compact=False, singlePrecision=False, useSerials=False):
         ''' reads PDB file and appends to self.
             Follows specifications of the atoms section in 
             http://www.wwpdb.org/documentation/file-format-content/format33/sect9.html#ATOM
+            Serial and residue numbers may be hybrid-36 encoded (large systems).
 
             Parameter
             ----------
-            filename : str
-                name of file
+            filename : str or file-like object
+                name of file (gzip, bz2 or xz compressed files are accepted) or open stream
+
+            compact : bool
+                store strings as categoricals and integers as int32
+                (see granules.structure.compact)
+
+            singlePrecision : bool
+                with compact, store coordinates as float32
+
+            useSerials : bool
+                take atom IDs from the serial numbers instead of numbering
+                the atoms 1, 2, ... in the order they appear
         '''
 
         #print("PDB.readFile(",filename,")")
         
-        #Abrir el archivo para leer datos
-        arch = open(filename, 'r')
-        data = []
-        
-        ranges = [6,5,1,4,1,3,1,1,4,1,3,8,8,8,6,6,10,2,2]
-        voidPositions = [0,6,11,20,27,66]
-        
-        atomID = 1
-        for linea in arch:
-            
-            #Solo queremos la informacion de átomos
-            if linea[:4] == 'ATOM' or linea[:4] == 'HETA': 
-                info = ['ATOM',atomID]
-                start = 0
-                stop = 0
-                        
-                for i in ranges:
-                    stop += i
-                    if start not in voidPositions:
-                        l = linea[start:stop].strip()
-                        #print('\nEn posicion',start+1,':',stop,'se encuentra ->>',l)
-                        if l == '' or l == '<0>': info.append(np.nan)
-                        else: info.append(l)
-                    start += i
-
-                #Cada vez anadir nueva informacion a los datos
-                #print(info)
-                data.append(info)
-                atomID += 1
-                       
+        #Abrir el archivo para leer datos, solo queremos la informacion de átomos
+        arch = openStream(filename)
+        lines = [linea.rstrip('\r\n')[:80].ljust(80) for linea in arch
+                 if linea[:4] == 'ATOM' or linea[:4] == 'HETA']
         arch.close() 
-        newTable = PDB(data=data)  
+
+        # one row of 80 characters per atom, fields are column ranges
+        records = np.frombuffer(''.join(lines).encode('latin-1', 'replace'),
+                                dtype=np.uint8).reshape(len(lines), 80)
+
+        def text(start, stop):
+            # decode only the distinct values
+            field = np.ascontiguousarray(records[:, start:stop]).view('S{}'.format(stop-start)).ravel()
+            codes, uniques = pd.factorize(field)
+            strings = np.array([u.decode('latin-1').strip() for u in uniques] + [''], dtype=object)
+            strings[(strings == '') | (strings == '<0>')] = np.nan
+            return strings[codes]
+
+        def number(start, stop):
+            field = np.ascontiguousarray(records[:, start:stop]).view('S{}'.format(stop-start)).ravel()
+            blank = np.all(records[:, start:stop] == 32, axis=1)
+            values = np.full(len(field), np.nan)
+            values[~blank] = field[~blank].astype(float)
+            return values
+
+        def integer(start, stop, name):
+            values, valid = decodeHybrid36(records[:, start:stop])
+            if not valid.all():
+                bad = lines[np.nonzero(~valid)[0][0]]
+                raise NAMDdataEsception("invalid {} in {}: {}".format(name, filename, bad.strip()))
+            return values
+
+        atomID = integer(6, 11, "serial number") if useSerials else np.arange(1, len(lines) + 1)
+        newTable = PDB(data={'RecName'   : np.full(len(lines), 'ATOM', dtype=object),
+                             'ID'        : atomID,
+                             'Name'      : text(12, 16),
+                             'AltLoc'    : text(16, 17),
+                             'ResName'   : text(17, 20),
+                             'ChainID'   : text(21, 22),
+                             'ResSeq'    : integer(22, 26, "residue number"),
+                             'iCode'     : text(26, 27),
+                             'x'         : number(30, 38),
+                             'y'         : number(38, 46),
+                             'z'         : number(46, 54),
+                             'Occupancy' : number(54, 60),
+                             'TempFactor': number(60, 66),
+                             'Element'   : text(76, 78),
+                             'Charge'    : text(78, 80)})
         #print(newTable)
 
         # set column types and append to existing table
-        super().__init__(data=self.append(newTable, ignore_index=True).astype(
+        table = self.append(newTable, ignore_index=True).astype(
                 {'ID'        :int,
                  'ResSeq'    :int,
                  'x'         :float,
@@ -101,7 +199,8 @@ class PDB(pd.DataFrame):
                  'TempFactor':float  
                  #'Charge'    :float 
                 })
-        )
+        if compact: table = compactDtypes(table, singlePrecision)
+        super().__init__(data=table)
 
         #print("PDB.readFile(",filename,") ... END")
 
@@ -135,13 +234,13 @@ class PBC():
 
             Parameter
             ----------
-            filename : str
-                name of file
+            filename : str or file-like object
+                name of file (may be compressed) or open stream
         '''
         import numpy as np
         
         #print("PBC.readFile(",filename,")")
-        xsc_file = open(filename, "r")
+        xsc_file = openStream(filename)
         for line in xsc_file:
             #print("PBC.readFile(",filename,") ... line = ", line)
             if line.strip()[0] != '#':
@@ -155,6 +254,7 @@ class PBC():
                 #print("PBC.readFile(",filename,") ... self.cellBasisVector2 = ", self.cellBasisVector2)
                 #print("PBC.readFile(",filename,") ... self.cellBasisVector3 = ", self.cellBasisVector3)
                 #print("PBC.readFile(",filename,") ... self.cellOrigin = ", self.cellOrigin)
+        xsc_file.close()
         #print("PBC.readFile(",filename,") ... END")
        
 class PSF:
@@ -171,75 +271,115 @@ class PSF:
         self.impropers = PSF.IMPHI()
         self.cross_terms = PSF.CRTERM()
 
-    def readFile(self, filename):
+    def readFile(self, filename, compact=False):
         ''' Reads data for all the sections in the PSF intto self.
+            Both the standard and the extended (PSF EXT) formats are accepted.
+            The file is read once, section after section.
 
             Parameters:
             -------------------
-            filename : str
-                psf file name
+            filename : str or file-like object
+                psf file name (may be compressed) or open stream
+
+            compact : bool
+                store strings as categoricals and integers as int32
+                (see granules.structure.compact)
         '''
         #print("PSF.readFile(",filename,")")
         
-        self.atoms.readSection(filename)
-        self.bonds.readSection(filename)
-        self.angles.readSection(filename)
-        self.dihedrals.readSection(filename)
-        self.impropers.readSection(filename)
-        self.cross_terms.readSection(filename)
+        arch = openStream(filename)
+        self.atoms.readSection(arch, compact)
+        self.bonds.readSection(arch)
+        self.angles.readSection(arch)
+        self.dihedrals.readSection(arch)
+        self.impropers.readSection(arch)
+        self.cross_terms.readSection(arch)
+        arch.close()
+
+        if compact:
+            for section in [self.bonds, self.angles, self.dihedrals, self.impropers, self.cross_terms]:
+                pd.DataFrame.__init__(section, compactDtypes(section))
         
         #print("PSF.readFile(",filename,") ... END")
 
     @staticmethod
     def readSection(filename, section, tupleLength, itemsPerLine):
         ''' reads the section of the PSF file specified in the parameter
-             'section'.
+             'section'. Open streams are read from their current position
+             and left after the section (or where they were if the section
+             is not found and the stream can seek).
 
             Parameter
             ----------
-            filename : str
-                name of file
+            filename : str or file-like object
+                name of file (may be compressed) or open stream
 
             section : str
                 one of "ATOM", "BOND", ...
 
+            tupleLength : int
+                how many values describe each atom, bond, angle, ...
+
             itemsPerLine : int
                 hoy many bonds, angles, ... are in each line
 
             Returns
-                lists of lists of values
+                array with one row per item: strings for the ATOM section,
+                atom numbers for the others
         '''
         
         #Abrir el archivo para leer datos
-        arch = open(filename, 'r')
-        data = []        
+        arch = openStream(filename)
+        start = arch.tell() if arch.seekable() else None
 
         # find desired section
-        for linea in arch:
+        linea = ''
+        for linea in iter(arch.readline, ''):
             if '!N'+section in linea: break
 
         #Obtener la cantidad de elementos, cae a 0 si no encontró la sección 
+        found = '!N'+section in linea
         try:
-            cantidad = int(linea[:9].strip())
-        except:
+            cantidad = int(linea.split('!')[0]) if found else 0
+        except ValueError:
             cantidad = 0    
+        if not found and start is not None: arch.seek(start)
+
+        # counts are written as I10 in PSF EXT files, I8 otherwise
+        extended = found and linea.index('!') > 9
         
         if cantidad % itemsPerLine == 0: cantLineas = cantidad // itemsPerLine
         else: cantLineas = cantidad // itemsPerLine + 1
         #print("cantLineas {0}: {1}".format(section,cantLineas))
 
-        for i in range(cantLineas):
-            linea = next(arch)
-            #Recoger la informacion mediante su posicion
-            info = linea.split()
-            for j in range(0,len(info), tupleLength):
-                #Cada vez anadir nueva informacion a los datos
-                data.append(info[j:j+tupleLength])  
-            #print(">", info)
-
+        lines = [arch.readline() for i in range(cantLineas)]
         arch.close()
+
+        tokens = ' '.join(lines).split()
+        if len(tokens) == cantidad * tupleLength:
+            data = np.array(tokens, dtype=object if section == "ATOM" else np.int64)
+        elif section == "ATOM":
+            # extra columns (CHEQ, DRUDE, ...) are ignored
+            data = np.array([linea.split()[:tupleLength] for linea in lines], dtype=object)
+        else:
+            # numbers that fill their field (I8, or I10 in PSF EXT) are not space separated
+            data = PSF.readFixedWidth(lines, 10 if extended else 8)[:cantidad * tupleLength]
         #print(data)
-        return data
+        return data.reshape(-1, tupleLength)
+
+    @staticmethod
+    def readFixedWidth(lines, width):
+        ''' parses lines of integers written in fields of 'width' characters.
+
+            Returns
+                int64 array of the values, blank fields are skipped
+        '''
+        lines  = [linea.rstrip('\r\n') for linea in lines]
+        length = -(-max(len(linea) for linea in lines) // width) * width
+        text   = ''.join(linea.ljust(length) for linea in lines)
+        fields = np.frombuffer(text.encode('latin-1', 'replace'), dtype=np.uint8).reshape(-1, width)
+        values, valid = decodeHybrid36(fields)
+        return values[valid]
     
 
     class ATOM(pd.DataFrame):
@@ -250,23 +390,28 @@ class PSF:
                         'ID','RecName','ChainID', 'ResName', 'Name', 
                         'Type', 'Charge', 'Mass', 'Unused'])
 
-        def readSection(self, filename):
+        def readSection(self, filename, compact=False):
             ''' reads the section of the ATOM section of PSF file specified in the parameter
                  'filename'.
     
                 Parameter
                 ----------
-                filename : str
-                    name of file
+                filename : str or file-like object
+                    name of file (may be compressed) or open stream
+
+                compact : bool
+                    store strings as categoricals and integers as int32
             '''
             newTable = PSF.ATOM(data=PSF.readSection(filename, "ATOM", 9, 1))  
 
             # set column types and append to existing table
-            super().__init__(data=self.append(newTable, ignore_index=True).astype({
+            table = self.append(newTable, ignore_index=True).astype({
                      'ID'     :int,
                      'Charge' :float,
                      'Mass'   :float
-                    }))
+                    })
+            if compact: table = compactDtypes(table)
+            super().__init__(data=table)
 
 
     class BOND(pd.DataFrame):
@@ -282,8 +427,8 @@ class PSF:
     
                 Parameter
                 ----------
-                filename : str
-                    name of file
+                filename : str or file-like object
+                    name of file (may be compressed) or open stream
             '''
             data=PSF.readSection(filename, "BOND", 2, 4)
             newTable = pd.DataFrame(data).dropna()
@@ -296,6 +441,60 @@ class PSF:
                      'atom2' :int
                     }))
 
+        def guessFromPDB(self, pdb, pbc=None, tolerance=0.45, minDistance=0.4):
+            ''' replaces self with bonds guessed from the atom distances in
+                'pdb'. Two atoms are bonded when their distance is between
+                'minDistance' and the sum of their covalent radii plus 'tolerance'.
+                Radii are taken from the Element column (or the first letter of
+                the atom name when Element is missing). Atoms that are alone in
+                their residue (ions) are never bonded.
+
+                Parameter
+                ----------
+                pdb : PDB
+                    atoms and coordinates
+
+                pbc : PBC or None
+                    periodic cell used for minimum image distances
+
+                tolerance : float
+                    added to the sum of covalent radii (Angstroms)
+
+                minDistance : float
+                    pairs closer than this are considered overlapping, not bonded
+            '''
+            import sys
+            from granules.structure.neighbors import CellList, boxLengths
+
+            elements = pdb['Element'].astype(object).where(pdb['Element'].notna(),
+                            pdb['Name'].astype(str).str.lstrip('0123456789').str[:1])
+            elements = elements.astype(str).str.upper()
+            radii = elements.map(COVALENT_RADII).values.astype(float)
+            unknown = np.isnan(radii)
+            if unknown.any():
+                sys.stderr.write("WARNING: no covalent radius for elements {}, those atoms "
+                                 "will not be bonded.\n".format(sorted(set(elements[unknown]))))
+
+            # single-atom residues are ions
+            residue = pdb.groupby(['ChainID', 'ResSeq', 'ResName'], dropna=False, sort=False,
+                                  observed=True)['ID'].transform('size')
+            radii[residue.values == 1] = np.nan
+
+            xyz = pdb[['x', 'y', 'z']].values.astype(float)
+            cutoff = 2 * np.nanmax(radii) + tolerance if (~np.isnan(radii)).any() else 0.0
+            if cutoff > 0:
+                i, j, r = CellList(xyz, cutoff, boxLengths(pbc)).pairs()
+                keep = (r < radii[i] + radii[j] + tolerance) & (r > minDistance)
+                i, j = i[keep], j[keep]
+            else:
+                i = j = np.array([], dtype=int)
+
+            ids = pdb['ID'].values
+            super().__init__(data=pd.DataFrame({'atom1':ids[i], 'atom2':ids[j]}).astype({
+                     'atom1'     :int,
+                     'atom2' :int
+                    }))
+
     class THETA(pd.DataFrame):
         ''' THETA section of the PSF file format specification.'''
 
@@ -309,8 +508,8 @@ class PSF:
     
                 Parameter
                 ----------
-                filename : str
-                    name of file
+                filename : str or file-like object
+                    name of file (may be compressed) or open stream
             '''
             data=PSF.readSection(filename, "THETA", 3,3)
             newTable = pd.DataFrame(data).dropna()
@@ -336,8 +535,8 @@ class PSF:
     
                 Parameter
                 ----------
-                filename : str
-                    name of file
+                filename : str or file-like object
+                    name of file (may be compressed) or open stream
             '''
             data=PSF.readSection(filename, "PHI", 4,2)
             if len(data) == 0:
@@ -373,8 +572,8 @@ class PSF:
     
                 Parameter
                 ----------
-                filename : str
-                    name of file
+                filename : str or file-like object
+                    name of file (may be compressed) or open stream
             '''
             data=PSF.readSection(filename, "IMPHI", 4,2)
             if len(data) == 0:
@@ -410,8 +609,8 @@ class PSF:
     
                 Parameter
                 ----------
-                filename : str
-                    name of file
+                filename : str or file-like object
+                    name of file (may be compressed) or open stream
             '''
             data=PSF.readSection(filename, "CRTERM", 4,2)
             if len(data) == 0:
@@ -448,28 +647,30 @@ class PRM:
 
             Parameters:
             -------------------
-            filename : str
-                prm file name
+            filename : str or file-like object
+                prm file name (may be compressed) or open stream
         '''
 
         #print("PRM.readFile(",filename,")")
-        self.bonds.readSection(filename)
-        self.angles.readSection(filename)
-        self.dihedrals.readSection(filename)
-        self.impropers.readSection(filename)
-        self.nonbonded.readSection(filename)
+        # every section is searched from the start, decompress only once
+        arch = openStream(filename)
+        text = io.StringIO(arch.read())
+        arch.close()
+        for section in [self.bonds, self.angles, self.dihedrals, self.impropers, self.nonbonded]:
+            text.seek(0)
+            section.readSection(text)
         #print("PRM.readFile(",filename,") ... END")
 
    
     @staticmethod
     def readSection(filename, section):
         ''' reads the section of the PRM file specified in the parameter
-             'section'.
+             'section'. Open streams are read from their current position.
 
             Parameter
             ----------
-            filename : str
-                name of file
+            filename : str or file-like object
+                name of file (may be compressed) or open stream
 
             section : str
                 a string in PRM.SECTIONS
@@ -479,7 +680,7 @@ class PRM:
         '''
         
         #Abrir el archivo para leer datos
-        arch = open(filename, 'r')
+        arch = openStream(filename)
         data = []       
 
         # find desired section
@@ -535,8 +736,8 @@ class PRM:
     
                 Parameter
                 ----------
-                filename : str
-                    name of file
+                filename : str or file-like object
+                    name of file (may be compressed) or open stream
             '''
 
             data = list()
@@ -590,8 +791,8 @@ class PRM:
     
                 Parameter
                 ----------
-                filename : str
-                    name of file
+                filename : str or file-like object
+                    name of file (may be compressed) or open stream
             '''
             newTable = PRM.BONDS(data=PRM.readSection(filename, "BONDS"))  
             super().__init__(data=self.append(newTable, ignore_index=True).astype({
@@ -624,8 +825,8 @@ class PRM:
     
                 Parameter
                 ----------
-                filename : str
-                    name of file
+                filename : str or file-like object
+                    name of file (may be compressed) or open stream
             '''
             data=PRM.readSection(filename, "ANGLES")
 
@@ -662,14 +863,26 @@ class PRM:
 
             return prmFF
 
+        def getTerms(self):
+            ''' Returns a dictionary with all the terms (Kchi, n, delta) of
+                each tuple of types, in both directions. A tuple listed more
+                than once with the same multiplicity keeps the last values.
+            '''
+            terms = {}
+            for row in zip(self.Type1, self.Type2, self.Type3, self.Type4, self.Kchi, self.n, self.delta):
+                terms.setdefault(tuple(row[:4]), {})[row[5]] = tuple(row[4:])
+            for key in list(terms.keys()):
+                terms.setdefault(key[::-1], terms[key])
+            return {key: tuple(byN.values()) for key, byN in terms.items()}
+
         def readSection(self, filename):
             ''' reads the DIHEDRALS section of the PRM file specified in the parameter
                  'section'.
     
                 Parameter
                 ----------
-                filename : str
-                    name of file
+                filename : str or file-like object
+                    name of file (may be compressed) or open stream
             '''
             newTable = PRM.DIHEDRALS(data=PRM.readSection(filename, "DIHEDRALS"))  
             super().__init__(data=self.append(newTable, ignore_index=True).astype({
@@ -702,8 +915,8 @@ class PRM:
     
                 Parameter
                 ----------
-                filename : str
-                    name of file
+                filename : str or file-like object
+                    name of file (may be compressed) or open stream
             '''
             newTable = PRM.IMPROPER(data=PRM.readSection(filename, "IMPROPER"))  
             super().__init__(data=self.append(newTable, ignore_index=True).astype({
@@ -720,7 +933,7 @@ class NAMDdataEsception(Exception):
 class NAMDdata:
     ''' Groups PDB, PRM and PSF objects.'''
 
-    def __init__(self, *files):
+    def __init__(self, *files, compact=False, singlePrecision=False):
         self.pdb = PDB()
         self.psf = PSF()
         self.prm = PRM()
@@ -728,9 +941,23 @@ class NAMDdata:
         self.network = None
         
         if files:
-            self.readFiles(*files)
+            self.readFiles(*files, compact=compact, singlePrecision=singlePrecision)
     
-    def readFiles(self, *files):
+    def readFiles(self, *files, compact=False, singlePrecision=False):
+        ''' Reads PDB, PSF, PRM and XSC files, recognized by their extensions.
+
+            Parameters:
+            -------------------
+            files : str
+                file names
+
+            compact : bool
+                store PDB and PSF tables with compact column types
+                (see granules.structure.compact)
+
+            singlePrecision : bool
+                with compact, store PDB coordinates as float32
+        '''
        
         if len(files) == 0:
             raise NAMDdataEsception("no files given to readFiles function")
@@ -739,16 +966,37 @@ class NAMDdata:
         else:
             for f in files:
                 if   ".pdb" in f:
-                    self.pdb.readFile(f)
+                    self.pdb.readFile(f, compact, singlePrecision)
                 elif ".psf" in f:
-                    self.psf.readFile(f)
+                    self.psf.readFile(f, compact)
                 elif ".prm" in f:
                     self.prm.readFile(f)
                 elif ".xsc" in f:
                     self.pbc.readFile(f)
-                else: 
+                else:
                     print("file:" + f + "does not have pdb, psf or prm as an extension")
 
+    def guessBonds(self, periodic=False, tolerance=0.45):
+        ''' Fills the PSF bonds section with bonds guessed from the PDB
+            coordinates. See PSF.BOND.guessFromPDB.
+
+            Parameters:
+            -------------------
+            periodic : bool
+                use minimum image distances in the cell read from the XSC file
+
+            tolerance : float
+                added to the sum of covalent radii (Angstroms)
+        '''
+        self.psf.bonds.guessFromPDB(self.pdb, self.pbc if periodic else None, tolerance)
+        return self.psf.bonds
+
+    def bytesPerAtom(self):
+        ''' memory used by the PDB and PSF tables divided by the number of atoms.'''
+        return bytesPerAtom(len(self.psf.atoms) or len(self.pdb), self.pdb, self.psf.atoms,
+                            self.psf.bonds, self.psf.angles, self.psf.dihedrals,
+                            self.psf.impropers, self.psf.cross_terms)
+
 
     def loadWolffia(self, wolffia):
         '''
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""-------------------------------------------------------------------------
+  compact.py
+  Part of granules Version 0.1.0, October, 2019
+
+
+    Copyright 2019: José O.  Sotero Esteva, Lyxaira M. Glass Rivera,
+    Computational Science Group, Department of Mathematics,
+    University of Puerto Rico at Humacao
+    <jose.sotero@upr.edu>.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License version 3 as published by
+    the Free Software Foundation.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program (gpl.txt).  If not, see <http://www.gnu.org/licenses/>.
+
+    Acknowledgements: The main funding source for this project has been provided
+    by the UPR-Penn Partnership for Research and Education in Materials program,
+    USA National Science Foundation grant number DMR-0934195.
+"""
+
+import pandas as pd
+import numpy as np
+
+COORDINATES  = ['x', 'y', 'z']
+IMAGE_FLAGS  = ['Nx', 'Ny', 'Nz']
+VELOCITIES   = ['Vx', 'Vy', 'Vz']
+
+
+def compactDtypes(table, singlePrecision=False):
+    ''' Returns a copy of 'table' with compact column types:
+        string columns become categoricals, integer columns (IDs, types)
+        int32 and image flags int8 whenever their values fit. Other float
+        columns are kept as float64.
+
+        Parameter
+        ----------
+        table : DataFrame
+            PDB, PSF or LAMMPS table
+
+        singlePrecision : bool
+            also store coordinates and velocities as float32
+    '''
+    types = {}
+    for col in table.columns:
+        values = table[col]
+        if values.dtype == object:
+            # many different strings are cheaper as plain objects
+            if values.nunique(dropna=True) <= len(values) // 2:
+                types[col] = 'category'
+        elif pd.api.types.is_integer_dtype(values.dtype) and len(values):
+            smallest = np.int8 if col in IMAGE_FLAGS else np.int32
+            info = np.iinfo(smallest)
+            if values.min() >= info.min and values.max() <= info.max:
+                types[col] = smallest
+            elif smallest == np.int8:
+                types[col] = np.int32
+        elif singlePrecision and col in COORDINATES + VELOCITIES:
+            types[col] = np.float32
+
+    return table.astype(types)
+
+
+def bytesPerAtom(natoms, *tables):
+    ''' memory used by 'tables' (including strings) divided by 'natoms'.'''
+    return sum(t.memory_usage(index=True, deep=True).sum() for t in tables) / max(natoms, 1)
+
+
+def uniqueBytes(*tables):
+    ''' memory of the column data of 'tables', counting once the arrays
+        shared by several of them (shallow copies, LammpsData.copy(deep=False)).
+    '''
+    seen = {}
+    for t in tables:
+        for col in t.columns:
+            values = t[col].values
+            key = (values.__array_interface__['data'][0], values.nbytes) \
+                  if isinstance(values, np.ndarray) else id(values)
+            seen[key] = values.nbytes
+    return sum(seen.values())
+
+
+#=============================================================================
+if __name__ == "__main__":  # tests
+    import os
+    from granules.structure.NAMDdata import NAMDdata
+
+    os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tests", "tubes"))
+    for compact, single in [(False, False), (True, False), (True, True)]:
+        ch = NAMDdata()
+        ch.pdb.readFile("tubos.pdb", compact=compact, singlePrecision=single)
+        ch.psf.readFile("tubos.psf", compact=compact)
+        print("compact={!s:5} float32={!s:5}: {:6.1f} bytes per atom (PDB + PSF atoms)".format(
+              compact, single, bytesPerAtom(len(ch.pdb), ch.pdb, ch.psf.atoms)))
+
+    ch = NAMDdata("tubos.pdb", "tubos.psf", "tubos.prm")
+    from granules.structure.LAMMPSdata import LammpsData
+    ld = LammpsData()
+    ld.loadNAMDdata(ch)
+    print("LAMMPS tables: {:6.1f} bytes per atom".format(ld.bytesPerAtom()), end=' -> ')
+    ld.compact(singlePrecision=True)
+    print("{:6.1f} compact".format(ld.bytesPerAtom()))
+
+    # variants that only move the atoms share everything else with the original
+    x = ld.atomproperty.atoms.x.values.copy()
+    for deep in [True, False]:
+        variants = [ld.copy(deep=deep) for _ in range(24)]
+        for k, v in enumerate(variants):
+            v.atomproperty.atoms['x'] += k
+            v.topologia.bonds['bID'] = v.topologia.bonds.bID.values[::-1]
+        total = uniqueBytes(*[t for l in [ld] + variants for t in l.tables()])
+        print("original + 24 modified copies, deep={!s:5}: {:5.1f} MB ({:4.1f} times the original)".format(
+              deep, total / 1e6, total / uniqueBytes(*ld.tables())))
+    assert (ld.atomproperty.atoms.x.values == x).all() and ld.topologia.bonds.bID.is_monotonic_increasing
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""-------------------------------------------------------------------------
+  neighbors.py
+  Part of granules Version 0.1.0, October, 2019
+
+
+    Copyright 2019: José O.  Sotero Esteva, Lyxaira M. Glass Rivera,
+    Computational Science Group, Department of Mathematics,
+    University of Puerto Rico at Humacao
+    <jose.sotero@upr.edu>.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License version 3 as published by
+    the Free Software Foundation.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program (gpl.txt).  If not, see <http://www.gnu.org/licenses/>.
+
+    Acknowledgements: The main funding source for this project has been provided
+    by the UPR-Penn Partnership for Research and Education in Materials program,
+    USA National Science Foundation grant number DMR-0934195.
+"""
+
+import numpy as np
+
+
+class CellList:
+    ''' Spatial index that bins atoms in cubic cells at least 'cutoff' wide
+        so that every pair closer than the cutoff lies in neighboring cells.
+        All searches are done with NumPy array operations, one pass per
+        neighbor cell offset.
+
+        Parameters
+        ----------
+        xyz : array (N,3)
+            atom coordinates
+
+        cutoff : float
+            minimum cell width
+
+        box : array of 3 floats or None
+            lengths of an orthorhombic periodic cell. None means no
+            periodic boundary conditions.
+    '''
+
+    MAX_CELLS_PER_ATOM = 4   # caps memory for sparse systems
+
+    def __init__(self, xyz, cutoff, box=None):
+        xyz = np.asarray(xyz, dtype=float).reshape(-1, 3)
+        self.xyz    = xyz
+        self.cutoff = float(cutoff)
+        self.box    = None if box is None else np.asarray(box, dtype=float).reshape(3)
+
+        if self.box is None:
+            self.origin = xyz.min(axis=0) if len(xyz) else np.zeros(3)
+            span        = (xyz.max(axis=0) - self.origin) if len(xyz) else np.zeros(3)
+            width       = self._cellWidth(span)
+            self.ncells = np.floor(span / width).astype(int) + 1
+            self.width  = np.full(3, width)
+        else:
+            self.origin = np.zeros(3)
+            width       = self._cellWidth(self.box)
+            self.ncells = np.maximum(np.floor(self.box / width).astype(int), 1)
+            self.width  = self.box / self.ncells
+
+        cells        = self.cellOf(xyz)
+        flat         = self._flatten(cells)
+        self.order   = np.argsort(flat, kind='stable')
+        self.counts  = np.bincount(flat, minlength=int(np.prod(self.ncells)))
+        self.starts  = np.cumsum(self.counts) - self.counts
+
+    def _cellWidth(self, span):
+        ''' cell width: the cutoff, enlarged when the grid would be too sparse.'''
+        natoms = max(len(self.xyz), 1)
+        volume = np.prod(np.maximum(span, self.cutoff))
+        return max(self.cutoff, (volume / (self.MAX_CELLS_PER_ATOM * natoms)) ** (1.0/3))
+
+    def _flatten(self, cells):
+        return (cells[:, 0] * self.ncells[1] + cells[:, 1]) * self.ncells[2] + cells[:, 2]
+
+    def cellOf(self, xyz):
+        ''' integer cell coordinates (N,3) of the points in 'xyz'.'''
+        rel = np.asarray(xyz, dtype=float).reshape(-1, 3) - self.origin
+        if self.box is not None: rel = np.mod(rel, self.box)
+        return np.clip(np.floor(rel / self.width).astype(int), 0, self.ncells - 1)
+
+    def minimumImage(self, d):
+        ''' applies the minimum image convention to difference vectors d.'''
+        if self.box is None: return d
+        return d - self.box * np.round(d / self.box)
+
+    def _shifts(self, shells):
+        ''' cell offsets to visit along each dimension, without repetitions.'''
+        shifts = []
+        for dim in range(3):
+            s = np.arange(-shells, shells + 1)
+            if self.box is not None and self.ncells[dim] < len(s):
+                # small periodic grids would visit the same cell twice
+                s = np.unique(np.mod(s, self.ncells[dim]))
+            shifts.append(s)
+        return shifts
+
+    def _candidates(self, qcells, shift):
+        ''' for query points in cells 'qcells' returns (query index, atom index)
+            for every atom in the cell displaced by 'shift'.
+        '''
+        nc = qcells + shift
+        if self.box is None:
+            valid = np.all((nc >= 0) & (nc < self.ncells), axis=1)
+        else:
+            nc    = np.mod(nc, self.ncells)
+            valid = np.ones(len(nc), dtype=bool)
+        qidx = np.nonzero(valid)[0]
+        flat = self._flatten(nc[valid])
+        cnt  = self.counts[flat]
+        total = cnt.sum()
+        qrep = np.repeat(qidx, cnt)
+        pos  = np.repeat(self.starts[flat] - (np.cumsum(cnt) - cnt), cnt) + np.arange(total)
+        return qrep, self.order[pos]
+
+    def query(self, points, radius=None):
+        ''' finds the atoms closer than 'radius' (default: the cutoff) to each point.
+
+            Returns
+                (point index, atom index, distance) arrays
+        '''
+        radius = self.cutoff if radius is None else float(radius)
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        qcells = self.cellOf(points)
+        shells = int(np.ceil(radius / self.width.min()))
+        sx, sy, sz = self._shifts(shells)
+
+        found = ([], [], [])
+        for dx in sx:
+            for dy in sy:
+                for dz in sz:
+                    q, a = self._candidates(qcells, np.array([dx, dy, dz]))
+                    r = np.sqrt(np.sum(self.minimumImage(self.xyz[a] - points[q]) ** 2, axis=1))
+                    keep = r < radius
+                    for lst, arr in zip(found, (q, a, r)): lst.append(arr[keep])
+        return tuple(np.concatenate(lst) for lst in found)
+
+    def pairs(self, cutoff=None):
+        ''' all pairs (i, j) with i < j closer than 'cutoff' (default: the
+            cutoff used to build the list; must not be larger).
+
+            Returns
+                (i, j, rij) arrays
+        '''
+        cutoff = self.cutoff if cutoff is None else float(cutoff)
+        if cutoff > self.width.min():
+            raise ValueError("cutoff larger than the cell width of this CellList")
+        cells = self.cellOf(self.xyz)
+        sx, sy, sz = self._shifts(1)
+        shifts = [np.array([dx, dy, dz]) for dx in sx for dy in sy for dz in sz]
+
+        # half shell: each pair of distinct cells is visited once, unless a
+        # small periodic grid makes opposite offsets land on the same cell
+        halfShell = self.box is None or np.all(self.ncells >= 3)
+        if halfShell:
+            shifts = [s for s in shifts if tuple(s) >= (0, 0, 0)]
+
+        found = ([], [], [])
+        for shift in shifts:
+            i, j = self._candidates(cells, shift)
+            if not halfShell or not shift.any():
+                half = i < j
+                i, j = i[half], j[half]
+            r = np.sqrt(np.sum(self.minimumImage(self.xyz[j] - self.xyz[i]) ** 2, axis=1))
+            keep = r < cutoff
+            for lst, arr in zip(found, (i, j, r)): lst.append(arr[keep])
+        i, j, r = (np.concatenate(lst) for lst in found)
+        i, j = np.minimum(i, j), np.maximum(i, j)
+        order = np.lexsort((j, i))
+        return i[order], j[order], r[order]
+
+
+def boxLengths(pbc):
+    ''' Returns the lengths of an orthorhombic cell defined by a NAMDdata.PBC
+        object, or None if the PBC has no cell vectors.
+    '''
+    if pbc is None or pbc.cellBasisVector1 is None: return None
+    cell = np.array([pbc.cellBasisVector1, pbc.cellBasisVector2, pbc.cellBasisVector3], dtype=float)
+    if np.any(np.abs(cell - np.diag(np.diag(cell))) > 1e-8):
+        raise ValueError("only orthorhombic periodic cells are supported")
+    return np.diag(cell).copy()
+
+
+#=============================================================================
+if __name__ == "__main__":  # tests
+    import time
+
+    # random gas with the density of liquid water
+    natoms = 1000000
+    side   = (natoms / 0.1) ** (1.0/3)
+    xyz    = np.random.default_rng(7).uniform(0, side, (natoms, 3))
+
+    start = time.time()
+    cl = CellList(xyz, 2.0, box=[side, side, side])
+    i, j, r = cl.pairs()
+    print("{} atoms, {} pairs < 2.0 A in {:.2f} s".format(natoms, len(i), time.time() - start))
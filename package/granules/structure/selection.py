@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+"""-------------------------------------------------------------------------
+  selection.py
+  Part of granules Version 0.1.0, October, 2019
+
+
+    Copyright 2019: José O.  Sotero Esteva, Lyxaira M. Glass Rivera,
+    Computational Science Group, Department of Mathematics,
+    University of Puerto Rico at Humacao
+    <jose.sotero@upr.edu>.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License version 3 as published by
+    the Free Software Foundation.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program (gpl.txt).  If not, see <http://www.gnu.org/licenses/>.
+
+    Acknowledgements: The main funding source for this project has been provided
+    by the UPR-Penn Partnership for Research and Education in Materials program,
+    USA National Science Foundation grant number DMR-0934195.
+"""
+
+
+import re
+import numpy as np
+import pandas as pd
+
+from granules.transformation.reorder import TERM_TABLES
+from granules.transformation.merge import COEFF_TABLES
+
+# keyword: (table, column); 'labels' columns come from atomLabels
+KEYWORDS = {'id':       ('atoms',  'aID'),
+            'type':     ('atoms',  'aType'),
+            'mol':      ('atoms',  'Mol_ID'),
+            'molecule': ('atoms',  'Mol_ID'),
+            'charge':   ('atoms',  'Q'),
+            'x':        ('atoms',  'x'),
+            'y':        ('atoms',  'y'),
+            'z':        ('atoms',  'z'),
+            'name':     ('labels', 'name'),
+            'resname':  ('labels', 'resname'),
+            'resid':    ('labels', 'resid'),
+            'residue':  ('labels', 'resid'),
+            'chain':    ('labels', 'chain'),
+            'segment':  ('labels', 'segment'),
+            'segid':    ('labels', 'segment')}
+
+COMPARISONS = {'<': np.less, '<=': np.less_equal, '>': np.greater, '>=': np.greater_equal,
+               '==': np.equal, '!=': np.not_equal}
+
+TOKEN = re.compile(r"\s*(<=|>=|==|!=|[()<>:]|[^\s()<>=!:]+)")
+
+
+def atomLabels(charmm):
+    ''' Per-atom names, residues, chains and segments of a NAMDdata object,
+        indexed by atom ID, for the 'name', 'resname', 'resid', 'chain' and
+        'segment' keywords of select().
+    '''
+    pdb = charmm.pdb.set_index('ID')
+    labels = pd.DataFrame({'name':    pdb.Name.astype(str),
+                           'resname': pdb.ResName.astype(str),
+                           'resid':   pdb.ResSeq.astype(int),
+                           'chain':   pdb.ChainID.astype(str)}, index=pdb.index)
+    segment = charmm.psf.atoms.set_index('ID').RecName.astype(str)
+    labels['segment'] = segment.reindex(labels.index).values
+    labels.index.name = 'aID'
+    return labels
+
+
+class SelectionParser:
+    ''' Recursive descent parser of atom selections that evaluates each
+        term to a boolean mask over the rows of the atoms table:
+
+            selection := term ('or' term)*
+            term      := factor ('and' factor)*
+            factor    := 'not' factor | '(' selection ')' | 'all' | 'none'
+                       | 'within' R 'of' factor
+                       | keyword op number            (op: < <= > >= == !=)
+                       | keyword value ...            (value: v, a:b or a to b)
+
+        e.g. "resname TYR TRP and not name N C O", "type 1:3",
+             "within 5 of (resid 10 and chain A)", "z > 20 and mol 2".
+    '''
+
+    def __init__(self, atoms, labels=None, box=None):
+        self.atoms  = atoms
+        self.labels = None if labels is None else labels.reindex(atoms.aID.values)
+        self.box    = box
+
+    def parse(self, query):
+        ''' boolean mask (array) of the atoms selected by the string 'query'.'''
+        self.query  = query
+        self.tokens = TOKEN.findall(query)
+        if "".join(self.tokens) != re.sub(r"\s", "", query):
+            raise ValueError("cannot read selection '{}'".format(query))
+        self.position = 0
+        mask = self._selection()
+        if self._peek() is not None: self._error()
+        return mask
+
+    def _peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def _next(self):
+        token = self._peek()
+        if token is None: self._error("unexpected end")
+        self.position += 1
+        return token
+
+    def _error(self, what=None):
+        what = what or "unexpected '{}'".format(self._peek())
+        raise ValueError("{} in selection '{}'".format(what, self.query))
+
+    def _selection(self):
+        mask = self._term()
+        while self._peek() == 'or':
+            self._next()
+            mask = mask | self._term()
+        return mask
+
+    def _term(self):
+        mask = self._factor()
+        while self._peek() == 'and':
+            self._next()
+            mask = mask & self._factor()
+        return mask
+
+    def _factor(self):
+        token = self._next()
+        if token == 'not': return ~self._factor()
+        if token == '(':
+            mask = self._selection()
+            if self._next() != ')': self._error("missing ')'")
+            return mask
+        if token == 'all':  return np.ones(len(self.atoms), dtype=bool)
+        if token == 'none': return np.zeros(len(self.atoms), dtype=bool)
+        if token == 'within':
+            radius = self._number(self._next())
+            if self._next() != 'of': self._error("expected 'of'")
+            return self._within(radius, self._factor())
+        if token in KEYWORDS: return self._match(token)
+        self.position -= 1
+        self._error()
+
+    def _number(self, token):
+        try:
+            return float(token)
+        except ValueError:
+            self._error("expected a number, got '{}'".format(token))
+
+    def _column(self, keyword):
+        table, column = KEYWORDS[keyword]
+        if table == 'labels':
+            if self.labels is None:
+                raise ValueError("'{}' needs atom labels (atomLabels) in selection '{}'".format(keyword, self.query))
+            return self.labels[column].values
+        return self.atoms[column].values
+
+    def _match(self, keyword):
+        values = self._column(keyword)
+        numeric = np.issubdtype(values.dtype, np.number)
+        if self._peek() in COMPARISONS:
+            if not numeric: self._error("'{}' is not numeric".format(keyword))
+            op = COMPARISONS[self._next()]
+            return op(values, self._number(self._next()))
+
+        singles, mask, count = [], np.zeros(len(values), dtype=bool), 0
+        while self._peek() not in (None, 'and', 'or', ')'):
+            count += 1
+            first = self._next()
+            if self._peek() in (':', 'to'):
+                self._next()
+                if not numeric: self._error("ranges need a numeric keyword, not '{}'".format(keyword))
+                mask |= (values >= self._number(first)) & (values <= self._number(self._next()))
+            else:
+                singles.append(self._number(first) if numeric else first)
+        if count == 0:
+            self._error("no values for '{}'".format(keyword))
+        return mask | np.isin(values, singles)
+
+    def _within(self, radius, mask):
+        from granules.structure.neighbors import CellList
+
+        result = mask.copy()
+        if mask.any():
+            xyz = self.atoms[['x', 'y', 'z']].values.astype(float)
+            found = CellList(xyz, radius, self.box).query(xyz[mask], radius)[1]
+            result[found] = True
+        return result
+
+
+def select(lammpsdata, query, labels=None):
+    ''' Boolean mask over lammpsdata.atomproperty.atoms of the atoms that
+        match 'query' (see SelectionParser). 'within' searches use a
+        CellList, with periodic boundaries when the region defines a box.
+
+        Parameter
+        ----------
+        lammpsdata : LammpsData
+
+        query : str
+
+        labels : DataFrame or None
+            per-atom names, residues, chains and segments indexed by atom
+            ID (atomLabels), needed by the keywords that use them
+
+        returns bool array
+    '''
+    return SelectionParser(lammpsdata.atomproperty.atoms, labels, lammpsdata.region.lengths()).parse(query)
+
+
+def renumbering(old, keep=None):
+    ''' array that maps the old IDs 'old[keep]' (all of them by default)
+        to 1..M, in order, and every other ID up to max(old) to 0.
+    '''
+    old = np.asarray(old, dtype=np.int64)
+    if keep is not None: old = old[keep]
+    new = np.zeros(old.max(initial=0) + 1, dtype=np.int64)
+    new[old] = np.arange(1, len(old) + 1)
+    return new
+
+
+def lookup(new, ids):
+    ''' new[ids], 0 for IDs beyond the end of 'new'.'''
+    ids = np.asarray(ids, dtype=np.int64)
+    inside = (ids >= 0) & (ids < len(new))
+    result = np.zeros(ids.shape, dtype=np.int64)
+    result[inside] = new[ids[inside]]
+    return result
+
+
+def subset(lammpsdata, mask, renumberTypes=True):
+    ''' New LammpsData with the atoms in 'mask' and the velocities, bonds,
+        angles, dihedrals and impropers whose atoms are all selected. Atom
+        and term IDs are renumbered 1..M with one renumbering array each.
+
+        Parameter
+        ----------
+        lammpsdata : LammpsData
+
+        mask : bool array over lammpsdata.atomproperty.atoms
+
+        renumberTypes : bool
+            keep only the types used by the selected atoms and terms,
+            renumbered 1..T, with their masses and coefficients; otherwise
+            the type tables are copied unchanged
+
+        returns LammpsData
+    '''
+    from granules.structure.LAMMPSdata import LammpsData
+
+    prop, top, ff = lammpsdata.atomproperty, lammpsdata.topologia, lammpsdata.forceField
+    atoms = prop.atoms
+    mask  = np.asarray(mask, dtype=bool)
+    if mask.shape != (len(atoms),):
+        raise ValueError("the mask has {} values for {} atoms".format(mask.size, len(atoms)))
+    result = LammpsData()
+
+    def replace(table, frame):
+        # fill the empty tables of result in place, as LammpsData.compact
+        pd.DataFrame.__init__(table, frame.reset_index(drop=True))
+
+    def renumbered(table, typeColumn, newType, columns=None):
+        ''' rows of a type table whose types are kept, with the new types.'''
+        columns = columns or [typeColumn]
+        kept = table[lookup(newType, table[typeColumn].values) > 0].copy()
+        for c in columns: kept[c] = lookup(newType, kept[c].values).astype(table[c].dtype)
+        return kept
+
+    newID = renumbering(atoms.aID.values, mask)
+    table = atoms[mask].copy()
+    table['aID'] = lookup(newID, table.aID.values).astype(atoms.aID.dtype)
+
+    types = table.aType.values.astype(np.int64)
+    newType = renumbering(np.unique(types)) if renumberTypes else None
+    if renumberTypes: table['aType'] = lookup(newType, types).astype(atoms.aType.dtype)
+    replace(result.atomproperty.atoms, table)
+
+    velocities = prop.velocities
+    vID = lookup(newID, velocities.vID.values)
+    table = velocities[vID > 0].copy()
+    table['vID'] = vID[vID > 0].astype(velocities.vID.dtype)
+    replace(result.atomproperty.velocities, table)
+
+    if renumberTypes:
+        replace(result.atomproperty.masses, renumbered(prop.masses, 'aType', newType))
+        replace(result.forceField.pairCoeffs, renumbered(ff.pairCoeffs, 'aType', newType, ['aType', 'aType2']))
+    else:
+        replace(result.atomproperty.masses, prop.masses.copy())
+        replace(result.forceField.pairCoeffs, ff.pairCoeffs.copy())
+
+    for name, (idColumn, columns) in TERM_TABLES.items():
+        coeffName, typeColumn = COEFF_TABLES[name]
+        terms = getattr(top, name)
+        ids = lookup(newID, terms[columns].values)
+        keep = np.all(ids > 0, axis=1)
+        table = terms[keep].copy()
+        for k, c in enumerate(columns): table[c] = ids[keep, k].astype(terms[c].dtype)
+        table[idColumn] = np.arange(1, len(table) + 1).astype(terms[idColumn].dtype)
+        coeffs = getattr(ff, coeffName)
+        if renumberTypes:
+            types = table[typeColumn].values.astype(np.int64)
+            newTermType = renumbering(np.unique(types))
+            table[typeColumn] = lookup(newTermType, types).astype(terms[typeColumn].dtype)
+            coeffs = renumbered(coeffs, typeColumn, newTermType)
+        replace(getattr(result.topologia, name), table)
+        replace(getattr(result.forceField, coeffName), coeffs.copy())
+
+    if lammpsdata.region.maxsMins is not None:
+        result.region.setMinsMaxs(list(lammpsdata.region.maxsMins))
+    return result
+
+
+#=============================================================================
+if __name__ == "__main__":  # tests
+    import os
+    from granules.structure.NAMDdata import NAMDdata
+    from granules.structure.LAMMPSdata import LammpsData
+
+    os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tests", "chignolin"))
+    ch = NAMDdata("2rvd_autopsf.pdb", "2rvd_autopsf.psf", "par_all36_prot.prm")
+    l = LammpsData()
+    l.loadNAMDdata(ch)
+    labels = atomLabels(ch)
+
+    for query in ["all", "resname TYR TRP and name CA", "resid 1:3 or resid 9 to 10", "type 1 2 and charge < 0",
+                  "within 4 of (resid 5 and name CA)", "not (z > -5 or resname TYR)", "id 1:10 and not name N"]:
+        print("{:40s} {:4d} atoms".format(query, select(l, query, labels).sum()))
+    for query in ["resid 1 and", "name", "type a:b", "x < y", "resname TYR)", "within 4 (resid 5)"]:
+        try:
+            select(l, query, labels)
+        except ValueError as e:
+            print("expected error:", e)
+
+    # the whole system and the first residues
+    energy = l.charmmEvaluate()[0]
+    same = subset(l, select(l, "all"))
+    print("all: energy change {:.2e}".format((same.charmmEvaluate()[0] - energy).abs().max()))
+    mask = select(l, "resid 1 to 3", labels)
+    part = subset(l, mask)
+    rows = pd.Index(l.atomproperty.atoms.aID.values)
+    inside = mask[rows.get_indexer(l.topologia.dihedrals[['Atom1', 'Atom2', 'Atom3', 'Atom4']].values.ravel())]
+    assert len(part.topologia.dihedrals) == inside.reshape(-1, 4).all(axis=1).sum()
+    print("resid 1 to 3: {} atoms, {} bonds, {} dihedrals, {} atom types, {} dihedral types".format(
+          len(part.atomproperty.atoms), len(part.topologia.bonds), len(part.topologia.dihedrals),
+          len(part.atomproperty.masses), len(part.forceField.dihedralCoeffs)))
+    part.writeConf("subset.data")
+    again = LammpsData("subset.data")
+    os.remove("subset.data")
+    print("bonded energies of the subset, before and after writing:",
+          part.charmmEvaluate()[0][['bond', 'angle', 'dihedral', 'improper']].round(6).tolist(),
+          again.charmmEvaluate()[0][['bond', 'angle', 'dihedral', 'improper']].round(6).tolist())
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""-------------------------------------------------------------------------
+  streams.py
+  Part of granules Version 0.1.0, October, 2019
+
+
+    Copyright 2019: José O.  Sotero Esteva, Lyxaira M. Glass Rivera,
+    Computational Science Group, Department of Mathematics,
+    University of Puerto Rico at Humacao
+    <jose.sotero@upr.edu>.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License version 3 as published by
+    the Free Software Foundation.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program (gpl.txt).  If not, see <http://www.gnu.org/licenses/>.
+
+    Acknowledgements: The main funding source for this project has been provided
+    by the UPR-Penn Partnership for Research and Education in Materials program,
+    USA National Science Foundation grant number DMR-0934195.
+"""
+
+import io
+import os
+import gzip
+import bz2
+import lzma
+
+BLOCK_SIZE = 1 << 20     # bytes moved per read or write of the underlying file
+
+# compression formats: (file name extension, magic number, open function)
+COMPRESSIONS = {'gzip': ('.gz',  b'\x1f\x8b',         gzip.open),
+                'bz2' : ('.bz2', b'BZh',              bz2.open),
+                'xz'  : ('.xz',  b'\xfd7zXZ\x00',     lzma.open)}
+
+
+class TextStream(io.TextIOWrapper):
+    ''' Text stream returned by openStream. Closing it closes the layers
+        opened by openStream (decompressor, buffers and file) but never a
+        file-like object given by the caller.
+    '''
+
+    def __init__(self, buffer, layers):
+        super().__init__(buffer, encoding='utf-8', errors='replace')
+        self._layers = layers
+
+    @property
+    def closed(self):
+        return self._layers is None or super().closed
+
+    def close(self):
+        if self._layers is None: return
+        if not super().closed:
+            self.flush()
+            self.detach()
+        layers, self._layers = self._layers, None
+        for layer in layers: layer.close()
+
+
+class BorrowedStream:
+    ''' Text file-like object given by the caller: close() only flushes it.'''
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._stream)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if hasattr(self._stream, 'flush'): self._stream.flush()
+
+
+def detectCompression(binary):
+    ''' compression format of a binary stream from its first bytes, without
+        consuming them. Returns '' when they can not be inspected.
+    '''
+    if hasattr(binary, 'peek'):
+        magic = binary.peek(6)[:6]
+    elif hasattr(binary, 'seekable') and binary.seekable():
+        position = binary.tell()
+        magic = binary.read(6)
+        binary.seek(position)
+    else:
+        return ''
+    for name, (extension, number, opener) in COMPRESSIONS.items():
+        if magic.startswith(number): return name
+    return ''
+
+
+def openStream(source, mode='r', compression=None):
+    ''' Opens a text stream for reading ('r') or writing ('w', 'a') that
+        decompresses or compresses on the fly, moving BLOCK_SIZE bytes at a
+        time to and from the underlying file.
+
+        Parameter
+        ----------
+        source : str, path or file-like object
+            file name, or an open text or binary file-like object. Binary
+            objects are decompressed like files; text objects are used as they are.
+
+        mode : str
+            'r', 'w' or 'a'
+
+        compression : str or None
+            'gzip', 'bz2', 'xz' or '' (none). When None it is recognized from
+            the contents of the file when reading and from the extension of
+            the file name (.gz, .bz2, .xz) when writing.
+
+        Returns
+            a text stream that can be iterated, written and closed as the
+            objects returned by open()
+    '''
+    mode = mode.replace('t', '').replace('b', '')
+    if isinstance(source, BorrowedStream):
+        return source
+    if isinstance(source, io.TextIOBase):
+        # also TextStreams: a reader that passes its stream on keeps closing it
+        return BorrowedStream(source)
+
+    if hasattr(source, 'read') or hasattr(source, 'write'):
+        binary = source
+        layers = []
+    else:
+        filename = os.fspath(source)
+        binary = open(filename, mode + 'b', buffering=BLOCK_SIZE)
+        layers = [binary]
+        if compression is None and mode != 'r':
+            compression = next((name for name, c in COMPRESSIONS.items()
+                                if filename.endswith(c[0])), '')
+
+    if compression is None:
+        compression = detectCompression(binary) if mode == 'r' else ''
+    if compression:
+        if compression not in COMPRESSIONS:
+            raise ValueError("unknown compression '{}'".format(compression))
+        compressed = COMPRESSIONS[compression][2](binary, mode + 'b')
+        if mode == 'r': binary = io.BufferedReader(compressed, BLOCK_SIZE)
+        else:           binary = io.BufferedWriter(compressed, BLOCK_SIZE)
+        layers = [binary, compressed] + layers
+
+    return TextStream(binary, layers)
+
+
+#=============================================================================
+if __name__ == "__main__":  # tests
+    import time, tempfile
+
+    lines = "".join("ATOM  {:5d} test line\n".format(i % 100000) for i in range(200000))
+    folder = tempfile.mkdtemp()
+    for extension in ['', '.gz', '.bz2', '.xz']:
+        filename = os.path.join(folder, "lines.txt" + extension)
+        start = time.time()
+        with openStream(filename, 'w') as out: out.write(lines)
+        written = time.time() - start
+        start = time.time()
+        with openStream(filename) as arch: text = arch.read()
+        assert text == lines
+        print("{:5} {:8.1f} MB  write {:5.2f} s  read {:5.2f} s".format(
+              extension or 'plain', os.path.getsize(filename) / 1e6, written, time.time() - start))
+
+        # binary file-like objects are not closed
+        with open(filename, 'rb') as f:
+            with openStream(f) as arch: assert arch.readline() == lines[:lines.index('\n') + 1]
+            assert not f.closed
+
+    # open text handles and StringIO objects are read as they are
+    from granules.structure.NAMDdata import PDB, PSF, PRM
+
+    os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tests", "chignolin"))
+    names = {PDB: "2rvd_autopsf.pdb", PSF: "2rvd_autopsf.psf", PRM: "par_all36_prot.prm"}
+    for cls, name in names.items():
+        byName = cls()
+        byName.readFile(name)
+        with open(name) as f:
+            text = f.read()
+        for handle in [open(name), io.StringIO(text)]:
+            read = cls()
+            read.readFile(handle)
+            handle.close()
+            if cls is PDB:
+                assert read.equals(byName)
+            elif cls is PSF:
+                assert read.atoms.equals(byName.atoms) and read.bonds.equals(byName.bonds) and \
+                       read.dihedrals.equals(byName.dihedrals)
+            else:
+                assert read.bonds.equals(byName.bonds) and read.nonbonded.equals(byName.nonbonded)
+        print("{}: read from a text handle and from StringIO".format(cls.__name__))
@@ -18,6 +18,10 @@ ch.readFiles("2rvd_autopsf.pdb", "2rvd_autopsf.psf", "par_all36_prot.prm")
 l.loadNAMDdata(ch)
 l.writeConf("2rvd.data")
 
+# SHAKE constraints on the bonds to hydrogens, included by in.lammps
+with open("shake.in", "w") as shake:
+    shake.write(l.fixShake(fixId="2") + "\n")
+
 '''
 #Pruebas para selectAtoms()
 
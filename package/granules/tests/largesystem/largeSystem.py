@@ -0,0 +1,95 @@
+'''
+ largeSystem.py
+
+Tests reading of systems larger than the fixed-width PDB and PSF fields:
+hybrid-36 serial and residue numbers in the PDB file, PSF EXT format and
+atom numbers that fill their whole PSF field. The input files are generated
+here (a box of TIP3P water).
+
+  usage: python3 largeSystem.py [number of atoms]
+
+'''
+
+import sys, time
+import numpy as np
+
+from granules.structure.NAMDdata import NAMDdata, PSF, encodeHybrid36
+from granules.structure.LAMMPSdata import LammpsData
+
+
+def writeWaterBox(nwaters, prefix):
+    ''' writes prefix.pdb (hybrid-36), prefix.psf (PSF EXT) and prefix.prm.'''
+    side  = int(np.ceil(nwaters ** (1.0/3)))
+    cell  = np.indices((side, side, side)).reshape(3, -1).T[:nwaters] * 3.1
+    xyz   = np.repeat(cell, 3, axis=0) + np.tile([[0.0, 0.0, 0.0], [0.9572, 0.0, 0.0],
+                                                  [-0.2400, 0.9266, 0.0]], (nwaters, 1))
+    names = ["OH2", "H1", "H2"]
+
+    with open(prefix + ".pdb", "w") as pdb:
+        pdb.write("REMARK synthetic water box\n")
+        for i, (x, y, z) in enumerate(xyz):
+            pdb.write("ATOM  {} {:<4} TIP3W{}    {:8.3f}{:8.3f}{:8.3f}  1.00  0.00      WAT  {:>2}\n".format(
+                      encodeHybrid36(i + 1, 5), names[i % 3], encodeHybrid36(i // 3 + 1, 4),
+                      x, y, z, names[i % 3][0]))
+        pdb.write("END\n")
+
+    with open(prefix + ".psf", "w") as psf:
+        psf.write("PSF EXT\n\n{:10d} !NTITLE\n REMARKS synthetic water box\n\n".format(1))
+        psf.write("{:10d} !NATOM\n".format(3 * nwaters))
+        for i in range(3 * nwaters):
+            atype, charge, mass = ("OT", -0.834, 15.9994) if i % 3 == 0 else ("HT", 0.417, 1.008)
+            psf.write("{:10d} {:<8} {:<8} {:<8} {:<8} {:<6} {:10.6f}    {:10.4f}  {:10d}\n".format(
+                      i + 1, "WAT", i // 3 + 1, "TIP3", names[i % 3], atype, charge, mass, 0))
+
+        oxygens = np.arange(1, 3 * nwaters, 3)
+        sections = [("!NBOND: bonds",   np.column_stack([oxygens, oxygens + 1, oxygens, oxygens + 2]).reshape(-1, 2), 4),
+                    ("!NTHETA: angles", np.column_stack([oxygens + 1, oxygens, oxygens + 2]), 3),
+                    ("!NPHI: dihedrals", np.zeros((0, 4), dtype=int), 2),
+                    ("!NIMPHI: impropers", np.zeros((0, 4), dtype=int), 2)]
+        for title, terms, perLine in sections:
+            psf.write("\n{:10d} {}\n".format(len(terms), title))
+            flat = terms.ravel()
+            step = perLine * terms.shape[1]
+            for start in range(0, len(flat), step):
+                psf.write("".join("{:10d}".format(v) for v in flat[start:start + step]) + "\n")
+        psf.write("\n{:10d} !NCRTERM: cross-terms\n\n".format(0))
+
+    with open(prefix + ".prm", "w") as prm:
+        prm.write("* TIP3P water\n*\n\nBONDS\nOT   HT    450.000     0.9572\nHT   HT      0.000     1.5139\n\n"
+                  "ANGLES\nHT   OT   HT     55.000   104.5200\n\nDIHEDRALS\n\nIMPROPER\n\n"
+                  "NONBONDED\nOT     0.000000  -0.152100     1.768200\nHT     0.000000  -0.046000     0.224500\n\nEND\n")
+
+
+natoms  = int(sys.argv[1]) if len(sys.argv) > 1 else 150000
+nwaters = natoms // 3
+writeWaterBox(nwaters, "water")
+
+start = time.time()
+ch = NAMDdata()
+ch.readFiles("water.pdb", "water.psf", "water.prm", compact=True)
+print("{} atoms read in {:.1f} s".format(len(ch.pdb), time.time() - start))
+
+assert len(ch.pdb) == len(ch.psf.atoms) == 3 * nwaters
+assert ch.pdb['ResSeq'].max() == nwaters
+assert len(ch.psf.bonds) == 2 * nwaters and ch.psf.bonds['atom2'].max() == 3 * nwaters
+assert len(ch.psf.angles) == nwaters
+
+serials = NAMDdata()
+serials.pdb.readFile("water.pdb", useSerials=True)
+assert (serials.pdb['ID'].values == np.arange(1, 3 * nwaters + 1)).all()
+
+# atom numbers of 8 digits run together in the standard (I8) PSF format
+with open("wide.psf", "w") as psf:
+    psf.write("PSF\n\n       1 !NTITLE\n REMARKS wide fields\n\n       0 !NATOM\n\n"
+              "       3 !NBOND: bonds\n" +
+              "".join("{:8d}".format(v) for v in [12345678, 12345679, 12, 13, 99999998, 99999999]) + "\n")
+bonds = PSF.BOND()
+bonds.readSection("wide.psf")
+assert bonds.values.tolist() == [[12345678, 12345679], [12, 13], [99999998, 99999999]]
+
+start = time.time()
+l = LammpsData()
+l.loadNAMDdata(ch, compact=True)
+l.writeConf("water.data")
+print("converted in {:.1f} s, {:.0f} bytes per atom".format(time.time() - start, l.bytesPerAtom()))
+print("OK")
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""-------------------------------------------------------------------------
+  hydrogenMass.py
+  Part of granules Version 0.1.0, October, 2019
+
+
+    Copyright 2019: José O.  Sotero Esteva, Lyxaira M. Glass Rivera,
+    Computational Science Group, Department of Mathematics,
+    University of Puerto Rico at Humacao
+    <jose.sotero@upr.edu>.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License version 3 as published by
+    the Free Software Foundation.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program (gpl.txt).  If not, see <http://www.gnu.org/licenses/>.
+
+    Acknowledgements: The main funding source for this project has been provided
+    by the UPR-Penn Partnership for Research and Education in Materials program,
+    USA National Science Foundation grant number DMR-0934195.
+"""
+
+import numpy as np
+import pandas as pd
+
+from granules.simulation.constraints import HYDROGEN_MASS, atomRows, bondComponents
+
+REPARTITIONED_MASS = 3.024    # g/mol, three times the mass of hydrogen
+
+
+def repartitionHydrogenMass(lammpsdata, hydrogenMass=REPARTITIONED_MASS, lightMass=HYDROGEN_MASS,
+                            skipWater=True, minimumMass=1.0):
+    ''' Hydrogen mass repartitioning: every hydrogen gets 'hydrogenMass' and
+        the heavy atom bonded to it loses the mass gained, so the total mass
+        is unchanged. LAMMPS masses are per atom type, so atom types whose
+        atoms end up with different masses are split: the atoms that keep the
+        original mass keep the type and the others get new types, numbered
+        after the existing ones, with the Pair Coeffs of the original type.
+        Atoms, Masses and Pair Coeffs of lammpsdata are replaced.
+
+        Parameter
+        ----------
+        lammpsdata : LammpsData
+
+        hydrogenMass : float
+            new mass of the hydrogens, g/mol
+
+        lightMass : float
+            atoms lighter than this are hydrogens
+
+        skipWater : bool
+            leave molecules of 3 atoms (rigid water) untouched
+
+        minimumMass : float
+            heavy atoms may not become lighter than this (ValueError)
+
+        returns DataFrame with the old type, new type, mass and number of
+        atoms of every resulting atom type (types without atoms included)
+    '''
+    prop, top = lammpsdata.atomproperty, lammpsdata.topologia
+    atoms = prop.atoms
+    mass  = prop.atomMasses()
+    light = mass < lightMass
+
+    rows = atomRows(atoms, top.bonds[['Atom1', 'Atom2']].values)
+    hydrogen = rows[light[rows[:, 0]] != light[rows[:, 1]]]
+    hydrogen = np.where(light[hydrogen[:, :1]], hydrogen, hydrogen[:, ::-1])   # (hydrogen, heavy)
+    if skipWater:
+        component = bondComponents(len(atoms), rows)
+        size = np.bincount(component, minlength=len(atoms))
+        hydrogen = hydrogen[size[component[hydrogen[:, 0]]] != 3]
+    # a hydrogen bonded to several heavy atoms takes its mass from the first one
+    hydrogen = hydrogen[np.unique(hydrogen[:, 0], return_index=True)[1]]
+
+    newMass = mass.copy()
+    newMass[hydrogen[:, 0]] = hydrogenMass
+    newMass -= np.bincount(hydrogen[:, 1], weights=hydrogenMass - mass[hydrogen[:, 0]],
+                           minlength=len(atoms))
+    if np.any(newMass[hydrogen[:, 1]] < minimumMass):
+        bad = atoms.aID.values[hydrogen[:, 1]][newMass[hydrogen[:, 1]] < minimumMass]
+        raise ValueError("atoms {} would be lighter than {} g/mol".format(list(np.unique(bad)[:10]), minimumMass))
+
+    # one type per (old type, new mass); the original mass keeps the old type
+    oldType = atoms.aType.values.astype(int)
+    combos  = pd.DataFrame({'old': oldType, 'Mass': np.round(newMass, 6)})
+    combos  = combos.groupby(['old', 'Mass']).size().rename('atoms').reset_index()
+    typeMass = prop.masses.drop_duplicates(subset='aType')
+    typeMass = pd.Series(typeMass.Mass.values.astype(float), index=typeMass.aType.values.astype(int))
+    combos['original'] = np.isclose(combos.Mass.values, typeMass.loc[combos.old.values].values)
+    combos = combos.sort_values(['old', 'original'], ascending=[True, False], kind='stable')
+    keeps  = ~combos.old.duplicated().values
+    combos['aType'] = combos.old.values
+    combos.loc[~keeps, 'aType'] = max(oldType.max(), typeMass.index.max()) + 1 + np.arange((~keeps).sum())
+
+    # every type of Masses keeps its row, also those without atoms
+    unused = typeMass.index.difference(combos.old.values)
+    combos = pd.concat([combos, pd.DataFrame({'old': unused, 'Mass': typeMass.loc[unused].values, 'atoms': 0,
+                                              'original': True, 'aType': unused})], ignore_index=True)
+    combos = combos.sort_values('aType').reset_index(drop=True)
+
+    typeOf = pd.Series(combos.aType.values, index=pd.MultiIndex.from_frame(combos[['old', 'Mass']]))
+    newType = typeOf.loc[list(zip(oldType, np.round(newMass, 6)))].values
+    atoms['aType'] = newType.astype(atoms.aType.dtype)
+
+    # replace the tables in place, as LammpsData.compact
+    pd.DataFrame.__init__(prop.masses, combos[['aType', 'Mass']].astype({'aType': prop.masses.aType.dtype}))
+
+    pairCoeffs = lammpsdata.forceField.pairCoeffs
+    pair = pairCoeffs.drop_duplicates(subset='aType')
+    pair = pair.set_index(pair.aType.astype(int)).loc[combos.old.values].reset_index(drop=True)
+    pair['aType'] = pair['aType2'] = combos.aType.values
+    pd.DataFrame.__init__(pairCoeffs, pair[list(pairCoeffs.columns)])
+
+    return combos[['old', 'aType', 'Mass', 'atoms']]
+
+
+#=============================================================================
+if __name__ == "__main__":  # tests
+    import os
+    from granules.structure.NAMDdata import NAMDdata
+    from granules.structure.LAMMPSdata import LammpsData
+
+    os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tests", "chignolin"))
+    l = LammpsData()
+    l.loadNAMDdata(NAMDdata("2rvd_autopsf.pdb", "2rvd_autopsf.psf", "par_all36_prot.prm"))
+    before = l.atomproperty.atomMasses()
+    energy = l.charmmEvaluate()[0].sum()
+
+    types = repartitionHydrogenMass(l)
+    after = l.atomproperty.atomMasses()
+    print(types.to_string(index=False))
+    print("total mass {:.4f} -> {:.4f}, lightest atom {:.3f}, {} -> {} atom types, energy change {:.2e}".format(
+          before.sum(), after.sum(), after.min(), types.old.nunique(), len(l.atomproperty.masses),
+          l.charmmEvaluate()[0].sum() - energy))
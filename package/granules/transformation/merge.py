@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""-------------------------------------------------------------------------
+  merge.py
+  Part of granules Version 0.1.0, October, 2019
+
+
+    Copyright 2019: José O.  Sotero Esteva, Lyxaira M. Glass Rivera,
+    Computational Science Group, Department of Mathematics,
+    University of Puerto Rico at Humacao
+    <jose.sotero@upr.edu>.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License version 3 as published by
+    the Free Software Foundation.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program (gpl.txt).  If not, see <http://www.gnu.org/licenses/>.
+
+    Acknowledgements: The main funding source for this project has been provided
+    by the UPR-Penn Partnership for Research and Education in Materials program,
+    USA National Science Foundation grant number DMR-0934195.
+"""
+
+
+import numpy as np
+import pandas as pd
+
+from granules.transformation.reorder import TERM_TABLES
+
+# coefficient table and type column of each topology table
+COEFF_TABLES = {'bonds':     ('bondCoeffs',     'bType'),
+                'angles':    ('angleCoeffs',    'anType'),
+                'dihedrals': ('dihedralCoeffs', 'dType'),
+                'impropers': ('improperCoeffs', 'iType')}
+
+PAIR_COLUMNS = ['epsilon', 'sigma', 'epsilon1_4', 'sigma1_4']
+
+
+def offsets(maxima):
+    ''' shift of the IDs of each system: sum of the largest IDs of the
+        systems before it.
+    '''
+    return np.concatenate([[0], np.cumsum(maxima)[:-1]]).astype(np.int64)
+
+
+def shifted(values, shift):
+    ''' values + shift in the dtype of 'values', or int64 if they no longer fit.'''
+    result = values.astype(np.int64) + shift
+    if len(result) and result.max() > np.iinfo(values.dtype).max: return result
+    return result.astype(values.dtype)
+
+
+def stack(frames, like=None):
+    ''' frames concatenated in one step (with the columns of the table
+        'like') and the index of the frame of each row.
+    '''
+    sizes  = np.array([len(f) for f in frames], dtype=np.int64)
+    system = np.repeat(np.arange(len(frames)), sizes)
+    like   = frames[0] if like is None else like
+    frames = [f for f in frames if len(f)]
+    if not frames: return like.iloc[:0].copy(), system
+    return pd.concat(frames, ignore_index=True)[list(like.columns)], system
+
+
+def firstPerType(table, system, typeColumn):
+    ''' rows of the first appearance of each (system, type), sorted by
+        system and type.
+    '''
+    types = table[typeColumn].values.astype(np.int64)
+    width = types.max(initial=0) + 1
+    return np.unique(system * width + types, return_index=True)[1]
+
+
+def mergeTypes(table, system, nsystems, typeColumn):
+    ''' Merges the coefficient tables of several systems into one table
+        where types with the same parameter values are one type, numbered
+        1..T in order of first appearance.
+
+        Parameter
+        ----------
+        table : DataFrame
+            coefficient tables of all the systems, concatenated (stack)
+
+        system : int array
+            system of each row of 'table'
+
+        nsystems : int
+            number of systems
+
+        typeColumn : str
+            column of the types
+
+        returns (merged table, lookup) where lookup[s, t] is the new type of
+                type t of system s (0 if t is not a type of s)
+    '''
+    rows   = firstPerType(table, system, typeColumn)
+    table  = table.iloc[rows].reset_index(drop=True)
+    system = system[rows]
+    old    = table[typeColumn].values.astype(np.int64)
+    lookup = np.zeros((nsystems, old.max(initial=0) + 1), dtype=np.int64)
+    if len(table) == 0: return table, lookup
+
+    params = [c for c in table.columns if c != typeColumn]
+    new = table.groupby(params, sort=False, dropna=False).ngroup().values if params \
+          else np.zeros(len(table), dtype=np.int64)
+    # number the groups by first appearance
+    first = np.sort(np.unique(new, return_index=True)[1])
+    rank  = np.zeros(new.max() + 1, dtype=np.int64)
+    rank[new[first]] = np.arange(1, len(first) + 1)
+    lookup[system, old] = rank[new]
+
+    merged = table.iloc[first].reset_index(drop=True)
+    merged[typeColumn] = np.arange(1, len(merged) + 1).astype(merged[typeColumn].dtype)
+    return merged, lookup
+
+
+def remap(lookup, system, types, what):
+    ''' new types of the 'types' of each row of a concatenated table.'''
+    types = np.asarray(types, dtype=np.int64)
+    inside = types < lookup.shape[1]
+    new = np.zeros(len(types), dtype=np.int64)
+    new[inside] = lookup[system[inside], types[inside]]
+    if np.any(new == 0):
+        raise ValueError("{} of types without coefficients: {}".format(what, list(np.unique(types[new == 0])[:10])))
+    return new
+
+
+def mergeSystems(systems):
+    ''' Combines several LammpsData objects into a new one with one
+        concatenation per table. Atom, molecule and term IDs of each system
+        are shifted by the largest IDs of the systems before it, and atom,
+        bond, angle, dihedral and improper types with the same parameters
+        (mass and pair coefficients for atom types) become a single type.
+        The region is the smallest box that holds the boxes of all systems.
+
+        Parameter
+        ----------
+        systems : list of LammpsData
+
+        returns LammpsData
+    '''
+    from granules.structure.LAMMPSdata import LammpsData
+
+    systems = list(systems)
+    result  = LammpsData()
+    if not systems: return result
+    nsystems = len(systems)
+
+    def replace(table, frame):
+        # replace the tables in place, as LammpsData.compact
+        pd.DataFrame.__init__(table, frame)
+
+    def maxima(frames, column):
+        return np.array([int(f[column].max()) if len(f) else 0 for f in frames], dtype=np.int64)
+
+    # atom types: mass and pair coefficients of the first row of each type
+    masses, msystem = stack([s.atomproperty.masses for s in systems])
+    rows = firstPerType(masses, msystem, 'aType')
+    masses, msystem = masses.iloc[rows].reset_index(drop=True), msystem[rows]
+    pair, psystem = stack([s.forceField.pairCoeffs for s in systems])
+    rows = firstPerType(pair, psystem, 'aType')
+    pair, psystem = pair.iloc[rows], psystem[rows]
+    width = max(masses.aType.values.max(initial=0), pair.aType.values.max(initial=0)) + 1
+    where = pd.Index(psystem * width + pair.aType.values.astype(np.int64)).get_indexer(
+            msystem * width + masses.aType.values.astype(np.int64))
+    found = where >= 0
+    for c in PAIR_COLUMNS:
+        values = np.full(len(masses), np.nan)
+        values[found] = pair[c].values[where[found]]
+        masses[c] = values
+    atomTypes, atomLookup = mergeTypes(masses, msystem, nsystems, 'aType')
+
+    atoms = [s.atomproperty.atoms for s in systems]
+    table, system = stack(atoms)
+    shift = offsets(maxima(atoms, 'aID'))
+    table['aID']    = shifted(table.aID.values, shift[system])
+    table['Mol_ID'] = shifted(table.Mol_ID.values, offsets(maxima(atoms, 'Mol_ID'))[system])
+    table['aType']  = remap(atomLookup, system, table.aType.values, "atoms").astype(table.aType.dtype)
+    replace(result.atomproperty.atoms, table)
+
+    table, vsystem = stack([s.atomproperty.velocities for s in systems])
+    table['vID'] = shifted(table.vID.values, shift[vsystem])
+    replace(result.atomproperty.velocities, table)
+
+    replace(result.atomproperty.masses, atomTypes[['aType', 'Mass']])
+    withPair = atomTypes[PAIR_COLUMNS].notna().all(axis=1).values
+    pair = atomTypes.loc[withPair, ['aType'] + PAIR_COLUMNS]
+    pair.insert(1, 'aType2', pair.aType.values)
+    replace(result.forceField.pairCoeffs, pair.reset_index(drop=True))
+
+    for name, (idColumn, columns) in TERM_TABLES.items():
+        coeffName, typeColumn = COEFF_TABLES[name]
+        coeffs, lookup = mergeTypes(*stack([getattr(s.forceField, coeffName) for s in systems]),
+                                    nsystems, typeColumn)
+        terms = [getattr(s.topologia, name) for s in systems]
+        table, tsystem = stack(terms)
+        table[idColumn] = shifted(table[idColumn].values, offsets(maxima(terms, idColumn))[tsystem])
+        table[typeColumn] = remap(lookup, tsystem, table[typeColumn].values, name).astype(table[typeColumn].dtype)
+        for c in columns: table[c] = shifted(table[c].values, shift[tsystem])
+        replace(getattr(result.topologia, name), table)
+        replace(getattr(result.forceField, coeffName), coeffs)
+
+    boxes = [s.region.maxsMins for s in systems if s.region.maxsMins is not None]
+    if boxes:
+        boxes = np.array(boxes, dtype=float).reshape(-1, 3, 2)
+        result.region.setMinsMaxs([float(x) for lo, hi in zip(boxes[:, :, 0].min(axis=0), boxes[:, :, 1].max(axis=0))
+                                   for x in (lo, hi)])
+    return result
+
+
+#=============================================================================
+if __name__ == "__main__":  # tests
+    import os, time
+    from granules.structure.NAMDdata import NAMDdata
+    from granules.structure.LAMMPSdata import LammpsData
+
+    os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tests", "chignolin"))
+    ch = NAMDdata("2rvd_autopsf.pdb", "2rvd_autopsf.psf", "par_all36_prot.prm")
+    l = LammpsData()
+    l.loadNAMDdata(ch)
+    energies = l.charmmEvaluate()[0]
+
+    # copies 40 A apart: bonded energies add up, types are shared
+    copies = []
+    for k in range(8):
+        c = l.copy()
+        c.atomproperty.atoms['x'] += 40.0 * k
+        copies.append(c)
+    merged = mergeSystems(copies)
+    mergedEnergies = merged.charmmEvaluate()[0]
+    print("8 copies: {} atoms, {} atom types ({} before), {} bond types ({} before)".format(
+          len(merged.atomproperty.atoms), len(merged.atomproperty.masses), len(l.atomproperty.masses),
+          len(merged.forceField.bondCoeffs), len(l.forceField.bondCoeffs)))
+    for term in energies.index:
+        print("  {:12s} {:14.6f} {:14.6f}".format(term, 8 * energies[term], mergedEnergies[term]))
+
+    for n in [100, 1000, 4000]:
+        t = time.time()
+        merged = mergeSystems([l] * n)
+        print("{:5d} systems merged in {:.2f} s: {} atoms, {} dihedrals".format(
+              n, time.time() - t, len(merged.atomproperty.atoms), len(merged.topologia.dihedrals)))
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""-------------------------------------------------------------------------
+  reorder.py
+  Part of granules Version 0.1.0, October, 2019
+
+
+    Copyright 2019: José O.  Sotero Esteva, Lyxaira M. Glass Rivera,
+    Computational Science Group, Department of Mathematics,
+    University of Puerto Rico at Humacao
+    <jose.sotero@upr.edu>.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License version 3 as published by
+    the Free Software Foundation.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program (gpl.txt).  If not, see <http://www.gnu.org/licenses/>.
+
+    Acknowledgements: The main funding source for this project has been provided
+    by the UPR-Penn Partnership for Research and Education in Materials program,
+    USA National Science Foundation grant number DMR-0934195.
+"""
+
+import numpy as np
+import pandas as pd
+
+CURVES = ['hilbert', 'morton']
+
+# atom ID columns of each topology table and the column with its own IDs
+TERM_TABLES = {'bonds':     ('bID',  ['Atom1', 'Atom2']),
+               'angles':    ('anID', ['Atom1', 'Atom2', 'Atom3']),
+               'dihedrals': ('dID',  ['Atom1', 'Atom2', 'Atom3', 'Atom4']),
+               'impropers': ('iID',  ['Atom1', 'Atom2', 'Atom3', 'Atom4'])}
+
+
+def gridCoordinates(xyz, bits, box=None):
+    ''' integer coordinates (N,3) in [0, 2**bits) of the points 'xyz' in
+        their bounding box or, if given, in the periodic box (lengths,
+        origin at 0).
+    '''
+    xyz = np.asarray(xyz, dtype=float).reshape(-1, 3)
+    if box is None:
+        lo   = xyz.min(axis=0) if len(xyz) else np.zeros(3)
+        span = np.maximum((xyz.max(axis=0) - lo) if len(xyz) else np.ones(3), 1e-12)
+        rel  = (xyz - lo) / span
+    else:
+        rel  = np.mod(xyz, box) / box
+    cells = 1 << bits
+    return np.clip((rel * cells).astype(np.int64), 0, cells - 1).astype(np.uint64)
+
+
+def mortonKeys(xyz, bits=10, box=None):
+    ''' position along the Morton (Z-order) curve of each point: the bits
+        of the grid coordinates interleaved.
+    '''
+    grid = gridCoordinates(xyz, bits, box)
+    keys = np.zeros(len(grid), dtype=np.uint64)
+    for b in range(bits - 1, -1, -1):
+        for d in range(3):
+            keys = (keys << np.uint64(1)) | ((grid[:, d] >> np.uint64(b)) & np.uint64(1))
+    return keys
+
+
+def hilbertKeys(xyz, bits=10, box=None):
+    ''' position along the 3D Hilbert curve of each point, with the
+        transpose algorithm of J. Skilling (AIP Conf. Proc. 707, 381 (2004))
+        applied to all points at once.
+    '''
+    X = gridCoordinates(xyz, bits, box)
+    one = np.uint64(1)
+
+    # inverse undo
+    Q = 1 << (bits - 1)
+    while Q > 1:
+        P = np.uint64(Q - 1)
+        for i in range(3):
+            high = (X[:, i] & np.uint64(Q)) != 0
+            X[high, 0] ^= P
+            low = ~high
+            t = (X[low, 0] ^ X[low, i]) & P
+            X[low, 0] ^= t
+            X[low, i] ^= t
+        Q >>= 1
+
+    # Gray encode
+    X[:, 1] ^= X[:, 0]
+    X[:, 2] ^= X[:, 1]
+    t = np.zeros(len(X), dtype=np.uint64)
+    Q = 1 << (bits - 1)
+    while Q > 1:
+        t[(X[:, 2] & np.uint64(Q)) != 0] ^= np.uint64(Q - 1)
+        Q >>= 1
+    X ^= t[:, np.newaxis]
+
+    keys = np.zeros(len(X), dtype=np.uint64)
+    for b in range(bits - 1, -1, -1):
+        for d in range(3):
+            keys = (keys << one) | ((X[:, d] >> np.uint64(b)) & one)
+    return keys
+
+
+def spatialOrder(xyz, curve='hilbert', molecules=None, bits=10, box=None):
+    ''' Permutation of the atoms that sorts them along a space-filling curve.
+
+        Parameter
+        ----------
+        xyz : array (N,3)
+
+        curve : str
+            'hilbert' or 'morton'
+
+        molecules : array (N) or None
+            molecule of each atom; molecules are kept contiguous, ordered by
+            the position of their centroids, and their atoms are sorted
+            along the curve
+
+        bits : int
+            resolution of the curve: 2**bits cells per dimension
+
+        box : array of 3 floats or None
+            periodic cell lengths
+
+        returns int array with the old index of each new position
+    '''
+    if curve not in CURVES:
+        raise ValueError("unknown curve '{}', use one of {}".format(curve, CURVES))
+    keysOf = hilbertKeys if curve == 'hilbert' else mortonKeys
+    xyz = np.asarray(xyz, dtype=float).reshape(-1, 3)
+    if molecules is None:
+        return np.argsort(keysOf(xyz, bits, box), kind='stable')
+
+    codes = pd.factorize(np.asarray(molecules))[0]
+    count = np.bincount(codes)
+    centroid = np.column_stack([np.bincount(codes, weights=xyz[:, d]) for d in range(3)]) / count[:, np.newaxis]
+    molKey = keysOf(centroid, bits, box)
+    return np.lexsort((keysOf(xyz, bits, box), codes, molKey[codes]))
+
+
+def reorderAtoms(lammpsdata, curve='hilbert', keepMolecules=True, bits=10):
+    ''' Sorts the atoms of a LammpsData object along a space-filling curve
+        and renumbers them 1..N in the new order. Atom IDs are replaced
+        in Atoms, Velocities, Bonds, Angles, Dihedrals and Impropers, and
+        the terms are sorted by their new first atom (and renumbered) so
+        that they also visit memory in order.
+
+        Parameter
+        ----------
+        lammpsdata : LammpsData
+
+        curve : str
+            'hilbert' or 'morton'
+
+        keepMolecules : bool
+            keep the atoms of each molecule (group of bonded atoms) together
+
+        bits : int
+            resolution of the curve
+
+        returns int array with the old row of each new atom
+    '''
+    prop, top = lammpsdata.atomproperty, lammpsdata.topologia
+    atoms = prop.atoms
+    box = lammpsdata.region.lengths()
+    xyz = atoms[['x', 'y', 'z']].values.astype(float)
+    if box is not None: xyz = xyz - np.array(lammpsdata.region.maxsMins[::2], dtype=float)
+
+    molecules = None
+    if keepMolecules:
+        from granules.simulation.constraints import atomRows, bondComponents
+        molecules = bondComponents(len(atoms), atomRows(atoms, top.bonds[['Atom1', 'Atom2']].values))
+    order  = spatialOrder(xyz, curve, molecules, bits, box)
+    oldIDs = pd.Index(atoms.aID.values[order])
+    idType = atoms.aID.dtype
+
+    # replace the tables in place, as LammpsData.compact
+    table = atoms.iloc[order].reset_index(drop=True)
+    table['aID'] = np.arange(1, len(table) + 1).astype(idType)
+    pd.DataFrame.__init__(atoms, table)
+
+    velocities = prop.velocities
+    if len(velocities):
+        table = velocities.iloc[oldIDs.get_indexer(velocities.vID.values).argsort(kind='stable')]
+        table = table.reset_index(drop=True)
+        table['vID'] = (oldIDs.get_indexer(table.vID.values) + 1).astype(velocities.vID.dtype)
+        pd.DataFrame.__init__(velocities, table)
+
+    for name, (idColumn, columns) in TERM_TABLES.items():
+        terms = getattr(top, name)
+        if len(terms) == 0: continue
+        table = terms.copy()
+        for c in columns:
+            new = oldIDs.get_indexer(table[c].values)
+            if np.any(new < 0):
+                raise ValueError("{} refer to atoms that are not in the Atoms table".format(name))
+            table[c] = (new + 1).astype(terms[c].dtype)
+        table = table.iloc[np.argsort(table[columns[0]].values, kind='stable')].reset_index(drop=True)
+        table[idColumn] = np.arange(1, len(table) + 1).astype(terms[idColumn].dtype)
+        pd.DataFrame.__init__(terms, table)
+
+    return order
+
+
+#=============================================================================
+if __name__ == "__main__":  # tests
+    import os, time
+    from granules.structure.NAMDdata import NAMDdata
+    from granules.structure.LAMMPSdata import LammpsData
+    from granules.analysis.energy import charmmEvaluate
+
+    os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tests", "tubes"))
+    ch = NAMDdata()
+    ch.readFiles("tubos.pdb", "tubos.psf", "tubos.prm")
+    l = LammpsData()
+    l.loadNAMDdata(ch)
+    energy = l.charmmEvaluate()[0].sum()
+
+    # atoms in random order, as written by a tool that does not sort its output
+    atoms = l.atomproperty.atoms
+    pd.DataFrame.__init__(atoms, atoms.iloc[np.random.default_rng(1).permutation(len(atoms))].reset_index(drop=True))
+
+    def timing(label):
+        terms = l.forceField.charmmTerms(l.atomproperty, l.topologia)
+        xyz = l.atomproperty.atoms[['x', 'y', 'z']].values.astype(float)
+        t = time.time()
+        pairs = terms.nonBondedPairs(xyz)
+        search = time.time() - t
+        t = time.time()
+        for _ in range(5): e = charmmEvaluate(terms, xyz, pairs=pairs)[0]
+        forces = (time.time() - t) / 5
+        print("{:28s}: pair search {:6.3f} s, forces {:6.3f} s, median |i - j| of pairs {:6.0f}, "
+              "energy change {:.1e}".format(label, search, forces, np.median(np.abs(pairs[1] - pairs[0])),
+                                            sum(e.values()) - energy))
+
+    timing("random order")
+    for curve in CURVES:
+        for keep in [False, True]:
+            t = time.time()
+            reorderAtoms(l, curve, keepMolecules=keep)
+            timing("{}{} ({:.3f} s)".format(curve, ", molecules" if keep else "", time.time() - t))
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""-------------------------------------------------------------------------
+  replicate.py
+  Part of granules Version 0.1.0, October, 2019
+
+
+    Copyright 2019: José O.  Sotero Esteva, Lyxaira M. Glass Rivera,
+    Computational Science Group, Department of Mathematics,
+    University of Puerto Rico at Humacao
+    <jose.sotero@upr.edu>.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License version 3 as published by
+    the Free Software Foundation.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program (gpl.txt).  If not, see <http://www.gnu.org/licenses/>.
+
+    Acknowledgements: The main funding source for this project has been provided
+    by the UPR-Penn Partnership for Research and Education in Materials program,
+    USA National Science Foundation grant number DMR-0934195.
+"""
+
+
+import numpy as np
+import pandas as pd
+
+from granules.transformation.reorder import TERM_TABLES
+
+
+def tiled(values, copies, step):
+    ''' 'values' repeated 'copies' times, the k-th copy shifted by k * step,
+        in the dtype of 'values' or in int64 if they no longer fit.
+    '''
+    values = np.asarray(values)
+    fits   = not len(values) or int(values.max()) + (copies - 1) * step <= np.iinfo(values.dtype).max
+    dtype  = values.dtype if fits else np.dtype(np.int64)
+    result = np.tile(values.astype(dtype, copy=False), copies)
+    result += np.repeat(np.arange(copies, dtype=dtype) * step, len(values))
+    return result
+
+
+def replicate(lammpsdata, nx=1, ny=1, nz=1):
+    ''' Tiles a periodic system into a supercell of nx * ny * nz copies, as
+        the LAMMPS replicate command. Copy k = i + nx * (j + ny * k) gets
+        atom, molecule and term IDs shifted by k times the largest ID of
+        the original; types and coefficients are shared by all copies.
+        Coordinates are unwrapped with the image flags, shifted by
+        (i, j, k) box lengths and wrapped into the new box, so bonds that
+        crossed the boundary join atoms of neighboring copies. Atoms,
+        Velocities, topology tables and the region of lammpsdata are
+        replaced.
+
+        Parameter
+        ----------
+        lammpsdata : LammpsData
+            with a box in lammpsdata.region
+
+        nx, ny, nz : int
+            number of copies along each axis
+
+        returns lammpsdata
+    '''
+    counts = np.array([nx, ny, nz], dtype=int)
+    if np.any(counts < 1):
+        raise ValueError("replicate needs at least one copy along each axis, got {}".format(list(counts)))
+    lengths = lammpsdata.region.lengths()
+    if lengths is None:
+        raise ValueError("replicate needs a periodic box (region.setMinsMaxs)")
+    prop, top = lammpsdata.atomproperty, lammpsdata.topologia
+    copies = int(counts.prod())
+    lo = np.array(lammpsdata.region.maxsMins[::2], dtype=float)
+
+    # cell of each copy, x fastest
+    cell = np.indices(counts[::-1]).reshape(3, -1).T[:, ::-1]
+
+    atoms  = prop.atoms
+    natoms = len(atoms)
+    maxID  = int(atoms.aID.max()) if natoms else 0
+    table  = pd.DataFrame({c: np.tile(atoms[c].values, copies) for c in atoms.columns})
+    table['aID'] = tiled(atoms.aID.values, copies, maxID)
+    if natoms: table['Mol_ID'] = tiled(atoms.Mol_ID.values, copies, int(atoms.Mol_ID.max()))
+
+    images = atoms[['Nx', 'Ny', 'Nz']].values.astype(np.int64)
+    unwrapped = atoms[['x', 'y', 'z']].values.astype(float) + images * lengths
+    xyz = (unwrapped[np.newaxis] + (cell * lengths)[:, np.newaxis]).reshape(-1, 3)
+    superLengths = counts * lengths
+    image = np.floor((xyz - lo) / superLengths)
+    table[['x', 'y', 'z']] = (xyz - image * superLengths).astype(atoms.x.dtype)
+    for d, c in enumerate(['Nx', 'Ny', 'Nz']):
+        fits = np.abs(image[:, d]).max(initial=0) <= np.iinfo(atoms[c].dtype).max
+        table[c] = image[:, d].astype(atoms[c].dtype if fits else np.int64)
+
+    # replace the tables in place, as LammpsData.compact
+    pd.DataFrame.__init__(atoms, table)
+
+    velocities = prop.velocities
+    if len(velocities):
+        table = pd.DataFrame({c: np.tile(velocities[c].values, copies) for c in velocities.columns})
+        table['vID'] = tiled(velocities.vID.values, copies, maxID)
+        pd.DataFrame.__init__(velocities, table)
+
+    for name, (idColumn, columns) in TERM_TABLES.items():
+        terms = getattr(top, name)
+        if len(terms) == 0: continue
+        table = pd.DataFrame({c: np.tile(terms[c].values, copies) for c in terms.columns})
+        table[idColumn] = tiled(terms[idColumn].values, copies, int(terms[idColumn].max()))
+        for c in columns: table[c] = tiled(terms[c].values, copies, maxID)
+        pd.DataFrame.__init__(terms, table)
+
+    lammpsdata.region.setMinsMaxs([float(x) for a, l in zip(lo, superLengths) for x in (a, a + l)])
+    return lammpsdata
+
+
+#=============================================================================
+if __name__ == "__main__":  # tests
+    import os, time
+    from granules.structure.NAMDdata import NAMDdata
+    from granules.structure.LAMMPSdata import LammpsData
+
+    os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tests", "chignolin"))
+    ch = NAMDdata("2rvd_autopsf.pdb", "2rvd_autopsf.psf", "par_all36_prot.prm")
+    l = LammpsData()
+    l.loadNAMDdata(ch)
+    # a 24 A box, larger than twice the cutoff, with the peptide across its faces
+    l.region.setMinsMaxs([-10.0, 14.0, -12.0, 12.0, -12.0, 12.0])
+    atoms = l.atomproperty.atoms
+    lengths = l.region.lengths()
+    images = np.floor((atoms[['x', 'y', 'z']].values - [-10.0, -12.0, -12.0]) / lengths).astype(int)
+    atoms[['x', 'y', 'z']] -= images * lengths
+    atoms[['Nx', 'Ny', 'Nz']] = images
+    energy = l.charmmEvaluate()[0].sum()
+
+    big = l.copy()
+    big.region.setMinsMaxs(list(l.region.maxsMins))
+    replicate(big, 2, 3, 2)
+    print("2x3x2 copies: {} atoms, box {}, energy per copy {:.6f}, original {:.6f}".format(
+          len(big.atomproperty.atoms), big.region.maxsMins, big.charmmEvaluate()[0].sum() / 12, energy))
+
+    l.compact()
+    for n in [10, 18, 40]:
+        big = l.copy()
+        big.region.setMinsMaxs(list(l.region.maxsMins))
+        t = time.time()
+        replicate(big, n, n, n)
+        print("{0}x{0}x{0} copies: {1:9d} atoms, {2:9d} bonds in {3:.2f} s".format(
+              n, len(big.atomproperty.atoms), len(big.topologia.bonds), time.time() - t))